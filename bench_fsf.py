@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+# FindSimilarFolders: find duplicate files and folders, that contain many of them
+# Copyright (C) 2015  Johannes König
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# benchmarks for the performance critical parts of fsf_core.
+# run 'bench_fsf.py --help' for the options
+
+import argparse
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+
+from time import perf_counter, process_time
+
+from fsf_core import _get_fileinfo, _get_fileinfo_fast, _read_indexfiles
+from fsf_core import create_index, find_duplicate_files, find_similar_folders, find_similar_trees
+
+
+def make_index_lines(num_lines, files_per_dir=20, depth=4, seed=0):
+	""" return a list of 'num_lines' synthetic index lines.
+	consecutive lines share their directory like in a real index,
+	as create_index writes all files of a folder in a row"""
+
+	rnd = random.Random(seed)
+	lines = []
+	folder = ""
+	for i in range(num_lines):
+		if i % files_per_dir == 0:
+			folder = "/".join("dir{}".format(rnd.randrange(1000)) for _ in range(depth))
+		lines.append("{size: 13d}\t{mtime: 10.4f}\t{checksum:040x}\t{path}\n".format(
+			size = rnd.randrange(1 << 30),
+			mtime = 1425734526.3954 + i,
+			checksum = rnd.getrandbits(160),
+			path = folder + "/file" + str(i)))
+	return lines
+
+
+def _throughput(name, num_lines, seconds):
+	print("{name:30s} {lines: 10d} lines  {sec: 8.3f} s  {rate: 12.0f} lines/s".format(
+			name = name, lines = num_lines, sec = seconds, rate = num_lines / seconds if seconds else 0))
+
+
+def bench_parse(args):
+	""" measure the parse throughput of the index line parsers """
+
+	num_lines = args.lines
+	lines = make_index_lines(num_lines)
+
+	t0 = perf_counter()
+	for line in lines:
+		_get_fileinfo(line)
+	_throughput("_get_fileinfo", num_lines, perf_counter() - t0)
+
+	t0 = perf_counter()
+	dircache = {}
+	for line in lines:
+		_get_fileinfo_fast(line, dircache)
+	_throughput("_get_fileinfo_fast", num_lines, perf_counter() - t0)
+
+	with tempfile.TemporaryDirectory() as tmpdir:
+		indexfile = os.path.join(tmpdir, "bench.idx")
+		with open(indexfile, 'w') as f:
+			f.writelines(lines)
+
+		t0 = perf_counter()
+		_read_indexfiles([indexfile], verbosity=0)
+		_throughput("_read_indexfiles", num_lines, perf_counter() - t0)
+
+
+def _group_size(rnd, distribution):
+	""" draw the number of copies of a file from the distribution
+	'fixed:K' (always K copies), 'uniform:A:B' or 'geometric:P' (at least 2 copies)"""
+
+	kind, *params = distribution.split(':')
+	if kind == "fixed":
+		return int(params[0])
+	if kind == "uniform":
+		return rnd.randint(int(params[0]), int(params[1]))
+	if kind == "geometric":
+		size = 2
+		while rnd.random() > float(params[0]):
+			size += 1
+		return size
+	raise ValueError("unknown group size distribution: " + distribution)
+
+
+def synthetic_files(num_files, depth=3, fanout=4, dup_ratio=0.3, group_sizes="geometric:0.5", seed=0):
+	""" return a list of synthetic files as tuples (folder, filename, content id).
+	the folders form a tree of the given depth and fanout, the files are spread over
+	all folders. A share of 'dup_ratio' of the files are copies of another file, the
+	number of copies per content is drawn from 'group_sizes' (see _group_size)"""
+
+	rnd = random.Random(seed)
+
+	folders = [""]
+	level = [""]
+	for d in range(depth):
+		level = [os.path.join(parent, "d{}_{}".format(d, i)) for parent in level for i in range(fanout)]
+		folders.extend(level)
+
+	slots = list(range(num_files))
+	rnd.shuffle(slots)		# copies end up in random folders
+	content = [0] * num_files
+	content_id = 0
+	pos = 0
+	while pos < num_files:
+		copies = _group_size(rnd, group_sizes) if rnd.random() < dup_ratio else 1
+		for slot in slots[pos:pos + copies]:
+			content[slot] = content_id
+		content_id += 1
+		pos += copies
+
+	return [(folders[i % len(folders)], "f{}".format(i), content[i]) for i in range(num_files)]
+
+
+def _content(content_id, file_size):
+	""" return the bytes of the synthetic content with the given id """
+
+	head = "{}\n".format(content_id).encode()
+	return (head * (file_size // len(head) + 1))[:file_size]
+
+
+def make_tree(rootdir, files, file_size=4096):
+	""" create the synthetic files (see synthetic_files) below rootdir """
+
+	for folder, name, content_id in files:
+		os.makedirs(os.path.join(rootdir, folder), exist_ok=True)
+		with open(os.path.join(rootdir, folder, name), 'wb') as f:
+			f.write(_content(content_id, file_size))
+
+
+def make_index(indexfile, files, file_size=4096):
+	""" write an index of the synthetic files (see synthetic_files) without creating them """
+
+	with open(indexfile, 'w') as f:
+		for i, (folder, name, content_id) in enumerate(files):
+			f.write("{size: 13d}\t{mtime: 10.4f}\t{checksum}\t{path}\n".format(
+				size = file_size,
+				mtime = 1425734526.3954 + i,
+				checksum = hashlib.sha1(_content(content_id, file_size)).hexdigest(),
+				path = os.path.join(folder, name)))
+
+
+def _stage_worker(stage, tmpdir):
+	""" run one stage of the pipeline benchmark in a fresh process,
+	so that the peak RSS belongs to this stage only """
+
+	rootdir = os.path.join(tmpdir, "tree")
+	indexfile = os.path.join(tmpdir, "index")
+	outfile = os.path.join(tmpdir, stage + ".out")
+
+	wall, cpu = perf_counter(), process_time()
+	with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):	# some stages print unconditionally
+		if stage == "create_index":
+			with open(indexfile, 'w') as f:
+				create_index(rootdir, f, None, rel_to=rootdir, verbosity=0)
+		elif stage == "_read_indexfiles":
+			_read_indexfiles([indexfile], verbosity=0)
+		else:
+			function = {"find_duplicate_files": find_duplicate_files,
+						"find_similar_folders": find_similar_folders,
+						"find_similar_trees": find_similar_trees}[stage]
+			with open(outfile, 'w') as f:
+				function([indexfile], f, verbosity=0)
+
+	return {"wall": perf_counter() - wall,
+			"cpu": process_time() - cpu,
+			"peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def _git_commit():
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+								stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+
+def bench_pipeline(args):
+	""" generate a synthetic tree (or with --index-only just its index) and
+	time the stages of the analysis one by one """
+
+	params = {"files": args.files, "depth": args.depth, "fanout": args.fanout, "dup_ratio": args.dup_ratio,
+				"group_sizes": args.group_sizes, "file_size": args.file_size, "seed": args.seed,
+				"index_only": args.index_only}
+	files = synthetic_files(args.files, args.depth, args.fanout, args.dup_ratio, args.group_sizes, args.seed)
+
+	stages = ["_read_indexfiles", "find_duplicate_files", "find_similar_folders", "find_similar_trees"]
+	results = {"commit": _git_commit(), "params": params, "stages": {}}
+
+	with tempfile.TemporaryDirectory() as tmpdir:
+		if args.index_only:
+			make_index(os.path.join(tmpdir, "index"), files, args.file_size)
+		else:
+			make_tree(os.path.join(tmpdir, "tree"), files, args.file_size)
+			stages.insert(0, "create_index")
+
+		context = multiprocessing.get_context("spawn")
+		for stage in stages:
+			with context.Pool(1) as pool:
+				result = pool.apply(_stage_worker, (stage, tmpdir))
+			result["files_per_s"] = args.files / result["wall"] if result["wall"] else 0
+			if stage == "create_index":
+				result["bytes_per_s"] = args.files * args.file_size / result["wall"] if result["wall"] else 0
+			results["stages"][stage] = result
+			print("{stage:25s} {wall: 9.3f} s wall {cpu: 9.3f} s cpu {rate: 12.0f} files/s {rss: 9.1f} MB peak".format(
+					stage = stage, wall = result["wall"], cpu = result["cpu"], rate = result["files_per_s"], rss = result["peak_rss_mb"]))
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(results, f, indent=1)
+
+	if args.compare:
+		with open(args.compare, 'r') as f:
+			old = json.load(f)
+		if compare_results(old, results, args.threshold):
+			sys.exit(1)
+
+
+def compare_results(old, new, threshold=0.1):
+	""" print the change of wall time and peak RSS of each stage between two benchmark
+	results. return True, if a stage got slower or bigger by more than 'threshold'"""
+
+	if old.get("params") != new.get("params"):
+		print("\033[91mwarning: the results were measured with different parameters\033[0m")
+
+	regression = False
+	for stage, result in new["stages"].items():
+		if stage not in old["stages"]:
+			continue
+		line = "{:25s}".format(stage)
+		for key in ["wall", "peak_rss_mb"]:
+			before, after = old["stages"][stage][key], result[key]
+			change = (after - before) / before if before else 0
+			slower = change > threshold
+			regression = regression or slower
+			line += "  {key} {change:+7.1%}".format(key = key, change = change) + (" \033[91mREGRESSION\033[0m" if slower else "")
+		print(line)
+	return regression
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description='Benchmarks for FindSimilarFolders.')
+	subparsers = parser.add_subparsers(title='benchmarks')
+
+	parser_parse = subparsers.add_parser('parse',
+						help='parse throughput of the index line parsers')
+	parser_parse.add_argument('-n', '--lines',
+						default=1000000,
+						type=int,
+						help='number of synthetic index lines to parse')
+	parser_parse.set_defaults(func=bench_parse)
+
+	parser_pipeline = subparsers.add_parser('pipeline',
+						help='time all stages from create_index to find_similar_trees on a synthetic tree')
+	parser_pipeline.add_argument('-n', '--files',
+						default=10000,
+						type=int,
+						help='number of files (default: %(default)s)')
+	parser_pipeline.add_argument('--depth',
+						default=3,
+						type=int,
+						help='depth of the folder tree (default: %(default)s)')
+	parser_pipeline.add_argument('--fanout',
+						default=4,
+						type=int,
+						help='subfolders per folder (default: %(default)s)')
+	parser_pipeline.add_argument('--dup-ratio',
+						default=0.3,
+						type=float,
+						help='share of the contents, that have copies (default: %(default)s)')
+	parser_pipeline.add_argument('--group-sizes',
+						default='geometric:0.5',
+						help='distribution of the number of copies: fixed:K, uniform:A:B or geometric:P (default: %(default)s)')
+	parser_pipeline.add_argument('--file-size',
+						default=4096,
+						type=int,
+						help='size of each file in bytes (default: %(default)s)')
+	parser_pipeline.add_argument('--seed',
+						default=0,
+						type=int)
+	parser_pipeline.add_argument('--index-only',
+						default=False,
+						action='store_true',
+						help="don't create the files, only their index. skips the create_index stage")
+	parser_pipeline.add_argument('-o', '--output',
+						help='save the results as JSON to this file')
+	parser_pipeline.add_argument('-c', '--compare',
+						metavar='JSON',
+						help='compare with the results of an earlier run and exit with 1 on a regression')
+	parser_pipeline.add_argument('--threshold',
+						default=0.1,
+						type=float,
+						help='relative change counted as regression (default: %(default)s)')
+	parser_pipeline.set_defaults(func=bench_pipeline)
+
+	args = parser.parse_args()
+	if not hasattr(args, 'func'):
+		parser.error('choose a benchmark')
+	args.func(args)
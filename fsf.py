@@ -25,8 +25,34 @@
 #todo: harden commandline interface: don't crash, if called with invalid/none options/arguments
 
 import argparse
+import contextlib
+import json
+import os
+import sys
 
-from fsf_core import create_index, collect_folders, find_duplicate_files, find_similar_folders, find_similar_trees
+from fsf_report import REPORT_FORMATS, open_report
+from fsf_metrics import metrics
+from fsf_watch import watch_index
+from fsf_daemon import serve_index, query_index
+from fsf_lookup import open_lookup_filter, lookup_files
+from fsf_plan import plan_index, write_script, run_plan
+
+from fsf_core import MMAP_THRESHOLD, _expand_indexfiles, _is_sorted_index, _shards_of_datasets, open_indexfile, ShardedIndexWriter, create_index, compact_index_file, collect_folders, write_folder_summary, find_duplicate_files, scan_duplicate_files, find_similar_folders, find_similar_trees
+
+
+OUTPUT_BUFFER = 1024*1024		# buffer size of the report files
+
+def _size(string):
+	'''argparse type for sizes: an integer, optionally followed by K, M, G or T'''
+
+	factor = 1
+	if string and string[-1].upper() in "KMGT":
+		factor = 1024 ** ("KMGT".index(string[-1].upper()) + 1)
+		string = string[:-1]
+	try:
+		return int(float(string) * factor)
+	except ValueError:
+		raise argparse.ArgumentTypeError("invalid size: " + string)
 
 
 def prepare_create_index(args):	#todo: integrate collect_folders in create_index
@@ -52,18 +78,77 @@ def prepare_create_index(args):	#todo: integrate collect_folders in create_index
 		start_at = ""
 		start_after=True
 
-	for rootdir in args.rootdir:
-		with open(args.index_file, 'a') as indexFile:
-			create_index(rootdir = rootdir,
-							outfile = indexFile,
-							errorfile = args.log_file,
-							start_at = start_at,
-							start_after = start_after,
-							exclude = exclude,
-							exclude_pattern = exclude_pattern,
-							rel_to = args.relative_to,
-							size_digits = 13,
-							verbosity = args.verbose)
+	# appending to an index sorted by checksum breaks its order, so it is sorted again
+	resort = any(os.path.isfile(file) and _is_sorted_index(file, complete=False) for file in _expand_indexfiles([args.index_file]))
+	if resort and not args.sorted:
+		print("\033[94mthe index is sorted by checksum, it is sorted again after indexing\033[0m")
+
+	# all rootdirs at once: hard links are hashed only once, even if they are in different
+	# rootdirs, and --per-device hashes rootdirs on different devices in parallel
+	with metrics.stage("create_index", 0), \
+			(ShardedIndexWriter(args.index_file, args.shards) if args.shards else open_indexfile(args.index_file, 'a')) as indexFile:
+		create_index(rootdir = args.rootdir,
+						outfile = indexFile,
+						errorfile = args.log_file,
+						start_at = start_at,
+						start_after = start_after,
+						exclude = exclude,
+						exclude_pattern = exclude_pattern,
+						rel_to = args.relative_to,
+						size_digits = 13,
+						verbosity = args.verbose,
+						block_size = args.block_size,
+						bwlimit = args.bwlimit,
+						nocache = args.no_cache,
+						mmap_threshold = args.mmap_threshold,
+						walkers = args.walkers,
+						per_device = args.per_device,
+						order = args.order,
+						min_size = args.min_size,
+						max_size = args.max_size,
+						subdirs = not args.no_subdirs)
+
+	if args.sorted or resort:
+		print('sort index')
+		for file in _expand_indexfiles([args.index_file]):
+			with metrics.stage("sort_index", 0):
+				compact_index_file([file], file, sort = "hash", verbosity = args.verbose)
+
+
+def prepare_plan_index(args):
+	print('plan index')
+
+	exclude = [item for sublist in args.exclude_path or [] for item in sublist]
+	exclude_pattern = [item for sublist in args.exclude_pattern or [] for item in sublist]
+
+	plan = plan_index(rootdirs = args.rootdir,
+						processes = args.jobs,
+						exclude = exclude,
+						min_size = args.min_size,
+						max_size = args.max_size,
+						units_per_process = args.units_per_process,
+						walkers = args.walkers,
+						verbosity = args.verbose)
+
+	# the options of all createIndex calls
+	options = ["-v", "0"]
+	if exclude_pattern:
+		options += ["--exclude-pattern"] + exclude_pattern
+	if args.relative_to:
+		options += ["--relative-to", args.relative_to]
+	if args.log_file:
+		options += ["--log-file", args.log_file]
+	if args.min_size:
+		options += ["--min-size", str(args.min_size)]
+	if args.max_size is not None:
+		options += ["--max-size", str(args.max_size)]
+	sort = "hash" if args.sorted else "path"
+
+	if args.run:
+		run_plan(plan, args.index_file, options, sort, args.verbose)
+	else:
+		with (open(args.script, 'w') if args.script else contextlib.nullcontext(sys.stdout)) as outfile:
+			write_script(plan, args.index_file, outfile, options, sort)
 
 
 def prepare_collect_folders(args):
@@ -99,40 +184,198 @@ def prepare_collect_folders(args):
 								exclude_pattern = exclude_pattern,
 								rel_to = args.relative_to,
 								fast = args.fast,
+								dtype = args.dtype,
 								size_digits = 7,
 								verbosity = args.verbose,
-								serial = args.start_serial)
+								serial = args.start_serial,
+								walkers = args.walkers)
+
+def prepare_compact_index(args):
+	print('compact index')
+
+	compact_index_file(args.index_file, args.outfile,
+						keep = args.keep,
+						drop_missing = args.drop_missing,
+						rel_to = args.relative_to,
+						sort = args.sort,
+						verbosity = args.verbose)
+
+def prepare_watch_index(args):
+	print('watch index')
+
+	watch_index(indexfile = args.index_file,
+				rootdirs = args.rootdir,
+				rel_to = args.relative_to,
+				exclude = [item for sublist in args.exclude_path or [] for item in sublist],
+				exclude_pattern = [item for sublist in args.exclude_pattern or [] for item in sublist],
+				errorfile = args.log_file,
+				poll = args.poll,
+				poll_interval = args.poll_interval,
+				batchsize = args.batch,
+				flush_interval = args.flush_interval,
+				compact_interval = args.compact_interval,
+				verbosity = args.verbose,
+				bwlimit = args.bwlimit,
+				nocache = args.no_cache)
 
 def prepare_duplicate_files(args):
 	print('find duplicate files')
 
-	with open(args.duplicatelist, 'w') as duplicateList:
+	if args.per_shard or args.shard is not None:		# check before the report is created
+		shards = len(_shards_of_datasets(args.index_file))
+		for shard in args.shard or []:
+			if not 0 <= shard < shards:
+				raise ValueError("there is no shard {}, the indexes have {} shards (0 to {})".format(shard, shards, shards - 1))
+
+	with open_report(args.duplicatelist, args.format, OUTPUT_BUFFER) as duplicateList:
 		find_duplicate_files(indexfiles = args.index_file,
 								outfile = duplicateList,
-								verbosity = args.verbose)
+								verbosity = args.verbose,
+								processes = args.jobs,
+								per_shard = args.per_shard,
+								shards = args.shard,
+								verify = args.verify,
+								verify_workers = args.verify_workers,
+								bwlimit = args.bwlimit,
+								rel_to = args.relative_to,
+								min_size = args.min_size,
+								top = args.top,
+								fmt = args.format)
+
+
+def prepare_scan_duplicates(args):
+	print('scan duplicate files')
+
+	with open_report(args.duplicatelist, args.format, 1 if args.format != "sqlite" else -1) as duplicateList:		# line buffered: the groups show up as they are found
+		scan_duplicate_files(rootdir = args.rootdir,
+								outfile = duplicateList,
+								errorfile = args.log_file,
+								exclude = [item for sublist in args.exclude_path or [] for item in sublist],
+								exclude_pattern = [item for sublist in args.exclude_pattern or [] for item in sublist],
+								rel_to = args.relative_to,
+								verbosity = args.verbose,
+								walkers = args.walkers,
+								per_device = args.per_device,
+								order = args.order,
+								bwlimit = args.bwlimit,
+								nocache = args.no_cache,
+								min_size = args.min_size,
+								max_size = args.max_size,
+								verify = args.verify,
+								verify_workers = args.verify_workers,
+								top = args.top,
+								fmt = args.format)
+
+
+def prepare_summarize_folders(args):
+	print('summarize folders')
+
+	write_folder_summary(indexfiles = args.index_file,
+							outfilename = args.summary_file,
+							collection_files = [item for sublist in args.collection_file or [] for item in sublist],
+							verbosity = args.verbose,
+							processes = args.jobs)
 
 
 def prepare_similar_folders(args):
 	print('find similar folders')
 
-	with open(args.similarfolderslist, 'w') as similarFoldersList:
+	with open_report(args.similarfolderslist, args.format, OUTPUT_BUFFER) as similarFoldersList:
 		find_similar_folders(indexfiles = args.index_files,
 								outfile = similarFoldersList,
-								verbosity = args.verbose)
+								verbosity = args.verbose,
+								processes = args.jobs,
+								fmt = args.format,
+								min_size = args.min_size)
 
 
 def prepare_similar_trees(args):
 	print('find similar trees')
 
-	with open(args.similartrees, 'w') as similartrees:
+	with open_report(args.similartrees, args.format, OUTPUT_BUFFER) as similartrees:
 		find_similar_trees(indexfiles = args.index_files,
 								outfile = similartrees,
-								verbosity = args.verbose)
+								verbosity = args.verbose,
+								processes = args.jobs,
+								fmt = args.format,
+								min_size = args.min_size)
+
+
+def prepare_serve_index(args):
+	print('serve index')
+
+	serve_index(socketfile = args.socket,
+				indexfiles = args.index_file,
+				cache_size = args.cache_size,
+				processes = args.jobs,
+				verbosity = args.verbose)
+
+
+def prepare_query_index(args):
+	request = {"query": args.query}
+	if args.query == "duplicates":
+		request["path"] = args.path
+	elif args.query == "overlap":
+		request["folder"] = args.path
+	if args.query == "groups" and args.min_size:
+		request["min_size"] = args.min_size
+	if args.query in ("groups", "overlap") and args.top:
+		request["top"] = args.top
+	if args.query in ("duplicates", "overlap") and not args.path:
+		raise ValueError("the query " + args.query + " needs a PATH")
+
+	try:
+		result = query_index(args.socket, request)
+	except (OSError, ValueError) as e:
+		print("\033[91m" + str(e) + "\033[0m")
+		return
+	for record in (result if isinstance(result, list) else [result]):
+		print(json.dumps(record))
+
+
+def prepare_lookup(args):
+	print('lookup files')
+
+	indexfiles = [item for sublist in args.index or [] for item in sublist]
+	try:
+		lookup = open_lookup_filter(args.filter, indexfiles, args.verbose)
+	except (OSError, ValueError) as e:
+		print("\033[91m" + str(e) + "\033[0m")
+		return
+
+	try:
+		with (open(args.outfile, 'w') if args.outfile else contextlib.nullcontext(sys.stdout)) as outfile:
+			lookup_files(paths = args.candidate,
+							outfile = outfile,
+							lookup = lookup,
+							exclude = [item for sublist in args.exclude_path or [] for item in sublist],
+							exclude_pattern = [item for sublist in args.exclude_pattern or [] for item in sublist],
+							errorfile = args.log_file,
+							locations = not args.no_locations,
+							bwlimit = args.bwlimit,
+							nocache = args.no_cache,
+							verbosity = args.verbose)
+	finally:
+		lookup.close()
 
 
 if __name__ == "__main__":
 
 	parser = argparse.ArgumentParser(description='Find identical files and similar folders.')
+
+	# options of all subcommands
+	metrics_options = argparse.ArgumentParser(add_help=False)
+	metrics_group = metrics_options.add_argument_group('metrics')
+	metrics_group.add_argument('--metrics-file',
+								metavar='FILE',
+								help='write the time of each stage, counters (files hashed, bytes read, groups found, ...) and the peak memory to %(metavar)s. In the Prometheus text format, if it ends with .prom, otherwise as JSON')
+	metrics_group.add_argument('--profile',
+								metavar='FILE',
+								help='run the python profiler and write its statistics to %(metavar)s (see the pstats module)')
+	metrics_group.add_argument('--trace-memory',
+								default=False,
+								action='store_true',
+								help='trace the memory allocations and report the peak of each stage in the metrics file (slow)')
 	subparsers = parser.add_subparsers(	title='subcommands',
 								description='valid subcommands:',
 								help='type %(prog)s SUBCOMMAND --help for additional help')
@@ -140,6 +383,7 @@ if __name__ == "__main__":
 
 
 	parser_create_index = subparsers.add_parser('createIndex',
+								parents=[metrics_options],
 								aliases=['ci'],
 								description='walk through the given tree and store some information of each file in an index',
 								help='create the Index')
@@ -148,7 +392,7 @@ if __name__ == "__main__":
 								nargs='+',
 								help='Start indexing here. More than one dir may be given')
 	parser_create_index.add_argument('index_file',
-								help='file containing the index. new values will be appended')
+								help='file containing the index. new values will be appended. the index is compressed, if the name ends with .gz, .xz, .bz2 or .zst')
 	parser_create_index.add_argument('-v', '--verbose',
 								nargs='?', const='2', default='1',
 								type=int, choices=range(0,4),
@@ -172,12 +416,136 @@ if __name__ == "__main__":
 	parser_create_index.add_argument('-R', '--relative-to',
 								metavar='REL_PATH',
 								help='all paths in the index file are relative to %(metavar)s')
+	parser_create_index.add_argument('--shards',
+								type=int,
+								metavar='N',
+								help='write a sharded index: INDEX_FILE is a directory with %(metavar)s shard files, partitioned by the checksums, and a manifest')
+	parser_create_index.add_argument('--sorted',
+								default=False,
+								action='store_true',
+								help='finally sort the index by size and checksum (like compactIndex --sort hash), so duplicateFiles does not need to sort it')
+	parser_create_index.add_argument('--block-size',
+								type=_size,
+								metavar='BYTES',
+								help='read the files in blocks of %(metavar)s (K, M may be appended). By default the block size grows with the file size')
+	parser_create_index.add_argument('--bwlimit',
+								type=_size,
+								metavar='BYTES',
+								help='read at most %(metavar)s per second (K, M, G may be appended)')
+	parser_create_index.add_argument('--mmap-threshold',
+								default=MMAP_THRESHOLD,
+								type=_size,
+								metavar='BYTES',
+								help='hash files of at least %(metavar)s through a memory map instead of reading them (default: never). '
+									'only for trees, that don\'t change while indexing (e.g. read-only snapshots): '
+									'a file truncated while it is hashed kills the process')
+	parser_create_index.add_argument('--no-cache',
+								default=False,
+								action='store_true',
+								help="drop the hashed files from the page cache, so indexing doesn't push out the cache of other programs")
+	parser_create_index.add_argument('--per-device',
+								default=False,
+								action='store_true',
+								help='hash the files of each device by a thread of its own, ordered to reduce seeking. The index is not written in the order of the walk then, so --start-after/--start-with do not work to continue such a run')
+	parser_create_index.add_argument('--order',
+								default='inode',
+								choices=['inode', 'extent'],
+								help='with --per-device read the files of a device sorted by inode or by their physical position on the disk (extent, linux only) (default: %(default)s)')
+	parser_create_index.add_argument('--walkers',
+								default=1,
+								type=int,
+								metavar='N',
+								help='list the directories with %(metavar)s parallel threads (useful on network file systems). The tree is then walked sorted by name')
+
+	parser_create_index.add_argument('--min-size',
+								default=0,
+								type=_size,
+								metavar='SIZE',
+								help="don't index files smaller than %(metavar)s bytes (K, M, G may be appended). 1 skips the empty files")
+	parser_create_index.add_argument('--max-size',
+								type=_size,
+								metavar='SIZE',
+								help="don't index files larger than %(metavar)s bytes (K, M, G may be appended)")
+	parser_create_index.add_argument('--no-subdirs',
+								default=False,
+								action='store_true',
+								help='index only the files in the rootdirs themselves, not in their subdirs')
 
 	parser_create_index.set_defaults(func=prepare_create_index)
 
 
 
+	parser_plan_index = subparsers.add_parser('planIndex',
+								parents=[metrics_options],
+								aliases=['pi'],
+								description='scan the metadata of the trees, split them into balanced units by their size and run createIndex on them with several processes (or write a shell script doing so). The index parts of the processes are merged into the index at the end',
+								help='create the index with several processes')
+
+	parser_plan_index.add_argument('rootdir',
+								nargs='+',
+								help='Start indexing here. More than one dir may be given')
+	parser_plan_index.add_argument('index_file',
+								help='file containing the index. new values will be added. the index is compressed, if the name ends with .gz, .xz, .bz2 or .zst')
+	parser_plan_index.add_argument('-j', '--jobs',
+								default=os.cpu_count() or 1,
+								type=int,
+								metavar='N',
+								help='run %(metavar)s createIndex processes at a time (default: the number of cpus)')
+	parser_plan_index.add_argument('--units-per-process',
+								default=4,
+								type=int,
+								metavar='K',
+								help='split the trees into about %(metavar)s units per process, more units balance better (default: %(default)s)')
+	parser_plan_index.add_argument('--run',
+								default=False,
+								action='store_true',
+								help='run the processes and merge their index parts instead of writing a shell script')
+	parser_plan_index.add_argument('-o', '--script',
+								metavar='FILE',
+								help='write the shell script to %(metavar)s instead of the console')
+	parser_plan_index.add_argument('-v', '--verbose',
+								nargs='?', const='2', default='1',
+								type=int, choices=range(0,4),
+								help='level of verbosity')
+	parser_plan_index.add_argument('-e', '--exclude-path',
+								action='append',
+								nargs='+',
+								metavar='EXCL_PATH',
+								help='exclude %(metavar)ss from index')
+	parser_plan_index.add_argument('-E', '--exclude-pattern',
+								action='append',
+								nargs='+',
+								metavar='EXCL_PATTERN',
+								help='exclude %(metavar)ss from index')
+	parser_plan_index.add_argument('-l', '--log-file')
+	parser_plan_index.add_argument('-R', '--relative-to',
+								metavar='REL_PATH',
+								help='all paths in the index file are relative to %(metavar)s')
+	parser_plan_index.add_argument('--sorted',
+								default=False,
+								action='store_true',
+								help='sort the merged index by size and checksum (like compactIndex --sort hash) instead of by path')
+	parser_plan_index.add_argument('--walkers',
+								default=1,
+								type=int,
+								metavar='N',
+								help='list the directories of the scan with %(metavar)s parallel threads (useful on network file systems)')
+	parser_plan_index.add_argument('--min-size',
+								default=0,
+								type=_size,
+								metavar='SIZE',
+								help="don't index files smaller than %(metavar)s bytes (K, M, G may be appended)")
+	parser_plan_index.add_argument('--max-size',
+								type=_size,
+								metavar='SIZE',
+								help="don't index files larger than %(metavar)s bytes (K, M, G may be appended)")
+
+	parser_plan_index.set_defaults(func=prepare_plan_index)
+
+
+
 	parser_collect_folders = subparsers.add_parser('collectFolders',
+								parents=[metrics_options],
 								aliases=['cf'],
 								help='create a list of all folders. This should be done when creating the index, but can be done standalone as well with this command')
 
@@ -219,11 +587,231 @@ if __name__ == "__main__":
 								type=int,
 								metavar='START_SERIAL',
 								help='start with serial at %(metavar)s. Usefull with --start-with/--start-after')
+	parser_collect_folders.add_argument('--walkers',
+								default=1,
+								type=int,
+								metavar='N',
+								help='list the directories with %(metavar)s parallel threads (useful on network file systems). The tree is then walked sorted by name')
+	parser_collect_folders.add_argument('-t', '--dtype',
+								default=False,
+								action='store_true',
+								help="count the readable files by the type of the directory entries instead of checking each file, and list the directories by a thread pool (at least 2 threads, see --walkers). The tree is then walked sorted by name. Ignored with -f/--fast")
 	parser_collect_folders.set_defaults(func=prepare_collect_folders)
 
 
 
+	parser_compact_index = subparsers.add_parser('compactIndex',
+								parents=[metrics_options],
+								aliases=['ki'],
+								help='merge index files and remove stale and repeated entries')
+
+	parser_compact_index.add_argument('index_file',
+								nargs='+',
+								help='index file(s) to merge. More than one file may be given')
+	parser_compact_index.add_argument('outfile',
+								help='file to write the compacted index to. may be one of the input files')
+	parser_compact_index.add_argument('-v', '--verbose',
+								nargs='?', const='2', default='1',
+								type=int, choices=range(0,4),
+								help='level of verbosity')
+	parser_compact_index.add_argument('-k', '--keep',
+								default='mtime',
+								choices=['mtime', 'last'],
+								help='if a path is found more than once, keep the entry with the newest mtime or the last one read (default: %(default)s)')
+	parser_compact_index.add_argument('-d', '--drop-missing',
+								default=False,
+								action='store_true',
+								help="drop entries of files, that don't exist any more")
+	parser_compact_index.add_argument('-R', '--relative-to',
+								metavar='REL_PATH',
+								help='relative paths in the index files are relative to %(metavar)s')
+	parser_compact_index.add_argument('--sort',
+								default='path',
+								choices=['path', 'hash'],
+								help='sort the index by path or by size and checksum. duplicateFiles merges indexes sorted by hash without sorting them again (default: %(default)s)')
+
+	parser_compact_index.set_defaults(func=prepare_compact_index)
+
+
+
+	parser_watch_index = subparsers.add_parser('watchIndex',
+								parents=[metrics_options],
+								aliases=['wi'],
+								description='index the files, that changed since the index was written, then watch the trees and keep the index up to date until interrupted',
+								help='keep an index up to date')
+
+	parser_watch_index.add_argument('rootdir',
+								nargs='+',
+								help='watch these dirs. More than one dir may be given')
+	parser_watch_index.add_argument('index_file',
+								help='index written by createIndex. new entries are appended, it is compacted regularly')
+	parser_watch_index.add_argument('-v', '--verbose',
+								nargs='?', const='2', default='1',
+								type=int, choices=range(0,4),
+								help='level of verbosity')
+	parser_watch_index.add_argument('-e', '--exclude-path',
+								action='append',
+								nargs='+',
+								metavar='EXCL_PATH',
+								help='exclude %(metavar)ss from index')
+	parser_watch_index.add_argument('-E', '--exclude-pattern',
+								action='append',
+								nargs='+',
+								metavar='EXCL_PATTERN',
+								help='exclude %(metavar)ss from index')
+	parser_watch_index.add_argument('-l', '--log-file')
+	parser_watch_index.add_argument('-R', '--relative-to',
+								metavar='REL_PATH',
+								help='all paths in the index file are relative to %(metavar)s')
+	parser_watch_index.add_argument('--poll',
+								default=False,
+								action='store_true',
+								help="check the mtime of the directories instead of using inotify. doesn't notice files modified in place")
+	parser_watch_index.add_argument('--poll-interval',
+								default=60,
+								type=float,
+								metavar='SECONDS',
+								help='with --poll, or if inotify is not available, check the directories every %(metavar)s (default: %(default)s)')
+	parser_watch_index.add_argument('--batch',
+								default=1000,
+								type=int,
+								metavar='N',
+								help='append the new entries as soon as there are %(metavar)s of them (default: %(default)s)')
+	parser_watch_index.add_argument('--flush-interval',
+								default=10,
+								type=float,
+								metavar='SECONDS',
+								help='append the new entries at least every %(metavar)s (default: %(default)s)')
+	parser_watch_index.add_argument('--compact-interval',
+								default=3600,
+								type=float,
+								metavar='SECONDS',
+								help='drop outdated and deleted entries from the index every %(metavar)s (default: %(default)s)')
+	parser_watch_index.add_argument('--bwlimit',
+								type=_size,
+								metavar='BYTES',
+								help='read at most %(metavar)s per second (K, M, G may be appended)')
+	parser_watch_index.add_argument('--no-cache',
+								default=False,
+								action='store_true',
+								help="drop the hashed files from the page cache")
+
+	parser_watch_index.set_defaults(func=prepare_watch_index)
+
+
+
+	parser_serve_index = subparsers.add_parser('serve',
+								parents=[metrics_options],
+								aliases=['sv'],
+								description='load the index files once and answer queries (see the query subcommand) on a unix socket until interrupted',
+								help='keep the index in memory and answer queries')
+
+	parser_serve_index.add_argument('index_file',
+								nargs='+',
+								help='index file(s) to load. More than one file may be given')
+	parser_serve_index.add_argument('socket',
+								help='unix socket to listen on')
+	parser_serve_index.add_argument('-v', '--verbose',
+								nargs='?', const='2', default='1',
+								type=int, choices=range(0,4),
+								help='level of verbosity')
+	parser_serve_index.add_argument('-j', '--jobs',
+								default=1,
+								type=int,
+								metavar='JOBS',
+								help='read the index files with %(metavar)s parallel processes')
+	parser_serve_index.add_argument('--cache-size',
+								default=1024,
+								type=int,
+								metavar='N',
+								help='cache the answers of the last %(metavar)s different queries (default: %(default)s)')
+
+	parser_serve_index.set_defaults(func=prepare_serve_index)
+
+
+
+	parser_query_index = subparsers.add_parser('query',
+								parents=[metrics_options],
+								aliases=['q'],
+								description='ask a server started by the serve subcommand. The results are printed as JSON, one object per line',
+								help='query a running server')
+
+	parser_query_index.add_argument('socket',
+								help='unix socket of the server')
+	parser_query_index.add_argument('query',
+								choices=['duplicates', 'groups', 'overlap', 'stats', 'reload'],
+								help='duplicates: the duplicates of the file PATH, groups: the groups of duplicates sorted by reclaimable space, overlap: the folders with copies of the files in the folder PATH, stats: size of the tables and hits of the cache, reload: read the index files again')
+	parser_query_index.add_argument('path',
+								nargs='?',
+								metavar='PATH',
+								help='file or folder as written in the index')
+	parser_query_index.add_argument('--min-size',
+								default=0,
+								type=_size,
+								metavar='SIZE',
+								help='groups: ignore files smaller than %(metavar)s bytes (K, M, G may be appended)')
+	parser_query_index.add_argument('--top',
+								type=int,
+								metavar='K',
+								help='groups, overlap: only the first %(metavar)s results')
+
+	parser_query_index.set_defaults(func=prepare_query_index)
+
+
+
+	parser_lookup = subparsers.add_parser('lookup',
+								parents=[metrics_options],
+								aliases=['lu'],
+								description='check, which of the given files (or the files in the given dirs) are in the index already and where',
+								help='look up files in an index')
+
+	parser_lookup.add_argument('candidate',
+								nargs='*',
+								help='files or dirs to look up. Without any, only the lookup file is built')
+	parser_lookup.add_argument('-i', '--index',
+								action='append',
+								nargs='+',
+								metavar='INDEX_FILE',
+								help='index file(s) of the archive. The lookup file is built from them, if it is missing or older')
+	parser_lookup.add_argument('-f', '--filter',
+								metavar='LOOKUP_FILE',
+								help='store the sizes, a bloom filter and the checksums of the index in %(metavar)s and load them from there next time')
+	parser_lookup.add_argument('-o', '--outfile',
+								help='write the results to this file instead of the console')
+	parser_lookup.add_argument('-v', '--verbose',
+								nargs='?', const='2', default='1',
+								type=int, choices=range(0,4),
+								help='level of verbosity')
+	parser_lookup.add_argument('-e', '--exclude-path',
+								action='append',
+								nargs='+',
+								metavar='EXCL_PATH',
+								help='don\'t look up files in %(metavar)ss')
+	parser_lookup.add_argument('-E', '--exclude-pattern',
+								action='append',
+								nargs='+',
+								metavar='EXCL_PATTERN',
+								help='don\'t look up files matching %(metavar)ss')
+	parser_lookup.add_argument('-l', '--log-file')
+	parser_lookup.add_argument('--no-locations',
+								default=False,
+								action='store_true',
+								help="don't read the index files to report where the existing files are stored")
+	parser_lookup.add_argument('--bwlimit',
+								type=_size,
+								metavar='BYTES',
+								help='read at most %(metavar)s per second (K, M, G may be appended)')
+	parser_lookup.add_argument('--no-cache',
+								default=False,
+								action='store_true',
+								help="drop the hashed files from the page cache")
+
+	parser_lookup.set_defaults(func=prepare_lookup)
+
+
+
 	parser_duplicate_files = subparsers.add_parser('duplicateFiles',
+								parents=[metrics_options],
 								aliases=['df'],
 								help='find duplicate files in the index')
 
@@ -236,46 +824,238 @@ if __name__ == "__main__":
 								nargs='?', const='2', default='1',
 								type=int, choices=range(0,4),
 								help='level of verbosity')
+	parser_duplicate_files.add_argument('-j', '--jobs',
+								default=1,
+								type=int,
+								metavar='JOBS',
+								help='read the index files with %(metavar)s parallel processes')
+	parser_duplicate_files.add_argument('--per-shard',
+								default=False,
+								action='store_true',
+								help='process sharded indexes one shard at a time to save memory')
+	parser_duplicate_files.add_argument('--shard',
+								type=int,
+								nargs='+',
+								metavar='SHARD',
+								help='process only the given shard numbers of sharded indexes. The outputs of several runs can be concatenated')
+	parser_duplicate_files.add_argument('--verify',
+								default=False,
+								action='store_true',
+								help='compare the content of the duplicates byte by byte instead of trusting size and checksum')
+	parser_duplicate_files.add_argument('--verify-workers',
+								default=4,
+								type=int,
+								metavar='N',
+								help='verify %(metavar)s groups of duplicates in parallel (default: %(default)s)')
+	parser_duplicate_files.add_argument('--bwlimit',
+								type=_size,
+								metavar='BYTES',
+								help='read at most %(metavar)s per second (K, M, G may be appended) while verifying')
+	parser_duplicate_files.add_argument('-R', '--relative-to',
+								metavar='REL_PATH',
+								help='relative paths in the index files are relative to %(metavar)s')
+	parser_duplicate_files.add_argument('--min-size',
+								default=0,
+								type=_size,
+								metavar='SIZE',
+								help='ignore files smaller than %(metavar)s bytes (K, M, G may be appended)')
+	parser_duplicate_files.add_argument('--top',
+								type=int,
+								metavar='K',
+								help='report only the %(metavar)s groups with the most reclaimable space, sorted by it. 0 reports all groups sorted by it')
 
+	parser_duplicate_files.add_argument('-F', '--format',
+								default='text',
+								choices=sorted(REPORT_FORMATS),
+								help='format of the output (default: %(default)s)')
 	parser_duplicate_files.set_defaults(func=prepare_duplicate_files)
 
 
 
+	parser_scan_duplicates = subparsers.add_parser('scanDuplicates',
+								parents=[metrics_options],
+								aliases=['sd'],
+								description='find duplicate files in the given trees without writing an index. The files are hashed size by size, files of a unique size are not read, and the duplicates of each size are written as soon as they are found',
+								help='find duplicate files in trees without an index')
+
+	parser_scan_duplicates.add_argument('rootdir',
+								nargs='+',
+								help='look for duplicates here. More than one dir may be given')
+	parser_scan_duplicates.add_argument('duplicatelist',
+								help='file to write the duplikates to')
+	parser_scan_duplicates.add_argument('-v', '--verbose',
+								nargs='?', const='2', default='1',
+								type=int, choices=range(0,4),
+								help='level of verbosity')
+	parser_scan_duplicates.add_argument('-e', '--exclude-path',
+								action='append',
+								nargs='+',
+								metavar='EXCL_PATH',
+								help='exclude %(metavar)ss from the scan')
+	parser_scan_duplicates.add_argument('-E', '--exclude-pattern',
+								action='append',
+								nargs='+',
+								metavar='EXCL_PATTERN',
+								help='exclude %(metavar)ss from the scan')
+	parser_scan_duplicates.add_argument('-l', '--log-file')
+	parser_scan_duplicates.add_argument('-R', '--relative-to',
+								metavar='REL_PATH',
+								help='write the paths relative to %(metavar)s')
+	parser_scan_duplicates.add_argument('--walkers',
+								default=1,
+								type=int,
+								metavar='N',
+								help='list the directories with %(metavar)s parallel threads (useful on network file systems)')
+	parser_scan_duplicates.add_argument('--per-device',
+								default=False,
+								action='store_true',
+								help='hash the files of each size and device by a thread of its own')
+	parser_scan_duplicates.add_argument('--order',
+								default='inode',
+								choices=['inode', 'extent'],
+								help='with --per-device read the files of a device sorted by inode or by their physical position on the disk (extent, linux only) (default: %(default)s)')
+	parser_scan_duplicates.add_argument('--bwlimit',
+								type=_size,
+								metavar='BYTES',
+								help='read at most %(metavar)s per second (K, M, G may be appended)')
+	parser_scan_duplicates.add_argument('--no-cache',
+								default=False,
+								action='store_true',
+								help="drop the hashed files from the page cache")
+	parser_scan_duplicates.add_argument('--min-size',
+								default=0,
+								type=_size,
+								metavar='SIZE',
+								help="ignore files smaller than %(metavar)s bytes (K, M, G may be appended)")
+	parser_scan_duplicates.add_argument('--max-size',
+								type=_size,
+								metavar='SIZE',
+								help="ignore files larger than %(metavar)s bytes (K, M, G may be appended)")
+	parser_scan_duplicates.add_argument('--verify',
+								default=False,
+								action='store_true',
+								help='compare the content of the duplicates byte by byte instead of trusting size and checksum')
+	parser_scan_duplicates.add_argument('--verify-workers',
+								default=4,
+								type=int,
+								metavar='N',
+								help='verify %(metavar)s groups of duplicates in parallel (default: %(default)s)')
+	parser_scan_duplicates.add_argument('--top',
+								type=int,
+								metavar='K',
+								help='report only the %(metavar)s groups with the most reclaimable space, sorted by it, at the end. 0 reports all groups sorted by it')
+	parser_scan_duplicates.add_argument('-F', '--format',
+								default='text',
+								choices=sorted(REPORT_FORMATS),
+								help='format of the output (default: %(default)s)')
+
+	parser_scan_duplicates.set_defaults(func=prepare_scan_duplicates)
+
+
+
+	parser_summarize_folders = subparsers.add_parser('summarizeFolders',
+								parents=[metrics_options],
+								aliases=['sm'],
+								description='write the number and size of the files of each folder and the checksum ids of their files with copies to a compact summary. similarFolders and similarTrees read it instead of the index files much faster',
+								help='create a folder summary of the index')
+
+	parser_summarize_folders.add_argument('index_file',
+								nargs='+',
+								help='index file(s) to summarize. More than one file may be given')
+	parser_summarize_folders.add_argument('summary_file',
+								help='file to write the summary to')
+	parser_summarize_folders.add_argument('-c', '--collection-file',
+								action='append',
+								nargs='+',
+								help='add the folders of these collection files (see collectFolders), that have no files in the index')
+	parser_summarize_folders.add_argument('-v', '--verbose',
+								nargs='?', const='2', default='1',
+								type=int, choices=range(0,4),
+								help='level of verbosity')
+	parser_summarize_folders.add_argument('-j', '--jobs',
+								default=1,
+								type=int,
+								metavar='JOBS',
+								help='read the index files with %(metavar)s parallel processes')
+
+	parser_summarize_folders.set_defaults(func=prepare_summarize_folders)
+
+
+
 	parser_similar_folders = subparsers.add_parser('similarFolders',
+								parents=[metrics_options],
 								aliases=['sf'],
 								help='find similar folders (folders that contain many duplicate files)')
 
 	parser_similar_folders.add_argument('index_files',
 								nargs='+',
-								help='file(s) to look for duplikates in. More than one file may be given')
+								help='file(s) to look for duplikates in. More than one file may be given. A single folder summary (see summarizeFolders) may be given instead')
 	parser_similar_folders.add_argument('similarfolderslist',
 								help='file to write the findings to')
 	parser_similar_folders.add_argument('-v', '--verbose',
 								nargs='?', const='2', default='1',
 								type=int, choices=range(0,4),
 								help='level of verbosity')
+	parser_similar_folders.add_argument('-j', '--jobs',
+								default=1,
+								type=int,
+								metavar='JOBS',
+								help='read the index files with %(metavar)s parallel processes')
 
+	parser_similar_folders.add_argument('-F', '--format',
+								default='text',
+								choices=sorted(REPORT_FORMATS),
+								help='format of the output (default: %(default)s)')
+	parser_similar_folders.add_argument('--min-size',
+								default=0,
+								type=_size,
+								metavar='SIZE',
+								help='ignore files smaller than %(metavar)s bytes (K, M, G may be appended). 1 ignores the empty files, that would pair all folders containing one')
 	parser_similar_folders.set_defaults(func=prepare_similar_folders)
 
 
 
 	parser_similar_folders = subparsers.add_parser('similarTrees',
+								parents=[metrics_options],
 								aliases=['st'],
 								help='find similar trees (folders with subfolders with high similarity)')
 
 	parser_similar_folders.add_argument('index_files',
 								nargs='+',
-								help='file(s) to look for duplikates in. More than one file may be given')
+								help='file(s) to look for duplikates in. More than one file may be given. A single folder summary (see summarizeFolders) may be given instead')
 	parser_similar_folders.add_argument('similartrees',
 								help='file to write the findings to')
 	parser_similar_folders.add_argument('-v', '--verbose',
 								nargs='?', const='2', default='1',
 								type=int, choices=range(0,4),
 								help='level of verbosity')
+	parser_similar_folders.add_argument('-j', '--jobs',
+								default=1,
+								type=int,
+								metavar='JOBS',
+								help='read the index files with %(metavar)s parallel processes')
+	parser_similar_folders.add_argument('-F', '--format',
+								default='text',
+								choices=sorted(REPORT_FORMATS),
+								help='format of the output (default: %(default)s)')
+	parser_similar_folders.add_argument('--min-size',
+								default=0,
+								type=_size,
+								metavar='SIZE',
+								help='files smaller than %(metavar)s bytes (K, M, G may be appended) are counted, but don\'t make folders similar')
 
 	parser_similar_folders.set_defaults(func=prepare_similar_trees)
 
 
 
 	args=parser.parse_args()
-	args.func(args)
+	metrics.configure(profile_file = args.profile, trace_memory = args.trace_memory)
+	try:
+		with metrics.stage("total", 0):
+			args.func(args)
+	except ValueError as e:		# arguments, that don't fit the indexes
+		parser.error(str(e))
+	finally:
+		metrics.close()
+		if args.metrics_file:
+			metrics.write(args.metrics_file)
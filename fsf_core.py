@@ -19,15 +19,47 @@ import os
 import hashlib
 import pathlib
 import sys
+import locale
+import multiprocessing
+import io
+import gzip
+import lzma
+import bz2
+import queue
+import threading
+import json
+import heapq
+import collections
+import itertools
+import concurrent.futures
+import mmap
+import stat
+import struct
+
+try:
+	import fcntl		# only needed for the physical order of files on linux
+except ImportError:
+	fcntl = None
+
+try:
+	import resource		# only needed to limit the files opened by the verification, not on windows
+except ImportError:
+	resource = None
+
+try:
+	import zstandard	# optional, only needed for zstd compressed index files
+except ImportError:
+	zstandard = None
 
 
 
 from collections import namedtuple	# allow my lists to be more clearly structured
 
 from fsf_objects import FTreeStat
+from fsf_report import report_writer
+from fsf_metrics import metrics
 
-from time import process_time	# todo: remove later, only needed for optimisation
-import resource					# for memory monitoring. might be removed later
+from time import monotonic, sleep
 
 
 # define a data type for elements of the list of files # todo: might go to fsf_objects
@@ -35,24 +67,202 @@ import resource					# for memory monitoring. might be removed later
 from fsf_objects import hpn
 
 
-def _gethash(filename, blocksize=65536):
+class _RateLimiter(object):
+	""" limit the bandwidth of all threads sharing this object to 'rate' bytes per second.
+	call consume() after reading a block, it sleeps as long as the block 'costs'"""
+
+	def __init__(self, rate):
+		self.rate = rate
+		self._lock = threading.Lock()
+		self._next = monotonic()		# time, when the bandwidth used so far is paid
+
+	def consume(self, nbytes):
+		with self._lock:
+			now = monotonic()
+			self._next = max(self._next, now) + nbytes / self.rate
+			wait = self._next - now
+		if wait > 0:
+			sleep(wait)
+
+
+_BLOCKSIZES = [		# (files up to this size, block size) for the adaptive block size
+	(1024*1024, 64*1024),
+	(64*1024*1024, 256*1024),
+	(None, 1024*1024),
+]
+_DONTNEED_WINDOW = 16*1024*1024		# drop the pages of a file from the cache every this many bytes
+MMAP_THRESHOLD = None		# hash files from this size on through a memory map (never by default, see _hash_mapped)
+
+_FADV_SEQUENTIAL = getattr(os, "POSIX_FADV_SEQUENTIAL", None)	# None, if there is no posix_fadvise
+_FADV_DONTNEED = getattr(os, "POSIX_FADV_DONTNEED", None)
+
+_hash_buffers = threading.local()	# one reusable read buffer per thread and block size
+
+def _blocksize_for(size):
+	""" return the block size to hash a file of 'size' bytes with """
+
+	for limit, blocksize in _BLOCKSIZES:
+		if limit is None or size <= limit:
+			return blocksize
+
+def _hash_buffer(blocksize):
+	""" return the read buffer of 'blocksize' bytes of this thread """
+
+	buffers = _hash_buffers.__dict__.setdefault("buffers", {})
+	if blocksize not in buffers:
+		buffers[blocksize] = bytearray(blocksize)
+	return buffers[blocksize]
+
+def _fadvise(f, offset, length, advice):
+	""" give the kernel a hint about the use of the file, if it can take one.
+	this is only a hint, so errors (and file objects without descriptor) are ignored"""
+
+	if advice is not None:
+		try:
+			os.posix_fadvise(f.fileno(), offset, length, advice)
+		except (OSError, ValueError):
+			pass
+
+def _hash_mapped(f, size, blocksize, hasher, limiter=None):
+	""" feed the first 'size' bytes of the regular file 'f' to the hasher through a memory map,
+	without copying them. touching a mapped page behind the end of the file kills the
+	process (SIGBUS). the file is checked not to have shrunk before each block, but it can
+	still be truncated between the check and the read, so only map files, that can't change
+	(e.g. read-only snapshots). return the number of bytes hashed. if the file shrank or can't be mapped, this is less
+	than 'size' and the caller continues reading at this offset"""
+
+	try:
+		m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+	except (OSError, ValueError):		# e.g. file systems, that don't support mmap
+		return 0
+
+	done = 0
+	try:
+		if hasattr(m, "madvise"):
+			m.madvise(mmap.MADV_SEQUENTIAL)
+		with memoryview(m) as view:
+			while done < size:
+				end = min(done + blocksize, size)
+				if os.fstat(f.fileno()).st_size < end:
+					break
+				hasher.update(view[done:end])
+				if limiter:
+					limiter.consume(end - done)
+				done = end
+	finally:
+		m.close()
+	return done
+
+def _gethash(filename, blocksize=None, limiter=None, nocache=False, mmap_threshold=MMAP_THRESHOLD):
+	""" return the sha1 checksum of the file as hex string.
+	the file is read with 'blocksize' bytes at once (adaptive to the file size, if None)
+	into a reused buffer. regular files of at least 'mmap_threshold' bytes are hashed
+	through a memory map instead (never, if None). 'limiter' (a _RateLimiter) caps the
+	bandwidth. with 'nocache' the pages of the file are dropped from the page cache after
+	reading, so hashing doesn't evict the cache of other programs"""
+
 	hasher=hashlib.sha1()
-	with open(filename, "rb") as f:
-		for block in iter(lambda: f.read(blocksize), b''):
-			hasher.update(block)
+	with open(filename, "rb", buffering=0) as f:
+		try:
+			fstats = os.fstat(f.fileno())
+		except (OSError, ValueError):		# no real file
+			fstats = None
+		if blocksize is None:
+			blocksize = _blocksize_for(fstats.st_size) if fstats else _BLOCKSIZES[0][1]
+		_fadvise(f, 0, 0, _FADV_SEQUENTIAL)
+
+		done = dropped = 0
+		if (fstats and mmap_threshold is not None and stat.S_ISREG(fstats.st_mode)
+				and fstats.st_size >= max(mmap_threshold, 1)):
+			done = dropped = _hash_mapped(f, fstats.st_size, blocksize, hasher, limiter)
+			f.seek(done)		# read what is left, if the file changed
+
+		view = memoryview(_hash_buffer(blocksize))
+		while True:
+			n = f.readinto(view)
+			if not n:
+				break
+			hasher.update(view[:n])
+			done += n
+			if limiter:
+				limiter.consume(n)
+			if nocache and done - dropped >= _DONTNEED_WINDOW:
+				_fadvise(f, dropped, done - dropped, _FADV_DONTNEED)
+				dropped = done
+		view.release()
+
+		if nocache:
+			_fadvise(f, 0, 0, _FADV_DONTNEED)
 	return hasher.hexdigest()
 
-# todo: what about empty folders? what about symbolic links?
-def create_index(rootdir, outfile, errorfile, start_at="", start_after=True, exclude=[], exclude_pattern=[], rel_to=None, size_digits=13, verbosity=2):
-	""" walk down the tree from rootdir (exclude 'exclude'. start at 'start_at' to continue
-	a previous run (if Start_after==True, start with the next file, otherwise start with the given file))
-	for each file calculate its checksum. append file statistics to 'outfile'
-	as follows, separated by "\t":
-	filesize (use 'sizedigits' digits)	mtime	checksum	path (relative to 'relto')
-	if verbosity =  0: print nothing
-					1: print each folder
-					2: print each file
-					3: print each line """
+def _list_dir(path):
+	""" list the directory 'path' like os.walk does. return the sorted names of the
+	subdirectories and of the other entries, the set of subdirectories, that are
+	symbolic links (they are listed, but not walked into) and the names of the regular
+	files among the other entries. the types come from the directory entries (d_type),
+	the entries are only stat'ed on file systems, that don't report them"""
+
+	dirs, files, links, regular = [], [], set(), []
+	with os.scandir(path) as it:
+		for entry in it:
+			try:
+				is_dir = entry.is_dir()
+			except OSError:
+				is_dir = False
+			if is_dir:
+				dirs.append(entry.name)
+				if entry.is_symlink():
+					links.add(entry.name)
+			else:
+				files.append(entry.name)
+				try:
+					if entry.is_file(follow_symlinks=False):		# like not islink() and isfile()
+						regular.append(entry.name)
+				except OSError:
+					pass
+	dirs.sort()
+	files.sort()
+	return dirs, files, links, regular
+
+def _walk_parallel(rootdir, workers, lookahead=None, types=False):
+	""" walk the tree like os.walk (top down), but list up to 'lookahead' directories
+	(default 4 * workers) in advance by 'workers' threads, so the latency of network file
+	systems is paid in parallel. the order is deterministic: depth first, sorted by name.
+	like with os.walk, the caller may remove names from 'dirs' to skip them, they are
+	not listed then. directories, that can't be listed, are skipped.
+	with 'types' yield (root, dirs, files, names of the regular files) (see _list_dir)"""
+
+	lookahead = lookahead or 4 * workers
+	pool = concurrent.futures.ThreadPoolExecutor(workers)
+	pending = {}		# path: future of _list_dir
+	stack = [rootdir]	# the next directory to yield is the last one
+	try:
+		while stack:
+			for path in stack[-lookahead:]:
+				if path not in pending:
+					pending[path] = pool.submit(_list_dir, path)
+			path = stack.pop()
+			try:
+				dirs, files, links, regular = pending.pop(path).result()
+			except OSError:
+				continue
+
+			yield (path, dirs, files, regular) if types else (path, dirs, files)
+
+			stack.extend(os.path.join(path, name) for name in reversed(dirs) if name not in links)
+	finally:
+		pool.shutdown(wait=True, cancel_futures=True)
+
+def _walk(rootdir, walkers=1):
+	""" return os.walk(rootdir) or for walkers > 1 the parallel walker (see _walk_parallel) """
+
+	if walkers > 1:
+		return _walk_parallel(rootdir, walkers)
+	return os.walk(rootdir)
+
+def _index_candidates(rootdirs, start_at="", start_after=True, exclude=[], exclude_pattern=[], verbosity=2, walkers=1, min_size=0, max_size=None, subdirs=True):
+	""" walk down the trees from the rootdirs and yield (fullname, stat result) of each
+	file to index. see create_index for the parameters"""
 
 	#todo: make 'start_at' find its start faster
 
@@ -61,9 +271,17 @@ def create_index(rootdir, outfile, errorfile, start_at="", start_after=True, exc
 	start_at_dir  = start_at and os.path.isdir(start_at)
 	show_message  = True
 
+	excluded = {}		# (device, inode): path of the dirs to exclude, so each dir is stat'ed only once
+	for path in exclude or []:
+		try:
+			fstats = os.stat(path)
+		except OSError:
+			continue
+		excluded[(fstats.st_dev, fstats.st_ino)] = path
+
 
 	# walk through the whole tree
-	for root, dirs, files in os.walk(rootdir):
+	for root, dirs, files in itertools.chain.from_iterable(_walk(rootdir, walkers) for rootdir in rootdirs):
 		if verbosity == 1:
 			print(root)
 		if verbosity > 1:
@@ -87,15 +305,19 @@ def create_index(rootdir, outfile, errorfile, start_at="", start_after=True, exc
 
 
 		# skip dirs, that match with exclude (and subdirs)
-		if exclude:
-			for path in exclude:
-				if os.path.samefile(root, path):
-					if verbosity >= 1:
-						print("\033[94mexlude dir: " + path + "\033[0m")
-					dirs.clear()
-					files.clear()
-					continue
+		if excluded:
+			try:
+				fstats = os.stat(root)
+			except OSError:
+				fstats = None
+			if fstats and (fstats.st_dev, fstats.st_ino) in excluded:
+				if verbosity >= 1:
+					print("\033[94mexlude dir: " + excluded[(fstats.st_dev, fstats.st_ino)] + "\033[0m")
+				dirs.clear()
+				files.clear()
 
+		if not subdirs:		# only the files of the rootdirs themselves
+			dirs.clear()
 
 
 		for name in files:
@@ -137,55 +359,239 @@ def create_index(rootdir, outfile, errorfile, start_at="", start_after=True, exc
 
 
 			fstats = os.stat(fullname)
-
+			if fstats.st_size < min_size or (max_size is not None and fstats.st_size > max_size):
+				continue		# skipped by its size, without opening it
+
+			yield fullname, fstats
+
+EMPTY_CHECKSUM = hashlib.sha1(b"").hexdigest()		# checksum of all empty files
+
+def _hash_candidate(fullname, fstats, inodes, errorfile, **hashargs):
+	""" return the checksum of the file (see _gethash for 'hashargs'), or None if it can't
+	be read. files with several hard links are looked up in and added to 'inodes'.
+	empty files get EMPTY_CHECKSUM without opening them"""
+
+	if fstats.st_size == 0:
+		metrics.count("empty_files")
+		return EMPTY_CHECKSUM
+
+	inode = (fstats.st_dev, fstats.st_ino) if fstats.st_nlink > 1 else None
+
+	try:
+		if inode in inodes:		# another hard link of this file was hashed already
+			return inodes[inode]
+		fhash = _gethash(fullname, **hashargs)
+		metrics.count("files_hashed")
+		metrics.count("bytes_hashed", fstats.st_size)
+		if inode:
+			inodes[inode] = fhash
+		return fhash
+
+	except PermissionError as e:
+		print ("\033[91mPermission Error: " + fullname + "\033[0m")
+		if errorfile:
+			with open(errorfile, "a") as errf:
+				errf.write("Permission Error: "+ fullname + "\n")
+
+	except FileNotFoundError as e:
+		print ("\033[91mFile not found Error: " + fullname + "\033[0m")
+		if errorfile:
+			with open(errorfile, "a") as errf:
+				errf.write("file not found Error: "+ fullname + "\n")
+
+	except Exception as e:
+		print ("\033[91munhandled Exception: " + fullname + "\033[0m")
+		errstr = str(e)
+		if errorfile:
+			with open(errorfile, "a") as errf:
+				errf.write(fullname + "  " + errstr + "\n")
+
+	return None
+
+def _format_index_line(fullname, fstats, fhash, size_digits=13, rel_to=None):
+	""" return the line of the index for the file (without newline) """
+
+	return "{size: {digits}d}\t{mtime: 10.4f}\t{checksum}\t{path}".format(
+		digits = size_digits,
+		size = fstats.st_size,
+		mtime = fstats.st_mtime,
+		checksum = fhash + (":{}:{}".format(fstats.st_dev, fstats.st_ino) if fstats.st_nlink > 1 else ""),
+		path = ( os.path.relpath(fullname, rel_to) if rel_to!=None else fullname))
+
+_FS_IOC_FIEMAP = 0xC020660B		# linux/fs.h, _IOWR('f', 11, struct fiemap)
+_FIEMAP_HEADER = struct.Struct("=QQLLLL")		# start, length, flags, mapped extents, extent count, reserved
+_FIEMAP_EXTENT = struct.Struct("=QQQQQLLLL")	# logical, physical, length, 2 reserved, flags, 3 reserved
+
+def _physical_offset(fullname):
+	""" return the physical position of the first extent of the file on its disk
+	(by the FIEMAP ioctl of linux) or None, if that is not available"""
+
+	if fcntl is None:
+		return None
+	try:
+		fd = os.open(fullname, os.O_RDONLY)
+	except OSError:
+		return None
+	try:
+		request = bytearray(_FIEMAP_HEADER.pack(0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0) + bytes(_FIEMAP_EXTENT.size))
+		fcntl.ioctl(fd, _FS_IOC_FIEMAP, request)
+	except OSError:		# e.g. file systems without FIEMAP
+		return None
+	finally:
+		os.close(fd)
+	if _FIEMAP_HEADER.unpack_from(request)[3] == 0:		# no extents, e.g. an empty file
+		return None
+	return _FIEMAP_EXTENT.unpack_from(request, _FIEMAP_HEADER.size)[1]
+
+def _lane_key(order):
+	""" return the key to sort the candidates of one device by """
+
+	if order == "extent":
+		def key(candidate):
+			offset = _physical_offset(candidate[0])
+			return (0, offset) if offset is not None else (1, candidate[1].st_ino)
+		return key
+	return lambda candidate: candidate[1].st_ino
+
+def _hash_per_device(candidates, hashfunc, order="inode", batchsize=100000):
+	""" hash the candidates (fullname, stat result) with 'hashfunc' by one thread per device.
+	each device reads its files sorted by inode (or with order="extent" by their physical
+	position), so disks read with less seeking and all disks work at the same time.
+	the candidates are processed in batches of 'batchsize'. yield (candidate, checksum)
+	as soon as the checksums are ready, the order within a batch is not defined"""
+
+	candidates = iter(candidates)
+	while True:
+		batch = list(itertools.islice(candidates, batchsize))
+		if not batch:
+			return
+
+		lanes = {}
+		for candidate in batch:
+			lanes.setdefault(candidate[1].st_dev, []).append(candidate)
+
+		results = queue.Queue()
+		def run_lane(lane):
 			try:
-				fhash = _gethash(fullname)
+				lane.sort(key=_lane_key(order))
+				for candidate in lane:
+					results.put((candidate, hashfunc(*candidate)))
+			finally:
+				results.put(None)		# this lane is done
+
+		with concurrent.futures.ThreadPoolExecutor(len(lanes)) as pool:
+			futures = [pool.submit(run_lane, lane) for lane in lanes.values()]
+			running = len(lanes)
+			while running:
+				result = results.get()
+				if result is None:
+					running -= 1
+				else:
+					yield result
+			for future in futures:
+				future.result()		# raise the exceptions of the lanes
 
-			except PermissionError as e:
-				print ("\033[91mPermission Error: " + fullname + "\033[0m")
-				if errorfile:
-					with open(errorfile, "a") as errf:
-						errf.write("Permission Error: "+ fullname + "\n")
-				continue
+IndexRecord = namedtuple('IndexRecord', ['fullname', 'fstats', 'checksum'])	# a file indexed by iter_index
 
-			except FileNotFoundError as e:
-				print ("\033[91mFile not found Error: " + fullname + "\033[0m")
-				if errorfile:
-					with open(errorfile, "a") as errf:
-						errf.write("file not found Error: "+ fullname + "\n")
-				continue
+def _size_buckets(candidates, verbosity=1):
+	""" collect the candidates (fullname, stat result) by their size and yield the list of
+	candidates of each size, largest first. sizes of a single file (or of hard links to one
+	inode only) are left out, such files have no duplicates"""
 
-			except Exception as e:
-				print ("\033[91munhandled Exception: " + fullname + "\033[0m")
-				errstr = str(e)
-				if errorfile:
-					with open(errorfile, "a") as errf:
-						errf.write(fullname + "  " + errstr + "\n")
-				continue
+	buckets = {}
+	for candidate in candidates:
+		buckets.setdefault(candidate[1].st_size, []).append(candidate)
+	if verbosity >= 1:
+		print("hashing " + str(sum(len(bucket) for bucket in buckets.values())) + " files of " + str(len(buckets)) + " sizes...")
 
+	for size in sorted(buckets, reverse=True):
+		bucket = buckets.pop(size)
+		if len({(fstats.st_dev, fstats.st_ino) for fullname, fstats in bucket}) > 1:
+			yield bucket
+		else:
+			metrics.count("files_of_unique_size", len(bucket))
+
+def iter_index(rootdir, errorfile=None, start_at="", start_after=True, exclude=[], exclude_pattern=[], verbosity=2, inodes=None, block_size=None, bwlimit=None, nocache=False, mmap_threshold=MMAP_THRESHOLD, walkers=1, per_device=False, order="inode", min_size=0, max_size=None, size_buckets=False, subdirs=True):
+	""" walk down the tree from rootdir like create_index (see there for the parameters)
+	and yield an IndexRecord (fullname, stat result, checksum) for each file hashed.
+	with 'size_buckets' the whole tree is walked first, then the files are hashed size
+	by size, largest first, so the records of one size follow each other. files with a
+	size no other file has are not read and not yielded then, they can't have duplicates"""
+
+	if inodes is None:
+		inodes = {}
+	limiter = _RateLimiter(bwlimit) if bwlimit else None
+
+	candidates = _index_candidates([rootdir] if isinstance(rootdir, str) else rootdir,
+									start_at, start_after, exclude, exclude_pattern, verbosity, walkers, min_size, max_size, subdirs)
+	def hashfunc(fullname, fstats):
+		return _hash_candidate(fullname, fstats, inodes, errorfile, blocksize=block_size,
+								limiter=limiter, nocache=nocache, mmap_threshold=mmap_threshold)
+	def hashed(candidates):
+		if per_device:
+			return _hash_per_device(candidates, hashfunc, order)
+		return ((candidate, hashfunc(*candidate)) for candidate in candidates)
+
+	if size_buckets:
+		results = itertools.chain.from_iterable(hashed(bucket) for bucket in _size_buckets(candidates, verbosity))
+	else:
+		results = hashed(candidates)
 
-			line = "{size: {digits}d}\t{mtime: 10.4f}\t{checksum}\t{path}".format(
-				digits = size_digits,
-				size = fstats.st_size,
-				mtime = fstats.st_mtime,
-				checksum = fhash,
-				path = ( os.path.relpath(fullname, rel_to) if rel_to!=None else fullname))
+	for (fullname, fstats), fhash in results:
+		if fhash is None:
+			continue
+		if verbosity == 2:
+			print(os.path.basename(fullname))
+		yield IndexRecord(fullname, fstats, fhash)
 
-			outfile.write(line+'\n')
+# todo: what about empty folders? what about symbolic links?
+def create_index(rootdir, outfile, errorfile, start_at="", start_after=True, exclude=[], exclude_pattern=[], rel_to=None, size_digits=13, verbosity=2, inodes=None, block_size=None, bwlimit=None, nocache=False, mmap_threshold=MMAP_THRESHOLD, walkers=1, per_device=False, order="inode", min_size=0, max_size=None, subdirs=True):
+	""" walk down the tree from rootdir (exclude 'exclude'. start at 'start_at' to continue
+	a previous run (if Start_after==True, start with the next file, otherwise start with the given file))
+	for each file calculate its checksum. append file statistics to 'outfile'
+	as follows, separated by "\t":
+	filesize (use 'sizedigits' digits)	mtime	checksum	path (relative to 'relto')
+	'rootdir' may be a list of dirs as well.
+	for files with more than one hard link, the checksum is followed by ':device:inode'
+	and each inode is hashed only once. 'inodes' is a dict {(device, inode): checksum},
+	pass the same dict to several calls to share it between them.
+	files are read in blocks of 'block_size' bytes (by default adaptive to the file size)
+	with at most 'bwlimit' bytes per second, files from 'mmap_threshold' bytes on through
+	a memory map. with 'nocache' the files are dropped from the page cache after hashing
+	(see _gethash).
+	with walkers > 1 the directories are listed by 'walkers' threads and walked sorted by name.
+	with 'per_device' the files of each device are hashed by a thread of their own, sorted
+	by inode or physical position ('order', see _hash_per_device). The lines are not
+	written in the order of the walk then, so don't resume such a run with 'start_at'.
+	files smaller than 'min_size' or larger than 'max_size' bytes are skipped before they
+	are opened, empty files are not read, their checksum is EMPTY_CHECKSUM.
+	without 'subdirs' only the files in the rootdirs themselves are indexed.
+	iter_index yields the same files as records instead of writing them
+	if verbosity =  0: print nothing
+					1: print each folder
+					2: print each file
+					3: print each line """
 
-			if verbosity == 2:
-				print(name)
-			if verbosity >= 3:
-				print(line)
+	for fullname, fstats, fhash in iter_index(rootdir, errorfile, start_at, start_after, exclude, exclude_pattern, verbosity, inodes, block_size,
+												bwlimit, nocache, mmap_threshold, walkers, per_device, order, min_size, max_size, subdirs=subdirs):
+		line = _format_index_line(fullname, fstats, fhash, size_digits, rel_to)
+		outfile.write(line+'\n')
+
+		if verbosity >= 3:
+			print(line)
 
 
 
-def collect_folders(rootdir, outfile, start_at="", start_after=True, exclude=[], exclude_pattern=[], rel_to=None, fast=False, size_digits=6, verbosity=2, serial = 1):
+def collect_folders(rootdir, outfile, start_at="", start_after=True, exclude=[], exclude_pattern=[], rel_to=None, fast=False, size_digits=6, verbosity=2, serial = 1, walkers=1, dtype=False):
 	""" walk down the tree from rootdir (exclude 'exclude'. start at 'start_at' to continue
 	a previous run (if Start_after==True, start with the next file, otherwise start with the given file))
 	for each folder count its files. append file statistics to 'outfile'
 	as follows, separated by "\t":
 	serial number		path (relative to 'relto')	number of items		number of readable files
+	with walkers > 1 the directories are listed by 'walkers' threads and walked sorted by name.
+	with 'dtype' the readable files are counted by the types of the directory entries
+	without stat'ing each file, and the directories are listed by a thread pool (like walkers > 1).
+	'fast' takes precedence over 'dtype'.
 	if verbosity =  0: print nothing
 					1: print each folder
 					2: print each folder messages
@@ -203,8 +609,14 @@ def collect_folders(rootdir, outfile, start_at="", start_after=True, exclude=[],
 		raise ValueError('start_at has to be a dir, not a file!')
 
 
+	dtype = dtype and not fast
+	if dtype:		# the thread pool lists the dirs, while the serials are counted here in the order of the walk
+		walk = _walk_parallel(rootdir, max(walkers, 2), types=True)
+	else:
+		walk = ((root, dirs, files, None) for root, dirs, files in _walk(rootdir, walkers))
+
 	# walk through the whole tree
-	for root, dirs, files in os.walk(rootdir):
+	for root, dirs, files, regular in walk:
 		if verbosity == 1:
 			print(root)
 		if verbosity > 1:
@@ -241,7 +653,12 @@ def collect_folders(rootdir, outfile, start_at="", start_after=True, exclude=[],
 				continue
 
 		number_real_files=0
-		if not fast:
+		if dtype:
+			number_real_files = len(regular)
+			if exclude_pattern:
+				number_real_files -= sum(1 for name in regular
+											if any(pathlib.Path(os.path.join(root, name)).match(pattern) for pattern in exclude_pattern))
+		elif not fast:
 			for name in files:
 				fullname = os.path.join(root, name)
 
@@ -281,28 +698,437 @@ def collect_folders(rootdir, outfile, start_at="", start_after=True, exclude=[],
 
 
 
+def _open_zstd(file, mode):
+	""" open a zstd compressed file in text mode. zstd frames can be concatenated,
+	so appending just adds a new frame"""
+
+	if zstandard is None:
+		raise ValueError("the python package 'zstandard' is needed for zstd compressed index files: " + file)
+
+	if mode[0] == 'r':
+		stream = zstandard.ZstdDecompressor().stream_reader(open(file, 'rb'), read_across_frames=True, closefd=True)
+	else:
+		stream = zstandard.ZstdCompressor().stream_writer(open(file, mode[0] + 'b'), closefd=True)
+	return io.TextIOWrapper(stream, encoding=locale.getpreferredencoding(False))
+
+# openers for compressed index files by file extension and by magic bytes
+_COMPRESSION_EXTENSIONS = {'.gz': gzip.open, '.xz': lzma.open, '.bz2': bz2.open, '.zst': _open_zstd}
+_COMPRESSION_MAGIC = [(b'\x1f\x8b', gzip.open), (b'\xfd7zXZ\x00', lzma.open), (b'BZh', bz2.open), (b'\x28\xb5\x2f\xfd', _open_zstd)]
+
+def _compression_by_magic(magic):
+	""" return the opener for the compression format starting with the bytes 'magic' or None """
+
+	for prefix, opener in _COMPRESSION_MAGIC:
+		if magic.startswith(prefix):
+			return opener
+	return None
+
+def _compression_of(file):
+	""" return the opener for the compressed file 'file' or None, if it is a plain text file.
+	the format is detected by the file extension or, if that is unknown, by the magic bytes"""
+
+	opener = _COMPRESSION_EXTENSIONS.get(os.path.splitext(file)[1])
+	if opener:
+		return opener
+	with open(file, 'rb') as f:
+		return _compression_by_magic(f.read(6))
+
+
+class _BackgroundWriter(object):
+	""" file like object, that collects everything written to it and hands it in large
+	batches to a thread, which writes it to 'fileobj'. As the compression modules release
+	the GIL, the compression runs in parallel to the caller (e.g. the walk of create_index)"""
+
+	def __init__(self, fileobj, batchsize=1024*1024):
+		self._fileobj = fileobj
+		self.encoding = getattr(fileobj, 'encoding', None)
+		self._batchsize = batchsize
+		self._batch = []
+		self._batchlen = 0
+		self._error = None
+		self._queue = queue.Queue(maxsize=8)	# don't let the caller run away with all the memory
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def _run(self):
+		while True:
+			data = self._queue.get()
+			if data is None:
+				return
+			if self._error is None:
+				try:
+					self._fileobj.write(data)
+				except Exception as e:
+					self._error = e
+
+	def write(self, string):
+		self._batch.append(string)
+		self._batchlen += len(string)
+		if self._batchlen >= self._batchsize:
+			self.flush()
+		return len(string)
+
+	def flush(self):
+		if self._error:
+			raise self._error
+		if self._batch:
+			self._queue.put(''.join(self._batch))
+			self._batch.clear()
+			self._batchlen = 0
+
+	def close(self):
+		if self._thread.is_alive():
+			self.flush()
+			self._queue.put(None)
+			self._thread.join()
+			self._fileobj.close()
+		if self._error:
+			raise self._error
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+def open_indexfile(file, mode='r'):
+	""" open an indexfile in text mode. files ending with .gz, .xz, .bz2 or .zst are
+	(de)compressed transparently. compressed files are written by a background thread.
+	when reading, compressed files are also detected by their magic bytes"""
+
+	opener = _COMPRESSION_EXTENSIONS.get(os.path.splitext(file)[1])
+	if opener:
+		if mode[0] == 'r':
+			return opener(file, 'rt')
+		return _BackgroundWriter(opener(file, mode[0] + 't'))
+
+	f = open(file, mode)
+	buffer = getattr(f, 'buffer', None)
+	if mode[0] == 'r' and buffer is not None:
+		opener = _compression_by_magic(buffer.peek(6)[:6])		# peek doesn't move the file position
+		if opener:
+			f.close()
+			return opener(file, 'rt')
+	return f
+
+
+_MANIFEST = "manifest.json"	# name of the manifest in the directory of a sharded index (a 'dataset')
+
+def _shard_of(checksum, shards):
+	""" return the number of the shard, the file with the given checksum belongs to.
+	the shards are partitioned by the leading 32 bits of the checksum"""
+
+	return (int(checksum[:8], 16) * shards) >> 32
+
+def _shard_ranges(shards):
+	""" return the range of checksum prefixes [first, last] of each shard as hex strings """
+
+	ranges = []
+	for shard in range(shards):
+		first = -((-shard << 32) // shards)			# smallest prefix with _shard_of(prefix) == shard
+		last  = -((-(shard + 1) << 32) // shards) - 1
+		ranges.append(["{:08x}".format(first), "{:08x}".format(last)])
+	return ranges
+
+def read_manifest(directory):
+	""" return the manifest of the sharded index in 'directory' as dict,
+	or None, if 'directory' is not a sharded index"""
+
+	manifest = os.path.join(directory, _MANIFEST)
+	if not os.path.isfile(manifest):
+		return None
+	with open(manifest, 'r') as f:
+		return json.load(f)
+
+def _expand_indexfiles(indexfiles):
+	""" replace all sharded indexes in the list of indexfiles by their shard files """
+
+	expanded = []
+	for file in indexfiles:
+		manifest = os.path.isdir(file) and read_manifest(file)
+		if manifest:
+			expanded.extend(os.path.join(file, shard) for shard in manifest["files"])
+		else:
+			expanded.append(file)
+	return expanded
+
+
+class ShardedIndexWriter(object):
+	""" file like object, that distributes the lines of an index written to it
+	over 'shards' shard files in 'directory', partitioned by the leading bits of
+	the checksum. A manifest describing the shards is written to the directory as well.
+	If the directory already contains a sharded index, new lines are appended to its shards"""
+
+	def __init__(self, directory, shards):
+		os.makedirs(directory, exist_ok=True)
+
+		manifest = read_manifest(directory)
+		if manifest is None:
+			manifest = {
+				"format": "fsf-index-dataset",
+				"version": 1,
+				"shards": shards,
+				"files": ["shard-{:04d}.idx".format(i) for i in range(shards)],
+				"ranges": _shard_ranges(shards),
+			}
+			with open(os.path.join(directory, _MANIFEST), 'w') as f:
+				json.dump(manifest, f, indent=1)
+		elif manifest["shards"] != shards:
+			raise ValueError("sharded index " + directory + " has " + str(manifest["shards"]) + " shards, not " + str(shards))
+
+		self.shards = shards
+		self._files = [open_indexfile(os.path.join(directory, name), 'a') for name in manifest["files"]]
+
+	def write(self, line):
+		self._files[_shard_of(line.split('\t', 3)[2], self.shards)].write(line)
+		return len(line)
+
+	def close(self):
+		for f in self._files:
+			f.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+# first line of an index, that is sorted by "size hash" (the key hpn.hash) instead of by path,
+# with the length of the entries after it in bytes. lines appended later change the length,
+# so they don't pass for sorted. lines starting with '#' are ignored by all readers
+SORTED_HEADER = "# fsf-index sorted-by=size-hash bytes={}\n"
+
+def _is_sorted_index(file, complete=True):
+	""" return True, if the indexfile starts with SORTED_HEADER and (with 'complete')
+	its entries still have the length given there. compressed files are decompressed
+	to count it, for the others the file size is compared """
+
+	prefix = SORTED_HEADER.partition("{}")[0]
+	with open_indexfile(file) as f:
+		header = f.readline()
+		if not header.startswith(prefix) or not header.endswith("\n") or not header[len(prefix):-1].isdigit():
+			return False
+		if not complete:
+			return True
+		length = int(header[len(prefix):-1])
+		if isinstance(getattr(f, 'buffer', None), io.BufferedReader):		# not compressed
+			return os.path.getsize(file) == len(header.encode(f.encoding)) + length
+		rest = 0
+		for chunk in iter(lambda: f.read(1024*1024), ""):
+			rest += len(chunk.encode(f.encoding))
+			if rest > length:
+				return False
+		return rest == length
+
+class _UnsortedIndex(ValueError):
+	'''an index has a valid SORTED_HEADER, but its entries are not sorted (it is corrupt)'''
+
+def _iter_sorted_indexfile(file):
+	""" yield the entries of the sorted indexfile like _iter_indexfile, raise _UnsortedIndex,
+	if their keys go down """
+
+	last = ""
+	for entry in _iter_indexfile(file):
+		if entry.hash < last:
+			raise _UnsortedIndex(file + " is marked as sorted, but it isn't (sort it with compactIndex --sort hash)")
+		last = entry.hash
+		yield entry
+
+def _iter_indexfile(file):
+	""" yield the entries of the indexfile one by one as hpn objects """
+
+	dircache = {}
+	with open_indexfile(file) as f:
+		for line in f:
+			if line[0] != '#':
+				yield _get_fileinfo_fast(line, dircache)
+
+
 def _get_fileinfo(string):
 	splitstring = string.rstrip('\n').split('\t', 3)		# if for any reason the filename contains '\t', we don't have a problem ;-)
 	path = pathlib.PurePath(splitstring[3])
+	checksum, sep, inode = splitstring[2].strip().partition(':')	# hard links: checksum:device:inode
+
+	#		   size                           hash           path (as tuple)  filename
+	return hpn(splitstring[0].strip() + ' ' + checksum, path.parts[:-1], path.name, inode=inode or None)
+
+_DIRCACHE_SIZE = 65536		# max number of directories kept in the cache of _get_fileinfo_fast
+
+def _get_fileinfo_fast(string, dircache):
+	""" same as _get_fileinfo, but split directory and filename with plain string operations.
+	only the directory is parsed by pathlib and only once: its parts are stored in the dict
+	'dircache', so all files of one directory share the same tuple (which saves memory as well)"""
+
+	size, mtime, checksum, path = string.rstrip('\n').split('\t', 3)
+	dirname, sep, filename = path.rpartition(os.sep)
+	if not filename or (os.altsep and os.altsep in path):	# unusual path, let pathlib do the work
+		return _get_fileinfo(string)
+
+	dirname = dirname or sep	# keep the root of absolute paths like '/file'
+	parts = dircache.get(dirname)
+	if parts is None:
+		if len(dircache) >= _DIRCACHE_SIZE:
+			dircache.clear()
+		parts = dircache[dirname] = pathlib.PurePath(dirname).parts
+
+	checksum, sep, inode = checksum.partition(':')	# hard links: checksum:device:inode
+	size = size.strip()
+	return hpn(size + ' ' + checksum, parts, filename, int(size), inode or None)
+
+def _read_indexfile_chunk(task):
+	""" worker of the parallel loader. 'task' is a tuple (file, start, end).
+	parse all lines of 'file', that start inside the byte range [start, end)
+	and return them as a list of tuples (hash, path, filename, size, inode), as tuples are much
+	cheaper to send back to the parent process than hpn objects"""
+
+	file, start, end = task
+	encoding = locale.getpreferredencoding(False)	# the same encoding, open(file, 'r') would use
+	dircache = {}
+	chunk = []
+
+	if end is None:		# compressed files can't be split and are read as a whole
+		with open_indexfile(file) as f:
+			for line in f:
+				if line[0] == '#':		# header line
+					continue
+				entry = _get_fileinfo_fast(line, dircache)
+				chunk.append((entry.hash, entry.path, entry.filename, entry.size, entry.inode))
+		return chunk
+
+	with open(file, 'rb') as f:
+		if start > 0:
+			f.seek(start - 1)
+			f.readline()		# the line crossing 'start' belongs to the previous chunk
+		pos = f.tell()
+		while pos < end:
+			line = f.readline()
+			if not line:
+				break
+			pos += len(line)
+			if line[:1] == b'#':		# header line
+				continue
+			entry = _get_fileinfo_fast(line.decode(encoding), dircache)
+			chunk.append((entry.hash, entry.path, entry.filename, entry.size, entry.inode))
 
-	#		   size                           hash                    path (as tuple)  filename
-	return hpn(splitstring[0].strip() + ' ' + splitstring[2].strip(), path.parts[:-1], path.name)
+	return chunk
 
-def _read_indexfiles(indexfiles, verbosity=1):	# todo: documentation
+def _split_indexfiles(indexfiles, chunksize):
+	""" split the indexfiles into byte ranges of about 'chunksize' bytes.
+	return a list of tuples (file, start, end) in the order of the lines in the files.
+	compressed files are not split, their single task is (file, 0, None)"""
+
+	tasks = []
+	for file in indexfiles:
+		if _compression_of(file):
+			tasks.append((file, 0, None))
+			continue
+		filesize = os.path.getsize(file)
+		start = 0
+		while True:
+			end = min(start + chunksize, filesize)
+			tasks.append((file, start, end))
+			if end >= filesize:
+				break
+			start = end
+	return tasks
+
+def _read_indexfiles(indexfiles, verbosity=1, processes=1, chunksize=64*1024*1024):
+	""" read all indexfiles into one list of hpn objects, keeping the order of the lines.
+	if processes > 1, the files (and large files in chunks of 'chunksize' bytes)
+	are parsed by a pool of 'processes' worker processes"""
 
 	filelist = []
 
 	if verbosity >= 1:
 		print("reading files...")
+
+	indexfiles = _expand_indexfiles(indexfiles)
+
+	if processes > 1:
+		tasks = _split_indexfiles(indexfiles, chunksize)
+		with multiprocessing.Pool(processes) as pool:
+			for task, chunk in zip(tasks, pool.imap(_read_indexfile_chunk, tasks)):
+				if verbosity >= 2 and task[1] == 0:
+					print(task[0])
+				filelist.extend(hpn(*entry) for entry in chunk)
+		metrics.count("index_entries_read", len(filelist))
+		return filelist
+
 	for file in indexfiles:
 		if verbosity >= 2:
 			print(file)
-		with open(file, 'r') as f:
+		dircache = {}
+		with open_indexfile(file) as f:
 			for line in f:
-				filelist.append(_get_fileinfo(line))
+				if line[0] != '#':		# skip header lines
+					filelist.append(_get_fileinfo_fast(line, dircache))
 
+	metrics.count("index_entries_read", len(filelist))
 	return filelist
 
+def compact_index(indexfiles, outfile, keep="mtime", drop_missing=False, rel_to=None, sort="path", verbosity=1, drop_paths=()):
+	""" merge the indexfiles and write each path only once to 'outfile', sorted by path.
+	if a path occurs several times (e.g. because createIndex ran twice over the same tree),
+	keep the entry with the newest mtime (keep="mtime") or the last one read (keep="last").
+	with 'drop_missing', entries of files that don't exist any more are dropped,
+	entries with a path in 'drop_paths' (as written in the index) are dropped anyway.
+	relative paths are resolved relative to 'rel_to' (or the current dir).
+	with sort="hash" the output is sorted by size and checksum instead and starts with
+	SORTED_HEADER, so find_duplicate_files can merge it without sorting"""
+
+	newest = {}		# path: (mtime, line)
+	read = 0
+
+	if verbosity >= 1:
+		print("reading files...")
+	for file in _expand_indexfiles(indexfiles):
+		if verbosity >= 2:
+			print(file)
+		with open_indexfile(file) as f:
+			for line in f:
+				if line[0] == '#':
+					continue
+				size, mtime, checksum, path = line.rstrip('\n').split('\t', 3)
+				mtime = float(mtime)
+				read += 1
+				if keep == "mtime" and path in newest and newest[path][0] > mtime:
+					continue
+				newest[path] = (mtime, line if line.endswith('\n') else line + '\n')
+
+	if verbosity >= 1:
+		print("writing " + str(len(newest)) + " of " + str(read) + " entries...")
+
+	paths = []
+	for path in sorted(newest):
+		if path in drop_paths or (drop_missing and not os.path.lexists(os.path.join(rel_to, path) if rel_to != None else path)):
+			if verbosity >= 2:
+				print("\033[94mdrop missing file: " + path + "\033[0m")
+			continue
+		paths.append(path)
+
+	if sort == "hash":
+		def hashkey(path):
+			size, mtime, checksum, rest = newest[path][1].split('\t', 3)
+			return size.strip() + ' ' + checksum.partition(':')[0]		# the same key as hpn.hash
+		paths.sort(key=hashkey)		# stable, so equal files stay sorted by path
+		encoding = getattr(outfile, 'encoding', None) or locale.getpreferredencoding(False)
+		outfile.write(SORTED_HEADER.format(sum(len(newest[path][1].encode(encoding)) for path in paths)))
+
+	for path in paths:
+		outfile.write(newest[path][1])
+
+def compact_index_file(indexfiles, outfilename, **kwargs):
+	""" run compact_index on the indexfiles and write the result to the file 'outfilename',
+	which may be one of the indexfiles. it is replaced only when the new one is complete"""
+
+	root, ext = os.path.splitext(outfilename)
+	tmpfile = root + '.tmp' + ext		# keep ext for the compression
+	with open_indexfile(tmpfile, 'w') as outfile:
+		compact_index(indexfiles = indexfiles, outfile = outfile, **kwargs)
+	os.replace(tmpfile, outfilename)
+
 def _collect_duplicate_files(filelist, verbosity=1):	# todo: documentation
 	# ! filelist will not come back. Make a copy, if needed any more
 
@@ -427,12 +1253,13 @@ def _pair_folders_with_duplicate_files(combined, verbosity=1):			# todo: documen
 		tmpfiles.clear()
 		if verbosity >= 1:
 			sys.stdout.write('\r'+infotext + "  " + str(round((1 - float(len(combined))/ready) * 100, 1)) + " %  " + \
-						str(round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 )) + " MB" )
+						str(metrics.peak_rss_mb()) + " MB" )
 			sys.stdout.flush()
 
 	if verbosity >= 1:
 		print('\r' + infotext + "                 ")
 	del(combined)
+	metrics.count("pairs_generated", len(paired_long))
 
 
 	# paired_long is similar to combined, but with only 2 folders. one element of paired_long looks like:
@@ -472,7 +1299,7 @@ def _pair_folders_with_duplicate_files(combined, verbosity=1):			# todo: documen
 			prev_entry = entry
 			if verbosity >= 1 and i > 100:
 				sys.stdout.write('\r'+infotext + "  " + str(round((1 - float(len(paired_long))/ready) * 100, 1)) + " %  " + \
-						str(round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 )) + " MB")
+						str(metrics.peak_rss_mb()) + " MB")
 				sys.stdout.flush()
 				i = 0
 			i += 1
@@ -496,29 +1323,171 @@ def _pair_folders_with_duplicate_files(combined, verbosity=1):			# todo: documen
 	return paired
 
 
-def measure_time(funcname, *opts, **args):
-	""" measure the time consumed by 'funcname' and print it out"""
+# first line of a folder summary (see write_folder_summary)
+SUMMARY_MAGIC = b"fsf-folder-summary 1\n"
+_SUMMARY_FOLDER = struct.Struct("<QQII")	# number and size of the different files, number of files with copies, length of the path
+
+class FolderSummary(object):
+	""" the folders of an index with the number and size of their different files and
+	the ids and names of their files, that have copies. the ids number the contents with
+	copies in the order of "size checksum", 'sizes' is their size by id.
+	'folders' is a dict {path tuple: (number of files, size, sorted ids, names)} in the
+	order of the index, the names belong to the ids at the same position"""
+
+	def __init__(self, sizes, folders):
+		self.sizes = sizes
+		self.folders = folders
+
+	@classmethod
+	def from_filelist(cls, filelist, collection_files=()):
+		""" summarize a list of hpn objects (see _read_indexfiles). the folders of the
+		collection files (see collect_folders), that have no files, are added as well"""
+
+		folders = {}
+		for entry in filelist:		# in the order of the index, find_similar_trees writes the folders in this order
+			if entry.path not in folders:
+				folders[entry.path] = [0, 0, [], []]
+
+		filelist.sort(key = lambda x: x.hash)		# the order of _collect_duplicate_files
+		sizes = []
+		for hash, group in itertools.groupby(filelist, key = lambda x: x.hash):
+			group = list(group)
+			size = group[0].size
+			for path in {entry.path for entry in group}:	# each content counts once per folder
+				folders[path][0] += 1
+				folders[path][1] += size
+			if len(group) > 1:
+				for entry in group:
+					folders[entry.path][2].append(len(sizes))
+					folders[entry.path][3].append(entry.filename)
+				sizes.append(size)
+
+		for file in collection_files:
+			with open(file, 'r') as f:
+				for line in f:
+					path = pathlib.PurePath(line.rstrip('\n').split('\t')[1]).parts
+					if path not in folders:
+						folders[path] = [0, 0, [], []]
+
+		return cls(sizes, {path: tuple(folder) for path, folder in folders.items()})
+
+	def save(self, filename):
+		""" write the summary to 'filename' (replaced atomically) """
+
+		tmpfile = filename + ".tmp"
+		with open(tmpfile, 'wb') as f:
+			f.write(SUMMARY_MAGIC)
+			f.write(json.dumps({"contents": len(self.sizes), "folders": len(self.folders)}).encode() + b'\n')
+			f.write(struct.pack("<{}Q".format(len(self.sizes)), *self.sizes))
+			for path, (num_files, size, ids, names) in self.folders.items():
+				path = str(pathlib.PurePath(*path)).encode('utf-8', 'surrogateescape')
+				names = '\0'.join(names).encode('utf-8', 'surrogateescape')
+				f.write(_SUMMARY_FOLDER.pack(num_files, size, len(ids), len(path)))
+				f.write(path)
+				f.write(struct.pack("<{}I".format(len(ids)), *ids))
+				f.write(struct.pack("<I", len(names)))
+				f.write(names)
+		os.replace(tmpfile, filename)
+
+	@classmethod
+	def load(cls, filename):
+		with open(filename, 'rb') as f:
+			if f.readline() != SUMMARY_MAGIC:
+				raise ValueError(filename + " is no folder summary")
+			header = json.loads(f.readline().decode())
+			data = f.read()
+
+		sizes = list(struct.unpack_from("<{}Q".format(header["contents"]), data))
+		pos = 8 * header["contents"]
+		folders = {}
+		for i in range(header["folders"]):
+			num_files, size, num_ids, pathlen = _SUMMARY_FOLDER.unpack_from(data, pos)
+			pos += _SUMMARY_FOLDER.size
+			path = pathlib.PurePath(data[pos:pos + pathlen].decode('utf-8', 'surrogateescape')).parts
+			pos += pathlen
+			ids = struct.unpack_from("<{}I".format(num_ids), data, pos)
+			pos += 4 * num_ids
+			nameslen, = struct.unpack_from("<I", data, pos)
+			pos += 4
+			names = data[pos:pos + nameslen].decode('utf-8', 'surrogateescape').split('\0') if num_ids else []
+			pos += nameslen
+			folders[path] = (num_files, size, ids, names)
+		return cls(sizes, folders)
+
+	def duplicate_lists(self, min_size=0):
+		""" return the list of duplicates like _collect_duplicate_files,
+		without the files smaller than 'min_size'"""
+
+		doublelist = [[] for size in self.sizes]
+		for path, (num_files, size, ids, names) in self.folders.items():
+			for id, name in zip(ids, names):
+				doublelist[id].append((path, name))
+		for files in doublelist:
+			files.sort()
+		return [files for id, files in enumerate(doublelist) if self.sizes[id] >= min_size]
+
+	def filetree(self, min_size=0):
+		""" return the tree of find_similar_trees with the folders of the summary.
+		files smaller than 'min_size' are counted, but don't make folders candidates"""
+
+		paths = [[] for size in self.sizes]		# id: paths of the files
+		for path, (num_files, size, ids, names) in self.folders.items():
+			for id in ids:
+				paths[id].append(path)
+
+		filetree = FTreeStat('root')
+		for path, (num_files, size, ids, names) in self.folders.items():
+			if not num_files:
+				continue
+			node = filetree.create_branch(path)
+			for id in ids:
+				node.add_hash(id, self.sizes[id], paths[id] if self.sizes[id] >= min_size else ())
+			node.add_other_files(num_files - len(node.cargo.hashdict), size - sum(node.cargo.hashdict.values()))
+		return filetree
 
-	t0 = process_time()
-	ret = funcname(*opts, **args)
-	print("\033[93m" + funcname.__name__ + ": " + str(round(process_time() - t0, 3)) + " s,  now " +
-				str(round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 )) + " MB\033[0m")
-	return ret
+def _is_folder_summary(file):
+	""" return True, if 'file' is a folder summary """
 
+	if not os.path.isfile(file):
+		return False
+	with open(file, 'rb') as f:
+		return f.read(len(SUMMARY_MAGIC)) == SUMMARY_MAGIC
 
-def print_time_delta(t_old, t_new=None):
-	"""print the timedelta in an nice way, including the memory usage.
-	if t_new is not given, use NOW. return NOW"""
-	if t_new==None:
-		t_new = process_time()
-	print("\033[93m" + str(round(abs(t_new - t_old), 3)) + " s,  now " + str(round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 )) + " MB\033[0m")
-	return process_time()
+def _read_folder_summary(indexfiles, verbosity=1):
+	""" return the FolderSummary, if 'indexfiles' is a single folder summary, else None """
 
+	if len(indexfiles) != 1 or not _is_folder_summary(indexfiles[0]):
+		return None
+	if verbosity >= 1:
+		print("reading folder summary...")
+	with metrics.stage("read_folder_summary", verbosity):
+		return FolderSummary.load(indexfiles[0])
+
+def write_folder_summary(indexfiles, outfilename, collection_files=(), verbosity=1, processes=1):
+	""" read the indexfiles and write their folder summary to 'outfilename'.
+	for each folder it contains the number and size of its different files and the ids
+	and names of its files, that have copies elsewhere, which is all find_similar_folders
+	and find_similar_trees need. they read the summary instead of the indexfiles much faster.
+	folders of the collection files without files in the index are added with 0 files"""
+
+	with metrics.stage("read_indexfiles", verbosity):
+		filelist = _read_indexfiles(indexfiles, verbosity, processes)
+	if verbosity >= 1:
+		print("summarizing folders...")
+	with metrics.stage("summarize_folders", verbosity):
+		summary = FolderSummary.from_filelist(filelist, collection_files)
+	del filelist
+	summary.save(outfilename)
+	if verbosity >= 1:
+		print(str(len(summary.folders)) + " folders, " + str(len(summary.sizes)) + " contents with copies")
 
-def find_similar_folders(indexfiles, outfile, verbosity=1):
+def find_similar_folders(indexfiles, outfile, verbosity=1, processes=1, fmt="text", min_size=0):
 	""" read all indexfiles into one large list,
 	sort this list by the hashes and filesizes
-	and print all duplicates to the outfile"""
+	and print all duplicates to the outfile in the format 'fmt' (see fsf_report).
+	instead of the indexfiles a single folder summary (see write_folder_summary) may be given.
+	files smaller than 'min_size' are ignored, e.g. 1 drops the empty files, which would
+	pair all folders containing one"""
 
 	#todo: somehow handle identical files in one folder, as they mess up everything a bit
 
@@ -528,18 +1497,27 @@ def find_similar_folders(indexfiles, outfile, verbosity=1):
 			"paired",	# list of folders with duplicate files, always pair two folders
 			}
 
-	filelist = _read_indexfiles(indexfiles, verbosity)
+	summary = _read_folder_summary(indexfiles, verbosity)
+	if summary:
+		filelist = None
+	else:
+		with metrics.stage("read_indexfiles", verbosity):
+			filelist = _read_indexfiles(indexfiles, verbosity, processes)
+		if min_size > 0:
+			filelist = [entry for entry in filelist if entry.size >= min_size]
 	# filelist now contains tupel(size_hash, (path, to, file), filename) of all files read
 
 	if "combined" in task or "paired" in task:	# collect duplicate files
-		doublelist = measure_time(_collect_duplicate_files, filelist, verbosity)
+		with metrics.stage("collect_duplicate_files", verbosity):
+			doublelist = summary.duplicate_lists(min_size) if summary else _collect_duplicate_files(filelist, verbosity)
 		# doublelist now contains sublists.
 		# each sublist contains tupel(path, filename) of identical files
 		# each sublist is sorted by the path
 		pass
 
 	if "combined" in task or "paired" in task:	# combine folders with duplicate files
-		combined = measure_time(_combine_folders_with_duplicate_files, doublelist, verbosity)
+		with metrics.stage("combine_folders_with_duplicate_files", verbosity):
+			combined = _combine_folders_with_duplicate_files(doublelist, verbosity)
 		# combined now contains two-element sublists
 		# the first element of the sublist is a (subsub)list containing the paths of all involved folders
 		# the second element is a subsublist containing subsubsublists of identical files
@@ -555,26 +1533,13 @@ def find_similar_folders(indexfiles, outfile, verbosity=1):
 			if verbosity >= 2:
 				print()
 
-		for dupset in combined:
-			line = ""
-			for path in dupset[0]:
-				line += str(path) + '\n'
-			if verbosity == 2:
-				print(line)
-			line += "--------\n"
-			for files in dupset[1]:
-				for file in files:
-					line += file + '\t'
-				line.rstrip('\t')
-				line += '\n'
-			line += '\n'
-			if verbosity >= 3:
-				print(line)
-
-			outfile.write(line)
+		with report_writer(outfile, fmt, verbosity) as writer:
+			for dupset in combined:
+				writer.write_folders(dupset[0], dupset[1])
 
 	if "paired" in task:						# pair folders with duplicate files
-		paired = measure_time(_pair_folders_with_duplicate_files,combined, verbosity)
+		with metrics.stage("pair_folders_with_duplicate_files", verbosity):
+			paired = _pair_folders_with_duplicate_files(combined, verbosity)
 
 	# 'paired' has a quite similar structure like 'combined', but the folders with identical files are
 	# now split into pairs. i.e. one entry of 'paired' looks like:
@@ -586,98 +1551,380 @@ def find_similar_folders(indexfiles, outfile, verbosity=1):
 			if verbosity >= 2:
 				print()
 
-
-		for dupset in paired:
-			line = str(dupset[0][0]) + '\n' + str(dupset[0][1]) + '\n'
-			if verbosity == 2:
-				print(line)
-			line += "--------\n"
-			for files in dupset[1]:
-				line += files[0] + '\t' + files[1] + '\n'
-			line += '\n'
-			if verbosity >= 3:
-				print(line)
-
-			outfile.write(line)
+		with metrics.stage("output", verbosity), report_writer(outfile, fmt, verbosity) as writer:
+			for dupset in paired:
+				writer.write_folders(dupset[0], dupset[1])
 
 
 # todo: whenever combining something: check, that list is long enough
 # todo: verbosity: define/assign a level, where the number of datasets is shown
 
-def find_duplicate_files(indexfiles, outfile, verbosity=1):
+def _link_members(entries):
+	""" collect the hpn objects of equal files in 'entries' by their inode.
+	return a list of members, each member is a list of the hard links of one inode.
+	a file without inode information is a member of its own"""
+
+	members = {}
+	for entry in entries:
+		members.setdefault(entry.inode or id(entry), []).append(entry)
+	return list(members.values())
+
+def _iter_duplicate_groups(filelist):
+	""" yield the groups of duplicate files in 'filelist'. a group is a list of at least
+	two members (see _link_members). hard links to the same inode are one member, as
+	removing them would not free any space.
+	filelist may be any iterable, but it must be sorted by hpn.hash"""
+
+	group = []
+	for entry in filelist:
+		if group and entry.hash != group[0].hash:
+			if len(group) > 1:
+				members = _link_members(group)
+				if len(members) > 1:
+					yield members
+			group = []
+		group.append(entry)
+	if len(group) > 1:
+		members = _link_members(group)
+		if len(members) > 1:
+			yield members
+
+def _split_by_content(members, rel_to=None, chunksize=1024*1024, limiter=None, verbosity=1):
+	""" read the first hard link of each of the 'members' (see _iter_duplicate_groups) chunk
+	by chunk, all of them at the same time, and split them as soon as the chunks differ.
+	return the lists of members with the same content, in the order of 'members' (lists of
+	a single member as well). files that can't be read are left out"""
+
+	opened = []
+	for member in members:
+		fullname = os.path.join(rel_to or '', *member[0].path, member[0].filename)
+		try:
+			opened.append((member, open(fullname, 'rb')))
+		except OSError as e:
+			print("\033[91mcan't verify " + fullname + ": " + str(e) + "\033[0m")
+
+	pending = [opened] if opened else []
+	finished = []
+	try:
+		while pending:
+			subgroup = pending.pop()
+			by_content = {}
+			for member, f in subgroup:
+				try:
+					block = f.read(chunksize)
+				except OSError as e:
+					print("\033[91mcan't verify " + member[0].filename + ": " + str(e) + "\033[0m")
+					continue
+				metrics.count("bytes_verified", len(block))
+				if limiter:
+					limiter.consume(len(block))
+				by_content.setdefault(block, []).append((member, f))
+
+			if verbosity >= 2 and len(by_content) > 1:
+				print("\033[94mcontent differs: " + members[0][0].hash + "\033[0m")
+			for block, same in by_content.items():
+				if block and len(same) > 1:
+					pending.append(same)
+				else:						# all of them reached the end of the file, or no other file is left to compare
+					finished.append([member for member, f in same])
+	finally:
+		for member, f in opened:
+			f.close()
+
+	position = {id(member): i for i, member in enumerate(members)}
+	finished.sort(key = lambda subgroup: position[id(subgroup[0])])
+	return finished
+
+_VERIFY_BUFFER = 16 * 1024 * 1024		# bytes read at a time by the verification of one group
+
+def _verify_duplicate_group(group, rel_to=None, chunksize=1024*1024, limiter=None, verbosity=1, max_open=64):
+	""" compare the content of the members of 'group' (see _iter_duplicate_groups)
+	byte by byte. return a list of the confirmed groups of identical files (each with
+	at least two members). files that can't be read are dropped. only the first hard
+	link of each member is read.
+	at most 'max_open' files are open at a time: the first member is the reference, it is
+	compared with the others in batches of max_open - 1 (see _split_by_content). the members,
+	that differ from it, are compared again with the first of them as reference and so on.
+	the chunks get smaller for large batches, so a batch reads at most _VERIFY_BUFFER bytes at a time"""
+
+	position = {id(member): i for i, member in enumerate(group)}
+	remaining = list(group)
+	confirmed = []
+	while len(remaining) > 1:
+		reference = remaining[0]
+		same, differ = [reference], []
+		for start in range(1, len(remaining), max_open - 1):
+			batch = [reference] + remaining[start:start + max_open - 1]
+			chunk = min(chunksize, max(64 * 1024, _VERIFY_BUFFER // len(batch)))
+			subgroups = _split_by_content(batch, rel_to, chunk, limiter, verbosity)
+			if not any(subgroup[0] is reference for subgroup in subgroups):
+				break		# the reference can't be read
+			for subgroup in subgroups:
+				if subgroup[0] is reference:
+					same.extend(subgroup[1:])
+				else:
+					differ.extend(subgroup)
+		else:
+			if len(same) > 1:
+				confirmed.append(same)
+			remaining = sorted(differ, key = lambda member: position[id(member)])
+			continue
+		remaining = remaining[1:]		# try again without the reference
+
+	confirmed.sort(key = lambda subgroup: position[id(subgroup[0])])		# keep the order of the input
+	return confirmed
+
+def _max_open_per_group(workers, limit=64):
+	""" return how many files the verification of one group may open, so 'workers' threads
+	stay well below the limit of open files of the process """
+
+	if resource is None:
+		return limit
+	soft = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+	if soft == resource.RLIM_INFINITY:
+		return limit
+	return max(2, min(limit, (soft - 32) // workers))
+
+def _verified_duplicate_groups(groups, rel_to=None, workers=4, bwlimit=None, verbosity=1):
+	""" verify the groups of duplicate files with a pool of 'workers' threads
+	(see _verify_duplicate_group) and yield the confirmed groups in the original order.
+	'bwlimit' limits the bandwidth of all workers together to bwlimit bytes per second"""
+
+	limiter = _RateLimiter(bwlimit) if bwlimit else None
+	max_open = _max_open_per_group(workers)
+	with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+		window = collections.deque()		# don't submit more groups than needed to keep the workers busy
+		for group in groups:
+			window.append(pool.submit(_verify_duplicate_group, group, rel_to, limiter=limiter, verbosity=verbosity, max_open=max_open))
+			if len(window) >= 4 * workers:
+				yield from window.popleft().result()
+		while window:
+			yield from window.popleft().result()
+
+def _top_duplicate_groups(groups, top):
+	""" return the 'top' groups of duplicates with the most reclaimable space
+	((number of members - 1) * size), sorted by it. Only 'top' groups are kept in memory.
+	if top <= 0, return all groups sorted by their reclaimable space"""
+
+	heap = []
+	for n, group in enumerate(groups):
+		item = ((len(group) - 1) * group[0][0].size, -n, group)	# -n: equal groups keep their order
+		if top <= 0 or len(heap) < top:
+			heapq.heappush(heap, item)
+		elif item[:2] > heap[0][:2]:
+			heapq.heapreplace(heap, item)
+
+	heap.sort(key = lambda item: item[:2], reverse=True)
+	return [item[2] for item in heap]
+
+def _write_duplicate_groups(groups, outfile, verbosity=1, ranked=False, fmt="text", batchsize=None):
+	""" print the groups of duplicates (see _iter_duplicate_groups) to the outfile
+	in the format 'fmt' (see fsf_report), in batches of 'batchsize' groups (default: see fsf_report).
+	if 'ranked', the reclaimable space of each group is reported as well"""
+
+	reclaimable = 0
+	with report_writer(outfile, fmt, verbosity, batchsize) as writer:
+		for group in groups:
+			wasted = (len(group) - 1) * group[0][0].size
+			reclaimable += wasted
+			writer.write_group(group, wasted if ranked else None)
+			metrics.count("groups_found")
+	metrics.count("reclaimable_bytes", reclaimable)
+
+	if verbosity >= 1:
+		print("reclaimable space: " + str(reclaimable) + " bytes")
+
+def _shards_of_datasets(indexfiles):
+	""" return a list, that contains for each shard number a list of the
+	shard files of this number in all the given sharded indexes"""
+
+	manifests = [read_manifest(file) if os.path.isdir(file) else None for file in indexfiles]
+	if not all(manifests):
+		raise ValueError("processing by shards needs sharded indexes only")
+	shards = manifests[0]["shards"]
+	if any(manifest["shards"] != shards for manifest in manifests):
+		raise ValueError("all sharded indexes must have the same number of shards")
+
+	return [[os.path.join(file, manifest["files"][i]) for file, manifest in zip(indexfiles, manifests)]
+				for i in range(shards)]
+
+def find_duplicate_files(indexfiles, outfile, verbosity=1, processes=1, per_shard=False, shards=None, verify=False, verify_workers=4, bwlimit=None, rel_to=None, min_size=0, top=None, fmt="text", records=None, records_by_size=False):
 	""" read all indexfiles into one large list,
 	sort this list by the hashes and filesizes
-	and print all duplicates to the outfile"""
+	and print all duplicates to the outfile.
+	if 'per_shard' is set, the indexfiles have to be sharded indexes with the same number
+	of shards. As all copies of a file are in the shard of the same number, the shards are
+	processed one after another, which needs only the memory for one shard.
+	'shards' restricts this to the given shard numbers, so different processes or hosts
+	can work on different shards and their outputs just have to be concatenated.
+	with 'verify' the content of each group of duplicates is compared byte by byte
+	by 'verify_workers' threads, reading at most 'bwlimit' bytes per second. relative
+	paths in the index are relative to 'rel_to'.
+	files smaller than 'min_size' are dropped before searching for duplicates.
+	if 'top' is given, only the 'top' groups with the most reclaimable space are printed,
+	sorted by their reclaimable space (all groups, if top is 0).
+	'fmt' is the format of the output (see fsf_report).
+	instead of reading indexfiles, the duplicates may be searched in the 'records' of
+	iter_index (paths relative to 'rel_to'). with 'records_by_size' they come size by size
+	(iter_index with size_buckets) and the groups of each size are written as soon as
+	the next size starts, otherwise all records are collected first"""
+
+	if records is not None:
+		groups = _record_duplicate_groups(records, rel_to, min_size, records_by_size)
+	elif per_shard or shards is not None:
+		shardfiles = _shards_of_datasets(indexfiles)
+		if shards is not None and not all(0 <= shard < len(shardfiles) for shard in shards):
+			raise ValueError("the shard numbers must be from 0 to {}".format(len(shardfiles) - 1))
+		groups = itertools.chain.from_iterable(
+					_duplicate_groups(shardfiles[shard], verbosity, processes, min_size)
+						for shard in (range(len(shardfiles)) if shards is None else shards))
+	else:
+		groups = _duplicate_groups(indexfiles, verbosity, processes, min_size)
+
+	if verify:
+		if verbosity >= 1: print("verifying the duplicates byte by byte...")
+		groups = _verified_duplicate_groups(groups, rel_to, verify_workers, bwlimit, verbosity)
+
+	if top is not None:
+		groups = _top_duplicate_groups(groups, top)
+
+	_write_duplicate_groups(groups, outfile, verbosity, ranked = top is not None, fmt = fmt,
+							batchsize = 1 if records_by_size and fmt != "sqlite" else None)		# a commit per group is too slow for sqlite
 
-	filelist = _read_indexfiles(indexfiles, verbosity)
+def scan_duplicate_files(rootdir, outfile, errorfile=None, exclude=[], exclude_pattern=[], rel_to=None, verbosity=1, walkers=1, per_device=False, order="inode", bwlimit=None, nocache=False, min_size=0, max_size=None, verify=False, verify_workers=4, top=None, fmt="text"):
+	""" find the duplicate files in the trees 'rootdir' without writing an index: walk the
+	trees, hash the files size by size (files of a unique size are not read, see iter_index)
+	and write the groups of duplicates of each size to 'outfile', as soon as all files of
+	that size are hashed. the paths are relative to 'rel_to'. see create_index and
+	find_duplicate_files for the other parameters"""
+
+	records = iter_index(rootdir, errorfile, exclude=exclude, exclude_pattern=exclude_pattern, verbosity=verbosity,
+							bwlimit=bwlimit, nocache=nocache, walkers=walkers, per_device=per_device, order=order,
+							min_size=min_size, max_size=max_size, size_buckets=True)
+	find_duplicate_files(None, outfile, verbosity, verify=verify, verify_workers=verify_workers, bwlimit=bwlimit,
+							rel_to=rel_to, top=top, fmt=fmt, records=records, records_by_size=True)
+
+def _duplicate_groups(indexfiles, verbosity=1, processes=1, min_size=0):
+	""" yield the groups of duplicates in the indexfiles (see _iter_duplicate_groups).
+	if all indexfiles are sorted by size and checksum (see compact_index), they are merged
+	while reading them, otherwise they are read completely and sorted"""
+
+	indexfiles = _expand_indexfiles(indexfiles)
+
+	if all(_is_sorted_index(file) for file in indexfiles):
+		if verbosity >= 1:
+			print("merging sorted index files...")
+		filelist = heapq.merge(*[_iter_sorted_indexfile(file) for file in indexfiles], key = lambda x: x.hash)
+		if min_size > 0:
+			filelist = (entry for entry in filelist if entry.size >= min_size)
+		yield from _iter_duplicate_groups(filelist)
+		return
+
+	with metrics.stage("read_indexfiles", verbosity):
+		filelist = _read_indexfiles(indexfiles, verbosity, processes)
 
 	# unfortunately for the next steps _collect_duplicate_files can't be used as the size
 	# and hash of the files are not available anymore in the doublelist. (and due to memory efficiency
 	# I don't want to keep this information in doublelist)
 
+	if min_size > 0:
+		filelist = [entry for entry in filelist if entry.size >= min_size]
+
 	# sort files
 	if verbosity >=1: print("sorting files by size and checksum...")
-	filelist.sort(key = lambda x: x.hash)
+	with metrics.stage("sort_files", verbosity):
+		filelist.sort(key = lambda x: x.hash)
 
 	# search for duplicates
 	if verbosity >=1: print("searching for duplicates...")
-	old_entry = hpn("", (), "")
-	first = True
-	for entry in filelist:
-		if entry.hash == old_entry.hash:
-			line = ""
-			if first:
-				line += '\n'  + entry.hash + '\n'
-				line += "{name}\t{path}\n".format(path=pathlib.PurePath(*old_entry.path), name=old_entry.filename)
-				first = False
-			line +="{name}\t{path}\n".format(path=pathlib.PurePath(*entry.path), name=entry.filename)
-			outfile.write(line)
-			if verbosity >= 3: print(line)
-		else:
-			first = True
-		old_entry = entry
-
-
-
-def find_similar_trees(indexfiles, outfile, verbosity=1):
-	t = process_time()
-	filelist = _read_indexfiles(indexfiles, verbosity)
-	# todo: perhaps we can read directly to filedict and spare the filelist?
-	# todo: perhaps we do not need to collect the filenames as we do not need them
-	t = print_time_delta(t)
+	yield from _iter_duplicate_groups(filelist)
 
-	print("collecting duplicate files")
-	t = process_time()
-
-	filedict = {}
-	for entry in filelist:
-		key = entry.hash
-		value = [entry.path]
-		if key in filedict:
-			filedict[key]["paths"].append(entry.path) # todo: paths could be a set() as well
-		else:
-			filedict[key] = {"size": int(entry.size), "paths": [entry.path]}
+def _record_duplicate_groups(records, rel_to=None, min_size=0, by_size=False):
+	""" yield the groups of duplicates in the records of iter_index (see _iter_duplicate_groups).
+	the paths are made relative to 'rel_to' like in the index. with 'by_size' the records of
+	one size follow each other and the groups of a size are yielded, when the next size starts"""
 
+	def entries():
+		dircache = {}
+		for fullname, fstats, checksum in records:
+			if fstats.st_size < min_size:
+				continue
+			path = os.path.relpath(fullname, rel_to) if rel_to is not None else fullname
+			dirname, sep, filename = path.rpartition(os.sep)
+			dirname = dirname or sep		# keep the root of absolute paths like '/file'
+			parts = dircache.get(dirname)
+			if parts is None:		# the files of a dir share its tuple, like in _get_fileinfo_fast
+				parts = dircache[dirname] = pathlib.PurePath(dirname).parts
+			yield hpn(str(fstats.st_size) + ' ' + checksum, parts, filename, fstats.st_size,
+						"{}:{}".format(fstats.st_dev, fstats.st_ino) if fstats.st_nlink > 1 else None)
+
+	if not by_size:
+		filelist = sorted(entries(), key = lambda x: x.hash)
+		yield from _iter_duplicate_groups(filelist)
+		return
+
+	bucket = []
+	for entry in entries():
+		if bucket and entry.size != bucket[0].size:
+			bucket.sort(key = lambda x: x.hash)
+			yield from _iter_duplicate_groups(bucket)
+			bucket = []
+		bucket.append(entry)
+	bucket.sort(key = lambda x: x.hash)
+	yield from _iter_duplicate_groups(bucket)
+
+
+
+def find_similar_trees(indexfiles, outfile, verbosity=1, processes=1, fmt="text", min_size=0):
+	""" read all indexfiles, build a tree of all folders and remove the folders,
+	that have no files in common with other folders. print the remaining folders
+	together with the folders they share files with to the outfile in the format 'fmt'.
+	instead of the indexfiles a single folder summary (see write_folder_summary) may be given.
+	files smaller than 'min_size' are counted, but don't make folders similar, e.g. 1 keeps
+	the empty files from making all folders with one similar"""
+
+	summary = _read_folder_summary(indexfiles, verbosity)
+	if summary:
+		print("building filetree...")
+		with metrics.stage("build_filetree", verbosity):
+			filetree = summary.filetree(min_size)
+	else:
+		with metrics.stage("read_indexfiles", verbosity):
+			filelist = _read_indexfiles(indexfiles, verbosity, processes)
+		# todo: perhaps we can read directly to filedict and spare the filelist?
+		# todo: perhaps we do not need to collect the filenames as we do not need them
+
+		print("collecting duplicate files")
+
+		with metrics.stage("collect_duplicate_files", verbosity):
+			filedict = {}
+			for entry in filelist:
+				key = entry.hash
+				value = [entry.path]
+				if key in filedict:
+					filedict[key]["paths"].append(entry.path) # todo: paths could be a set() as well
+				else:
+					filedict[key] = {"size": int(entry.size), "paths": [entry.path]}
 
-	t = print_time_delta(t)
 
-	# filedict is a dictionary with "size<space>hash" as keys. each value is a dict with
-	# two elements: "size":  size of one file with this hash
-	#               "paths": list of paths  where files with this hash are found.
-	# for example
-	# "231325 af3e3277f23b4636": {"size": 1234, "paths": ["path/to/file1", "path/to/file2"...]}
+		# filedict is a dictionary with "size<space>hash" as keys. each value is a dict with
+		# two elements: "size":  size of one file with this hash
+		#               "paths": list of paths  where files with this hash are found.
+		# for example
+		# "231325 af3e3277f23b4636": {"size": 1234, "paths": ["path/to/file1", "path/to/file2"...]}
 
 
-# there should be no need for the filelist to be sorted!
-#	print("sorting filelist...")
-#	filelist.sort(key=lambda x: x[1])		# sort by path
-#	t = print_time_delta(t)
+	# there should be no need for the filelist to be sorted!
+	#	print("sorting filelist...")
+	#	filelist.sort(key=lambda x: x[1])		# sort by path
 
-	print("building filetree...")
-	filetree = FTreeStat('root')
-	for entry in filelist:							# each entry represents one FILE
-		node = filetree.create_branch(entry.path)	# each node represents one FOLDER
-		node.add_hash(entry.hash, filedict[entry.hash]["size"], filedict[entry.hash]["paths"])
+		print("building filetree...")
+		with metrics.stage("build_filetree", verbosity):
+			filetree = FTreeStat('root')
+			for entry in filelist:							# each entry represents one FILE
+				node = filetree.create_branch(entry.path)	# each node represents one FOLDER
+				size = filedict[entry.hash]["size"]
+				node.add_hash(entry.hash, size, filedict[entry.hash]["paths"] if size >= min_size else ())
 
 	# filetree is the root node of a tree. Each node contains a name, a list of
 	# subfolders and a Cargo object 'cargo'.
@@ -697,11 +1944,21 @@ def find_similar_trees(indexfiles, outfile, verbosity=1):
 	#   size_subfolders: size of all files in all child nodes
 
 
-	t = print_time_delta(t)
-
 	print("collecting stats and removing unique folders")
-	filetree.traverse_bottomup(lambda node: node.collect_stats_remove_uniques())
+	with metrics.stage("remove_unique_folders", verbosity):
+		filetree.traverse_bottomup(lambda node: node.collect_stats_remove_uniques())
 	# todo: check, if removing the nodes is helpful at all
 
-	t = print_time_delta(t)
 	#print(filetree)
+
+	print("output...")
+	with metrics.stage("output", verbosity), report_writer(outfile, fmt, verbosity) as writer:
+		def write_node(node):
+			if not node.get_parent():
+				return		# the root node is no folder
+			path = node.get_path()
+			candidates = sorted(node.cargo.dup_candidates - {path})
+			if candidates:
+				writer.write_tree_folder(path, node.num_files(), node.size_files(), candidates)
+				metrics.count("similar_folders_found")
+		filetree.traverse_topdown(write_node)
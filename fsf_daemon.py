@@ -0,0 +1,261 @@
+# FindSimilarFolders: find duplicate files and folders, that contain many of them
+# Copyright (C) 2015  Johannes König
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# query server: keeps the indexes in memory and answers queries over a unix socket.
+# a request is one line of JSON, e.g. {"query": "duplicates", "path": "a/b/file"},
+# the answer one line of JSON {"result": ...} or {"error": "..."}.
+# a connection may send any number of requests
+
+
+import functools
+import itertools
+import json
+import os
+import pathlib
+import socket
+import socketserver
+import threading
+
+from collections import Counter
+
+from fsf_core import _read_indexfiles, _link_members
+from fsf_metrics import metrics
+
+
+class IndexStore(object):
+	'''the entries of the indexes by path, by folder and by checksum (only checksums of
+	more than one file). if a path occurs several times, the last entry read counts'''
+
+	def __init__(self, indexfiles, processes=1, verbosity=1):
+		with metrics.stage("read_indexfiles", verbosity):
+			filelist = _read_indexfiles(indexfiles, verbosity, processes)
+
+		with metrics.stage("build_tables", verbosity):
+			self._by_path = {}		# (path tuple, filename): hpn
+			for entry in filelist:
+				key = (entry.path, entry.filename)
+				self._by_path.pop(key, None)		# e.g. appended by watchIndex, the later entry goes last
+				self._by_path[key] = entry
+			del filelist
+
+			self._folders = {}		# path tuple: list of hpn
+			by_hash = {}
+			for entry in self._by_path.values():
+				self._folders.setdefault(entry.path, []).append(entry)
+				by_hash.setdefault(entry.hash, []).append(entry)
+
+			self._by_hash = {}		# "size checksum": list of members (see _link_members)
+			for hash, entries in by_hash.items():
+				if len(entries) > 1:
+					members = _link_members(entries)
+					if len(members) > 1:
+						self._by_hash[hash] = members
+
+			# the groups of duplicates sorted by reclaimable space, like find_duplicate_files --top
+			self._groups = sorted(self._by_hash.values(), key = lambda group: (len(group) - 1) * group[0][0].size, reverse=True)
+
+		self._paths = {}		# cache: path tuple -> joined path
+
+
+	def _path(self, path):
+		joined = self._paths.get(path)
+		if joined is None:
+			joined = self._paths[path] = str(pathlib.PurePath(*path))
+		return joined
+
+
+	def _group_record(self, group):
+		'''the group in the layout of duplicateFiles -F jsonl'''
+
+		size, checksum = group[0][0].hash.split(' ', 1)
+		files = []
+		for member in group:
+			entry = {"name": member[0].filename, "path": self._path(member[0].path)}
+			if len(member) > 1:
+				entry["links"] = [{"name": link.filename, "path": self._path(link.path)} for link in member[1:]]
+			files.append(entry)
+		return {"size": int(size), "hash": checksum, "reclaimable": (len(group) - 1) * int(size), "files": files}
+
+
+	def duplicates(self, path):
+		'''return the group of duplicates of the file 'path' (as written in the index),
+		None if it has no duplicates'''
+
+		path = pathlib.PurePath(path)
+		entry = self._by_path.get((path.parts[:-1], path.name))
+		if entry is None:
+			raise ValueError("not in the index: " + str(path))
+		group = self._by_hash.get(entry.hash)
+		return self._group_record(group) if group else None
+
+
+	def groups(self, min_size=0, top=None):
+		'''return the groups of duplicates of files of at least 'min_size' bytes,
+		sorted by their reclaimable space. with 'top' only the first 'top' groups'''
+
+		groups = (group for group in self._groups if group[0][0].size >= min_size)
+		return [self._group_record(group) for group in itertools.islice(groups, top or None)]
+
+
+	def overlap(self, folder, top=None):
+		'''return the folders, that contain copies of files in 'folder', sorted by
+		the number of the files of 'folder' they contain'''
+
+		folder = pathlib.PurePath(folder).parts
+		entries = self._folders.get(folder)
+		if entries is None:
+			raise ValueError("not in the index: " + str(pathlib.PurePath(*folder)))
+
+		common = Counter()
+		for entry in entries:
+			others = {other.path for member in self._by_hash.get(entry.hash, ()) for other in member}
+			others.discard(folder)
+			common.update(others)
+		return [{"folder": self._path(other), "common": num, "files": len(self._folders[other])}
+					for other, num in common.most_common(top)]
+
+
+	def stats(self):
+		return {"files": len(self._by_path), "folders": len(self._folders), "groups": len(self._groups)}
+
+
+
+class _QueryHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		for line in self.rfile:
+			self.wfile.write(self.server.answer(line.decode()).encode() + b'\n')
+			self.wfile.flush()
+
+
+
+class QueryServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	'''load the 'indexfiles' once and answer the queries on the unix socket 'socketfile'.
+	the answers of the last 'cache_size' different queries are cached'''
+
+	daemon_threads = True
+
+	def __init__(self, socketfile, indexfiles, cache_size=1024, processes=1, verbosity=1):
+		self.indexfiles = indexfiles
+		self.processes = processes
+		self.verbosity = verbosity
+		self.store = IndexStore(indexfiles, processes, verbosity)
+		self._cached = functools.lru_cache(maxsize=cache_size)(self._answer)
+		self._reload_lock = threading.Lock()
+
+		if os.path.exists(socketfile):		# left over by a server, that was killed?
+			with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+				try:
+					probe.connect(socketfile)
+				except ConnectionRefusedError:
+					os.remove(socketfile)
+				else:
+					raise OSError("a server is running on " + socketfile)
+		socketserver.UnixStreamServer.__init__(self, socketfile, _QueryHandler)
+		os.chmod(socketfile, 0o600)		# the paths in the index are nobody else's business
+
+
+	def _answer(self, store, request):
+		'''answer the request (a JSON string with sorted keys) from 'store'. both are the key of the cache'''
+
+		request = json.loads(request)
+		query = request.pop("query", None)
+		if query == "duplicates":
+			result = store.duplicates(**request)
+		elif query == "groups":
+			result = store.groups(**request)
+		elif query == "overlap":
+			result = store.overlap(**request)
+		else:
+			raise ValueError("unknown query: " + str(query))
+		return json.dumps({"result": result})
+
+
+	def answer(self, line):
+		'''answer the request 'line' and return the answer as JSON string'''
+
+		metrics.count("queries")
+		try:
+			request = json.loads(line)
+			if not isinstance(request, dict):
+				raise ValueError("a request must be a JSON object")
+			if request.get("query") == "stats":
+				cache = self._cached.cache_info()
+				return json.dumps({"result": dict(self.store.stats(), cache_hits=cache.hits,
+													cache_misses=cache.misses, cached=cache.currsize,
+													peak_rss_mb=metrics.peak_rss_mb())})
+			if request.get("query") == "reload":
+				self.reload()
+				return json.dumps({"result": self.store.stats()})
+			store = self.store
+			result = self._cached(store, json.dumps(request, sort_keys=True))
+			if store is not self.store:		# reloaded meanwhile, don't keep the old tables in the cache
+				self._cached.cache_clear()
+			return result
+		except (ValueError, TypeError, OSError) as e:		# TypeError: unknown parameters, OSError: reading the indexfiles
+			return json.dumps({"error": str(e)})
+
+
+	def reload(self):
+		'''read the indexes again, e.g. after they were updated. queries are answered
+		from the old tables in the meantime. if the indexfiles can't be read, the old
+		tables are kept'''
+
+		with self._reload_lock:
+			self.store = IndexStore(self.indexfiles, self.processes, self.verbosity)
+			self._cached.cache_clear()
+
+
+	def server_close(self):
+		socketserver.UnixStreamServer.server_close(self)
+		if os.path.exists(self.server_address):
+			os.remove(self.server_address)
+
+
+
+def serve_index(socketfile, indexfiles, cache_size=1024, processes=1, verbosity=1):
+	''' load the indexfiles and answer queries on the unix socket 'socketfile' until
+	KeyboardInterrupt. the queries are JSON objects, one per line:
+	{"query": "duplicates", "path": PATH}  the group of duplicates of a file (or null)
+	{"query": "groups", "min_size": BYTES, "top": N}  the groups of duplicates sorted by reclaimable space
+	{"query": "overlap", "folder": PATH, "top": N}  the folders with copies of the files of a folder
+	{"query": "stats"}  the size of the tables and the hits of the cache
+	{"query": "reload"}  read the indexfiles again
+	paths are given as they are written in the index. the answer is one line
+	{"result": ...} or {"error": "..."}'''
+
+	with QueryServer(socketfile, indexfiles, cache_size, processes, verbosity) as server:
+		if verbosity >= 1:
+			print("listening on " + socketfile)
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+
+
+
+def query_index(socketfile, request):
+	''' send the request (a dict, see serve_index) to the server on 'socketfile'
+	and return the result. raise ValueError, if the server reports an error'''
+
+	with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+		sock.connect(socketfile)
+		with sock.makefile('rwb') as f:
+			f.write(json.dumps(request).encode() + b'\n')
+			f.flush()
+			answer = json.loads(f.readline().decode())
+	if "error" in answer:
+		raise ValueError(answer["error"])
+	return answer["result"]
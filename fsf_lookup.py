@@ -0,0 +1,273 @@
+# FindSimilarFolders: find duplicate files and folders, that contain many of them
+# Copyright (C) 2015  Johannes König
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# lookup of files in an archive index: are they stored already, and where?
+# the sizes, a bloom filter and the sorted keys of all files of the index are
+# kept in a lookup file, that is memory mapped, so it loads instantly
+
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+from fsf_core import _RateLimiter, _index_candidates, _hash_candidate, _expand_indexfiles, open_indexfile
+from fsf_metrics import metrics
+
+
+LOOKUP_MAGIC = b"fsf-lookup 1\n"		# first line of a lookup file
+
+_KEY_SIZE = 28			# 8 bytes size (big endian, so the keys sort by size) + 20 bytes sha1
+_BUCKET_BITS = 512		# a bucket of the bloom filter is one cache line, all probes of a key hit one bucket
+_BITS_PER_KEY = 10		# about 1% false positives
+_PROBES = 7
+
+
+def _key(size, checksum):
+	""" return the key of a file in the lookup file """
+
+	try:
+		digest = bytes.fromhex(checksum)
+	except ValueError:
+		digest = b''
+	if len(digest) != 20:		# not a sha1, e.g. in tests
+		digest = hashlib.sha1(checksum.encode()).digest()
+	return size.to_bytes(8, 'big') + digest
+
+
+def _probes(key, buckets):
+	""" return the bit positions of the key in a bloom filter of 'buckets' buckets.
+	the key is hashed again, as checksums in the index don't have to be sha1.
+	the bucket is chosen by size and checksum: by the size alone, the buckets of
+	common sizes (like empty files) would overflow"""
+
+	mixed = hashlib.blake2b(key, digest_size=16).digest()
+	bucket = int.from_bytes(mixed[:8], 'little') % buckets
+	bits = int.from_bytes(mixed[8:], 'little')
+	return [bucket * _BUCKET_BITS + ((bits >> (9 * i)) & (_BUCKET_BITS - 1)) for i in range(_PROBES)]
+
+
+class LookupFilter(object):
+	'''the files of an index: the set of their sizes, a bloom filter and the sorted keys
+	(see _key) for the exact lookup. use build() or load() to create it'''
+
+	def __init__(self, sizes, bloom, keys, indexfiles):
+		self.sizes = sizes				# set of all file sizes
+		self.bloom = bloom				# bytes-like, a multiple of _BUCKET_BITS bits
+		self.keys = keys				# bytes-like, the sorted keys without duplicates
+		self.indexfiles = indexfiles	# where the files can be located
+		self._buckets = len(bloom) * 8 // _BUCKET_BITS
+		self._mmap = None				# the mapped lookup file and its memoryview, if loaded
+		self._view = None
+
+
+	@classmethod
+	def build(cls, indexfiles, verbosity=1):
+		'''read the indexfiles and build the filter'''
+
+		keys = set()
+		for file in _expand_indexfiles(indexfiles):
+			if verbosity >= 2:
+				print(file)
+			with open_indexfile(file) as f:
+				for line in f:
+					if line[0] == '#':
+						continue
+					size, mtime, checksum, path = line.split('\t', 3)
+					keys.add(_key(int(size), checksum.strip().partition(':')[0]))	# hard links: checksum:device:inode
+
+		buckets = max(1, len(keys) * _BITS_PER_KEY // _BUCKET_BITS)
+		bloom = bytearray(buckets * _BUCKET_BITS // 8)
+		sizes = set()
+		for key in keys:
+			sizes.add(int.from_bytes(key[:8], 'big'))
+			for bit in _probes(key, buckets):
+				bloom[bit >> 3] |= 1 << (bit & 7)
+
+		return cls(sizes, bloom, b''.join(sorted(keys)), [os.path.abspath(file) for file in indexfiles])
+
+
+	def save(self, filename):
+		'''write the filter to the lookup file 'filename' (replaced atomically)'''
+
+		header = {"indexfiles": self.indexfiles, "sizes": len(self.sizes), "bloom": len(self.bloom), "keys": len(self.keys) // _KEY_SIZE}
+		tmpfile = filename + ".tmp"
+		with open(tmpfile, 'wb') as f:
+			f.write(LOOKUP_MAGIC)
+			f.write(json.dumps(header).encode() + b'\n')
+			f.write(struct.pack("<{}Q".format(len(self.sizes)), *sorted(self.sizes)))
+			f.write(self.bloom)
+			f.write(self.keys)
+		os.replace(tmpfile, filename)
+
+
+	@classmethod
+	def load(cls, filename):
+		'''map the lookup file 'filename' into memory. only the sizes are read'''
+
+		with open(filename, 'rb') as f:
+			if f.readline() != LOOKUP_MAGIC:
+				raise ValueError(filename + " is no lookup file")
+			header = json.loads(f.readline().decode())
+			start = f.tell()
+			mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+		sizes = set(struct.unpack_from("<{}Q".format(header["sizes"]), mapped, start))
+		start += 8 * header["sizes"]
+		view = memoryview(mapped)
+		lookup = cls(sizes, view[start:start + header["bloom"]],
+						view[start + header["bloom"]:start + header["bloom"] + header["keys"] * _KEY_SIZE], header["indexfiles"])
+		lookup._mmap, lookup._view = mapped, view
+		return lookup
+
+
+	def might_contain(self, key):
+		'''return False, if the key is certainly not in the index'''
+
+		bloom = self.bloom
+		return all(bloom[bit >> 3] & (1 << (bit & 7)) for bit in _probes(key, self._buckets))
+
+
+	def contains(self, key):
+		'''return True, if the key is in the index (binary search in the sorted keys)'''
+
+		keys = self.keys
+		lo, hi = 0, len(keys) // _KEY_SIZE
+		while lo < hi:
+			mid = (lo + hi) // 2
+			other = bytes(keys[mid * _KEY_SIZE:(mid + 1) * _KEY_SIZE])
+			if other < key:
+				lo = mid + 1
+			elif other > key:
+				hi = mid
+			else:
+				return True
+		return False
+
+
+	def locate(self, keys, verbosity=1):
+		'''return a dict {key: [paths as written in the index]} of the given keys'''
+
+		locations = {}
+		if not keys:
+			return locations
+		if verbosity >= 1:
+			print("locating " + str(len(keys)) + " files in the index...")
+		for file in _expand_indexfiles(self.indexfiles):
+			with open_indexfile(file) as f:
+				for line in f:
+					if line[0] == '#':
+						continue
+					size, mtime, checksum, path = line.rstrip('\n').split('\t', 3)
+					key = _key(int(size), checksum.strip().partition(':')[0])
+					if key in keys:
+						locations.setdefault(key, []).append(path)
+		return locations
+
+
+	def close(self):
+		if self._mmap:
+			for view in [self.bloom, self.keys, self._view]:		# mmap can't be closed while views exist
+				view.release()
+			self._mmap.close()
+			self._mmap = None
+
+
+
+def open_lookup_filter(filename=None, indexfiles=None, verbosity=1):
+	""" return the LookupFilter of the lookup file 'filename'. if 'indexfiles' are
+	given and the lookup file is missing, older than one of them or was built from
+	other indexfiles, build the filter from the indexfiles and save it to 'filename'
+	(if given)"""
+
+	if filename and os.path.exists(filename):
+		if not indexfiles:
+			return LookupFilter.load(filename)
+		if all(os.path.getmtime(file) <= os.path.getmtime(filename) for file in _expand_indexfiles(indexfiles)):
+			lookup = LookupFilter.load(filename)
+			if lookup.indexfiles == [os.path.abspath(file) for file in indexfiles]:
+				return lookup
+			lookup.close()
+	if not indexfiles:
+		raise ValueError("neither a lookup file nor index files given")
+
+	if verbosity >= 1:
+		print("building the lookup filter...")
+	with metrics.stage("build_lookup_filter", verbosity):
+		lookup = LookupFilter.build(indexfiles, verbosity)
+	if filename:
+		lookup.save(filename)
+	return lookup
+
+
+def _lookup_candidates(paths, exclude=[], exclude_pattern=[], verbosity=1):
+	""" yield (fullname, stat result) of the files 'paths' and of the files in the dirs 'paths' """
+
+	for path in paths:
+		if os.path.isdir(path):
+			yield from _index_candidates([path], exclude=exclude, exclude_pattern=exclude_pattern, verbosity=verbosity - 1)
+		elif os.path.isfile(path) and not os.path.islink(path):
+			yield path, os.stat(path)
+
+
+def lookup_files(paths, outfile, lookup, exclude=[], exclude_pattern=[], errorfile=None, locations=True, bwlimit=None, nocache=False, verbosity=1):
+	""" look up the files 'paths' and the files in the dirs 'paths' in the LookupFilter 'lookup'
+	and write one line per file to 'outfile': 'new' or 'exists', a tab and the path.
+	with 'locations' the lines of existing files are followed by the paths of their copies
+	in the index, each starting with a tab. those are found by reading the indexfiles
+	once at the end, so existing files are written last then.
+	files with a size, that doesn't occur in the index, are not read at all. the other
+	ones are hashed (see _gethash for 'bwlimit' and 'nocache'), a negative answer of the
+	bloom filter is certain, a positive one is checked in the sorted keys"""
+
+	hashargs = {"limiter": _RateLimiter(bwlimit) if bwlimit else None, "nocache": nocache}
+	found = []		# (fullname, key) of the existing files, if they are located
+	new = existing = 0
+
+	for fullname, fstats in _lookup_candidates(paths, exclude, exclude_pattern, verbosity):
+		metrics.count("files_looked_up")
+		if fstats.st_size not in lookup.sizes:
+			metrics.count("lookups_skipped_by_size")
+			key = None
+		else:
+			checksum = _hash_candidate(fullname, fstats, {}, errorfile, **hashargs)
+			if checksum is None:
+				continue
+			key = _key(fstats.st_size, checksum)
+			if not lookup.might_contain(key):
+				key = None
+			elif not lookup.contains(key):
+				metrics.count("bloom_false_positives")
+				key = None
+
+		if key is None:
+			new += 1
+			outfile.write("new\t" + fullname + '\n')
+		else:
+			existing += 1
+			if locations:
+				found.append((fullname, key))
+			else:
+				outfile.write("exists\t" + fullname + '\n')
+
+	if found:
+		located = lookup.locate({key for fullname, key in found}, verbosity)
+		for fullname, key in found:
+			outfile.write("exists\t" + fullname + '\n' + ''.join('\t' + path + '\n' for path in located.get(key, [])))
+
+	if verbosity >= 1:
+		print(str(new) + " new files, " + str(existing) + " already stored")
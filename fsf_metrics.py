@@ -0,0 +1,160 @@
+# FindSimilarFolders: find duplicate files and folders, that contain many of them
+# Copyright (C) 2015  Johannes König
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# instrumentation: stage timers, counters and memory usage of a run.
+# fsf_core records into the module level object 'metrics', fsf.py
+# configures it and writes it as JSON or Prometheus textfile at the end
+
+
+import contextlib
+import cProfile
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+try:
+	import resource		# not on windows, the peak memory is reported as 0 there
+except ImportError:
+	resource = None
+
+
+def _peak_rss():
+	'''return the peak resident set size of this process in bytes (0, if unknown)'''
+
+	if resource is None:
+		return 0
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024		# linux reports KiB
+
+
+class Metrics(object):
+	'''collect the wall and CPU time of named stages, counters and the peak memory.
+	stages and counters are created on first use'''
+
+	def __init__(self):
+		self.stages = {}		# name: {"wall": s, "cpu": s, "calls": n, "peak_rss": bytes}
+		self.counters = {}		# name: value
+		self._lock = threading.Lock()
+		self._traced_peaks = []		# peak of the traced memory of each open stage before the last reset, innermost last
+		self._profile = None
+		self._profile_file = None
+
+
+	def configure(self, profile_file=None, trace_memory=False):
+		'''reset all values. with 'profile_file' run cProfile until close()
+		and dump its stats to the file. with 'trace_memory' trace the memory allocations of python (slow),
+		then each stage reports the peak of the traced memory, too'''
+
+		self.__init__()
+		if trace_memory:
+			tracemalloc.start()
+		if profile_file:
+			self._profile_file = profile_file
+			self._profile = cProfile.Profile()
+			self._profile.enable()
+
+
+	def count(self, name, value=1):
+		'''add 'value' to the counter 'name'. may be called from any thread'''
+
+		with self._lock:
+			self.counters[name] = self.counters.get(name, 0) + value
+
+
+	@contextlib.contextmanager
+	def stage(self, name, verbosity=1):
+		'''measure the block as stage 'name'. a stage entered several times sums up.
+		if verbosity >= 1, print its CPU time and the memory usage'''
+
+		if tracemalloc.is_tracing():		# reset_peak() drops the peak of the outer stage, so keep it
+			if self._traced_peaks:
+				self._traced_peaks[-1] = max(self._traced_peaks[-1], tracemalloc.get_traced_memory()[1])
+			self._traced_peaks.append(0)
+			tracemalloc.reset_peak()
+		wall, cpu = time.perf_counter(), time.process_time()
+		try:
+			yield
+		finally:
+			wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+			stage = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+			stage["wall"] += wall
+			stage["cpu"] += cpu
+			stage["calls"] += 1
+			stage["peak_rss"] = _peak_rss()
+			if tracemalloc.is_tracing() and self._traced_peaks:
+				peak = max(self._traced_peaks.pop(), tracemalloc.get_traced_memory()[1])
+				if self._traced_peaks:
+					self._traced_peaks[-1] = max(self._traced_peaks[-1], peak)
+				stage["traced_peak"] = max(stage.get("traced_peak", 0), peak)
+			if verbosity >= 1:
+				print("\033[93m" + name + ": " + str(round(cpu, 3)) + " s,  now " +
+						str(round(stage["peak_rss"] / 1024 / 1024)) + " MB\033[0m")
+
+
+	def peak_rss_mb(self):
+		'''return the peak resident set size so far in MB, for progress messages'''
+
+		return round(_peak_rss() / 1024 / 1024)
+
+
+	def as_dict(self):
+		return {"stages": self.stages, "counters": self.counters, "peak_rss": _peak_rss()}
+
+
+	def _prometheus(self):
+		lines = []
+		for key, metric in [("wall", "fsf_stage_wall_seconds"), ("cpu", "fsf_stage_cpu_seconds"), ("calls", "fsf_stage_calls"),
+							("peak_rss", "fsf_stage_peak_rss_bytes"), ("traced_peak", "fsf_stage_traced_peak_bytes")]:
+			lines.append("# TYPE " + metric + " gauge")
+			for name, stage in sorted(self.stages.items()):
+				if key in stage:
+					lines.append(metric + '{stage="' + name + '"} ' + str(stage[key]))
+		for name, value in sorted(self.counters.items()):
+			lines.append("# TYPE fsf_" + name + "_total counter")
+			lines.append("fsf_" + name + "_total " + str(value))
+		lines.append("# TYPE fsf_peak_rss_bytes gauge")
+		lines.append("fsf_peak_rss_bytes " + str(_peak_rss()))
+		return '\n'.join(lines) + '\n'
+
+
+	def write(self, filename):
+		'''write the metrics to 'filename': in the Prometheus text format, if it ends
+		with .prom, otherwise as JSON. the file is replaced atomically, so a collector
+		never reads a half written file'''
+
+		tmpfile = filename + ".tmp"
+		with open(tmpfile, 'w') as f:
+			if filename.endswith(".prom"):
+				f.write(self._prometheus())
+			else:
+				json.dump(self.as_dict(), f, indent=1)
+		os.replace(tmpfile, filename)
+
+
+	def close(self):
+		'''stop profiling and tracing started by configure()'''
+
+		if self._profile:
+			self._profile.disable()
+			self._profile.dump_stats(self._profile_file)
+			self._profile = None
+		if tracemalloc.is_tracing():
+			tracemalloc.stop()
+
+
+
+metrics = Metrics()
@@ -113,6 +113,18 @@ class FTree(object):
 		return self._parent
 
 
+	def get_path(self):
+		'''return the names of all nodes from the root (excluded)
+		down to this node (included) as tuple'''
+
+		path = []
+		node = self
+		while node.get_parent():
+			path.append(node.name)
+			node = node.get_parent()
+		return tuple(reversed(path))
+
+
 	def is_leaf(self):
 		return self.num_subfolders() == 0
 
@@ -199,10 +211,11 @@ class hpn(object):
 	size, so that it can later be replaced by a namedtuple again for
 	performance reasons. __eq__ and __ne__ are only used in tests'''
 
-	def __init__(self, hash, path, name, size=None):
+	def __init__(self, hash, path, name, size=None, inode=None):
 		self.hash = hash
 		self.path = path
 		self.filename = name
+		self.inode = inode		# 'device:inode' for files with several hard links, else None
 
 		if size != None:
 			self.size = size
@@ -220,6 +233,7 @@ class hpn(object):
 		if index==1: return self.path
 		if index==2: return self.filename
 		if index==3: return self.size
+		if index==4: return self.inode
 		raise IndexError
 
 	def __eq__(self, other):
@@ -275,6 +289,8 @@ class FTreeStat(FTree):
 		cargo.num_subfolders = 0
 		cargo.num_f_subfolders = 0
 		cargo.size_subfolders = 0
+		cargo.other_files = 0	# number and size of files in this folder, that are not in hashdict
+		cargo.other_size = 0	# (a folder summary lists only the files with copies)
 		for key, value in kwargs.items():
 			cargo.__dict__[key] = value
 
@@ -302,6 +318,26 @@ class FTreeStat(FTree):
 		self.cargo.dup_candidates.update(paths)
 
 
+	def add_other_files(self, num, size):
+		''' count 'num' files of 'size' bytes in total in this node, that are not
+		added by add_hash, as they have no copies'''
+
+		self.cargo.other_files += num
+		self.cargo.other_size += size
+
+
+	def num_files(self):
+		'''return the number of different files in this node'''
+
+		return len(self.cargo.hashdict) + self.cargo.other_files
+
+
+	def size_files(self):
+		'''return the size of the different files in this node'''
+
+		return sum(self.cargo.hashdict.values()) + self.cargo.other_size
+
+
 	def collect_stats_remove_uniques(self):
 		'''collect statistic information about the node and propagate it to
 		the parents. remove nodes, that are completely unique, as they are not
@@ -310,8 +346,8 @@ class FTreeStat(FTree):
 		if not self.get_parent():
 			return	# for the root node do nothing
 
-		size_f_this = sum(self.cargo.hashdict.values())
-		num_f_this = len(self.cargo.hashdict)
+		size_f_this = self.size_files()
+		num_f_this = self.num_files()
 		self.get_parent().cargo.num_subfolders += 1
 		self.get_parent().cargo.num_f_subfolders += self.cargo.num_f_subfolders + num_f_this
 		self.get_parent().cargo.size_subfolders  += self.cargo.size_subfolders + size_f_this
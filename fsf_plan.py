@@ -0,0 +1,272 @@
+# FindSimilarFolders: find duplicate files and folders, that contain many of them
+# Copyright (C) 2015  Johannes König
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# split the indexing of large trees into work units for several createIndex processes.
+# a quick scan of the metadata estimates the bytes of each subtree, subtrees larger
+# than a fair share are split into their subdirs, smaller ones are packed together
+# into units of several rootdirs. the files of a split dir itself are indexed by a unit
+# without subdirs (--no-subdirs), so the units don't overlap without excluding each
+# other. the units are distributed over the processes, largest first, each process
+# writes an index part of its own and the parts are merged into the index at the end
+
+
+import os
+import shlex
+import stat
+import subprocess
+import sys
+import threading
+
+from fsf_core import _walk, compact_index_file
+from fsf_metrics import metrics
+
+
+_FILE_COST = 64 * 1024		# opening a file takes about as long as reading that many bytes
+
+FSF = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fsf.py")
+
+
+class WorkUnit(object):
+	'''a part of the trees, that is indexed by one createIndex call: the 'rootdirs'
+	without the dirs 'exclude' (given by the user), with an estimated number of 'files'
+	and 'bytes'. without 'subdirs' only the files in the rootdirs themselves'''
+
+	def __init__(self, rootdirs, exclude=(), files=0, bytes=0, subdirs=True):
+		self.rootdirs = list(rootdirs)
+		self.exclude = list(exclude)
+		self.files = files
+		self.bytes = bytes
+		self.subdirs = subdirs
+
+
+	def cost(self):
+		return self.bytes + self.files * _FILE_COST
+
+
+	def __repr__(self):
+		return "WorkUnit({!r}, exclude={!r}, files={}, bytes={}, subdirs={})".format(self.rootdirs, self.exclude, self.files, self.bytes, self.subdirs)
+
+
+
+def _scan_tree(rootdir, exclude_ids, min_size=0, max_size=None, walkers=1):
+	""" stat the files below 'rootdir' and return {dir: [files, bytes, subdirs]} of the
+	dirs, that are indexed. dirs with a (device, inode) in 'exclude_ids' are skipped
+	(like createIndex does with --exclude-path). the files and bytes of a dir include
+	its subdirs"""
+
+	tree = {}
+	order = []
+	for root, dirs, files in _walk(rootdir, walkers):
+		if exclude_ids:
+			try:
+				st = os.stat(root)
+			except OSError:
+				st = None
+			if st and (st.st_dev, st.st_ino) in exclude_ids:
+				dirs.clear()
+				continue
+
+		num = size = 0
+		for name in files:
+			try:
+				st = os.lstat(os.path.join(root, name))
+			except OSError:
+				continue
+			if stat.S_ISREG(st.st_mode) and st.st_size >= min_size and (max_size is None or st.st_size <= max_size):
+				num += 1
+				size += st.st_size
+		tree[root] = [num, size, [os.path.join(root, name) for name in dirs]]
+		order.append(root)
+
+	for root in reversed(order):		# children before their parents
+		node = tree[root]
+		node[2] = [child for child in node[2] if child in tree]		# excluded or unreadable
+		for child in node[2]:
+			node[0] += tree[child][0]
+			node[1] += tree[child][1]
+	return tree
+
+
+def _split_tree(root, tree, target, units):
+	""" append the units of the subtree 'root' to 'units'. a subtree costing at most 'target'
+	is one unit. otherwise its subdirs costing more than 'target' are split recursively,
+	the others are packed into units of several rootdirs (first fit), and the files of
+	'root' itself are a unit without subdirs. so no unit has to exclude another one """
+
+	def cost(path):
+		return tree[path][1] + tree[path][0] * _FILE_COST
+
+	files, bytes, children = tree[root]
+	if cost(root) <= target:
+		if files:
+			units.append(WorkUnit([root], files=files, bytes=bytes))
+		return
+
+	own = WorkUnit([root], files=files, bytes=bytes, subdirs=False)
+	packed = []
+	for child in sorted(children, key=cost, reverse=True):
+		own.files -= tree[child][0]
+		own.bytes -= tree[child][1]
+		if cost(child) > target:
+			_split_tree(child, tree, target, units)
+			continue
+		if not tree[child][0]:
+			continue		# nothing to index
+		for unit in packed:
+			if unit.cost() + cost(child) <= target:
+				break
+		else:
+			unit = WorkUnit([])
+			packed.append(unit)
+		unit.rootdirs.append(child)
+		unit.files += tree[child][0]
+		unit.bytes += tree[child][1]
+
+	if own.files:
+		units.append(own)
+	units.extend(packed)
+
+
+def _is_below(path, dirs):
+	path = os.path.realpath(path)
+	return any(os.path.commonpath([path, os.path.realpath(dir)]) == os.path.realpath(dir) for dir in dirs)
+
+
+def plan_index(rootdirs, processes, exclude=[], min_size=0, max_size=None, units_per_process=4, walkers=1, verbosity=1):
+	""" scan the metadata of the trees 'rootdirs' and split them into WorkUnits for
+	'processes' createIndex processes. subtrees are split, until no unit costs more than
+	1/'units_per_process' of the share of a process (the files of a single dir can't be
+	split further). the cost of a unit are its bytes and 64K per file.
+	return a list of the units of each process, the units are assigned largest first
+	to the process with the least work so far (LPT). the units don't overlap, each one
+	keeps the 'exclude' paths, that lie in its trees.
+	'exclude', 'min_size' and 'max_size' are like in create_index"""
+
+	exclude = exclude or []
+	exclude_ids = set()
+	for path in exclude:
+		try:
+			st = os.stat(path)
+		except OSError:
+			continue
+		exclude_ids.add((st.st_dev, st.st_ino))
+
+	with metrics.stage("scan_trees", verbosity):
+		trees = []
+		for rootdir in rootdirs:
+			if verbosity >= 1:
+				print("scanning " + rootdir)
+			trees.append((rootdir, _scan_tree(rootdir, exclude_ids, min_size, max_size, walkers)))
+
+	total = sum(tree[rootdir][1] + tree[rootdir][0] * _FILE_COST for rootdir, tree in trees if rootdir in tree)
+	target = max(1, total // (processes * units_per_process))
+
+	units = []
+	for rootdir, tree in trees:
+		if rootdir in tree:
+			_split_tree(rootdir, tree, target, units)
+	for unit in units:
+		if unit.subdirs:
+			unit.exclude += [path for path in exclude if _is_below(path, unit.rootdirs)]
+	metrics.count("work_units", len(units))
+
+	plan = [[] for i in range(processes)]
+	loads = [0] * processes
+	for unit in sorted(units, key=WorkUnit.cost, reverse=True):
+		i = loads.index(min(loads))
+		plan[i].append(unit)
+		loads[i] += unit.cost()
+
+	if verbosity >= 1:
+		for i, process in enumerate(plan):
+			print("process {}: {} units, {} files, {:.1f} MB".format(i, len(process),
+						sum(unit.files for unit in process), sum(unit.bytes for unit in process) / 1024**2))
+	return [process for process in plan if process]
+
+
+def part_filename(index_file, i):
+	""" return the name of the index part of process 'i' (keeps the extension, so the part is compressed like the index) """
+
+	root, ext = os.path.splitext(index_file)
+	return root + ".part" + str(i) + ext
+
+
+def index_commands(plan, index_file, options=()):
+	""" return the createIndex commands (argument lists) of each process of the 'plan'.
+	'options' are added to each command, e.g. ["-R", "base", "-E", "*.tmp"] """
+
+	commands = []
+	for i, process in enumerate(plan):
+		commands.append([])
+		for unit in process:
+			command = [sys.executable, FSF, "createIndex"] + unit.rootdirs + [part_filename(index_file, i)] + list(options)
+			if not unit.subdirs:
+				command.append("--no-subdirs")
+			if unit.exclude:
+				command += ["--exclude-path"] + unit.exclude
+			commands[-1].append(command)
+	return commands
+
+
+def write_script(plan, index_file, outfile, options=(), sort="path"):
+	""" write a shell script to 'outfile', that runs the processes of the 'plan' in the background
+	and merges the parts into 'index_file' (sorted by 'sort', see compact_index) when all are done """
+
+	outfile.write("#!/bin/sh\n")
+	parts = [part_filename(index_file, i) for i in range(len(plan))]
+	for commands in index_commands(plan, index_file, options):
+		outfile.write("( " + " &&\n  ".join(shlex.join(command) for command in commands) + " ) &\n")
+	outfile.write("wait\n")
+	outfile.write("set -- " + " ".join(shlex.quote(part) for part in parts) + "\n")
+	outfile.write("[ -e {0} ] && set -- {0} \"$@\"\n".format(shlex.quote(index_file)))		# add to an existing index
+	outfile.write(shlex.join([sys.executable, FSF, "compactIndex"]) + ' "$@" ' + shlex.join([index_file, "--sort", sort]) + " &&\n")
+	outfile.write("rm -f " + " ".join(shlex.quote(part) for part in parts) + "\n")
+
+
+def run_plan(plan, index_file, options=(), sort="path", verbosity=1):
+	""" run the processes of the 'plan' and merge their parts into 'index_file' (new entries are
+	added to an existing index). return False, if a process failed. the parts are kept then,
+	they can be merged with compactIndex after the failed units were indexed again"""
+
+	failed = []
+	def run(commands):
+		for command in commands:
+			if verbosity >= 2:
+				print(shlex.join(command))
+			if subprocess.run(command, stdout=None if verbosity >= 2 else subprocess.DEVNULL).returncode != 0:
+				failed.append(command)
+				return
+
+	with metrics.stage("run_processes", verbosity):
+		threads = [threading.Thread(target=run, args=(commands,)) for commands in index_commands(plan, index_file, options)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+
+	parts = [part_filename(index_file, i) for i in range(len(plan))]
+	if failed:
+		for command in failed:
+			print("\033[91mfailed: " + shlex.join(command) + "\033[0m")
+		return False
+
+	with metrics.stage("merge_parts", verbosity):
+		existing = [index_file] if os.path.exists(index_file) else []
+		compact_index_file(existing + [part for part in parts if os.path.exists(part)], index_file, sort=sort, verbosity=verbosity)
+	for part in parts:
+		if os.path.exists(part):
+			os.remove(part)
+	return True
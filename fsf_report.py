@@ -0,0 +1,329 @@
+# FindSimilarFolders: find duplicate files and folders, that contain many of them
+# Copyright (C) 2015  Johannes König
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# writers for the reports of the analysis commands.
+# records are formatted into a batch and written to the outfile in one go.
+# the sqlite writer stores the records in tables instead
+
+
+import contextlib
+import csv
+import json
+import os
+import pathlib
+import sqlite3
+
+
+class ReportWriter(object):
+	'''base class of the report writers. subclasses implement _format_group(),
+	_format_folders() and _format_tree_folder(), which return the formatted record as string'''
+
+	def __init__(self, outfile, verbosity=1, batchsize=1000):
+		self.outfile = outfile
+		self.verbosity = verbosity
+		self.batchsize = batchsize
+		self._batch = []
+		self._console = []		# what to print at the current verbosity
+		self._paths = {}		# cache: path tuple -> joined path
+
+
+	def _path(self, path):
+		'''return the path tuple joined to a string. each folder is joined only once'''
+
+		joined = self._paths.get(path)
+		if joined is None:
+			if len(self._paths) >= 65536:
+				self._paths.clear()
+			joined = self._paths[path] = str(pathlib.PurePath(*path))
+		return joined
+
+
+	def _emit(self, record, console=None):
+		self._batch.append(record)
+		if self.verbosity >= 3:
+			self._console.append(record)
+		elif console:
+			self._console.append(console)
+		if len(self._batch) >= self.batchsize:
+			self.flush()
+
+
+	def write_group(self, group, wasted=None):
+		'''write one group of duplicate files. 'group' is a list of members, each member
+		is a list of hpn objects of the hard links of one file (see _iter_duplicate_groups).
+		'wasted' is the reclaimable space of the group, if it shall be reported'''
+
+		self._emit(self._format_group(group, wasted))
+
+
+	def write_folders(self, paths, files):
+		'''write one set of folders with identical files. 'paths' is a list of the path
+		tuples of the folders, 'files' a list of tuples of the names of identical files,
+		one name per folder'''
+
+		self._emit(self._format_folders(paths, files),
+					''.join(self._path(path) + '\n' for path in paths) if self.verbosity == 2 else None)
+
+
+	def write_tree_folder(self, path, num_files, size, candidates):
+		'''write one folder of the tree of similarTrees: its path tuple, the number and
+		size of the files in it and the path tuples of the folders with the same files'''
+
+		self._emit(self._format_tree_folder(path, num_files, size, candidates),
+					self._path(path) if self.verbosity == 2 else None)
+
+
+	def flush(self):
+		if self._batch:
+			self.outfile.write(''.join(self._batch))
+			self._batch.clear()
+		if self._console:
+			print('\n'.join(self._console))
+			self._console.clear()
+
+
+	def close(self):
+		self.flush()
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+
+class TextReportWriter(ReportWriter):
+	'''the original block layouts, see README.md'''
+
+	def _format_group(self, group, wasted=None):
+		line = '\n' + group[0][0].hash + ('\t' + str(wasted) if wasted is not None else '') + '\n'
+		for member in group:
+			line += member[0].filename + '\t' + self._path(member[0].path) + '\n'
+			for link in member[1:]:		# further hard links of the same file start with a tab
+				line += '\t' + link.filename + '\t' + self._path(link.path) + '\n'
+		return line
+
+
+	def _format_folders(self, paths, files):
+		return (''.join(self._path(path) + '\n' for path in paths)
+				+ "--------\n"
+				+ ''.join('\t'.join(names) + '\n' for names in files)
+				+ '\n')
+
+
+	def _format_tree_folder(self, path, num_files, size, candidates):
+		return (self._path(path) + '\t' + str(num_files) + '\t' + str(size) + '\n'
+				+ "--------\n"
+				+ ''.join(self._path(candidate) + '\n' for candidate in candidates)
+				+ '\n')
+
+
+
+class JsonLinesReportWriter(ReportWriter):
+	'''one JSON object per line'''
+
+	def _format_group(self, group, wasted=None):
+		size, checksum = group[0][0].hash.split(' ', 1)
+		record = {"size": int(size), "hash": checksum, "files": []}
+		if wasted is not None:
+			record["reclaimable"] = wasted
+		for member in group:
+			entry = {"name": member[0].filename, "path": self._path(member[0].path)}
+			if len(member) > 1:
+				entry["links"] = [{"name": link.filename, "path": self._path(link.path)} for link in member[1:]]
+			record["files"].append(entry)
+		return json.dumps(record) + '\n'
+
+
+	def _format_folders(self, paths, files):
+		return json.dumps({"folders": [self._path(path) for path in paths], "files": files}) + '\n'
+
+
+	def _format_tree_folder(self, path, num_files, size, candidates):
+		return json.dumps({"folder": self._path(path), "files": num_files, "size": size,
+							"candidates": [self._path(candidate) for candidate in candidates]}) + '\n'
+
+
+
+class CsvReportWriter(ReportWriter):
+	'''one line per file. duplicates: group, size, hash, reclaimable, name, path, link
+	(link is 1 for further hard links of the file in the line before).
+	folders: group, then folder and name for each folder'''
+
+	def __init__(self, outfile, verbosity=1, batchsize=1000):
+		super().__init__(outfile, verbosity, batchsize)
+		self._csv = csv.writer(self, lineterminator='\n')	# the csv module writes to self.write
+		self._rows = []
+		self._groups = 0
+
+
+	def write(self, string):
+		self._rows.append(string)
+
+
+	def _format(self, header, rows):
+		if self._groups == 0:
+			self._csv.writerow(header)
+		self._groups += 1
+		self._csv.writerows(rows)
+		record = ''.join(self._rows)
+		self._rows.clear()
+		return record
+
+
+	def _format_group(self, group, wasted=None):
+		size, checksum = group[0][0].hash.split(' ', 1)
+		rows = []
+		for member in group:
+			for i, entry in enumerate(member):
+				rows.append([self._groups, size, checksum, '' if wasted is None else wasted,
+								entry.filename, self._path(entry.path), int(i > 0)])
+		return self._format(["group", "size", "hash", "reclaimable", "name", "path", "link"], rows)
+
+
+	def _format_folders(self, paths, files):
+		folders = [self._path(path) for path in paths]
+		header = ["group"]
+		for i in range(len(paths)):
+			header += ["folder" + str(i + 1), "name" + str(i + 1)]
+		return self._format(header, [[self._groups] + [i for pair in zip(folders, names) for i in pair] for names in files])
+
+
+	def _format_tree_folder(self, path, num_files, size, candidates):
+		return self._format(["group", "folder", "files", "size", "candidate"],
+							[[self._groups, self._path(path), num_files, size, self._path(candidate)] for candidate in candidates])
+
+
+
+class SqliteReportWriter(ReportWriter):
+	'''store the records in a sqlite database. 'outfile' is a sqlite3 connection (see open_report).
+	tables:
+		groups(id, size, hash, reclaimable)				groups of duplicate files
+		files(group_id, name, path, inode)				the files of the groups
+		folder_pairs(id, folder1, folder2, files)		pairs of folders with identical files
+		pair_files(pair_id, name1, name2)				the identical files of the pairs
+		tree_folders(id, folder, files, size)			folders of similarTrees
+		tree_candidates(folder_id, candidate)			folders with files of the same content'''
+
+	_SCHEMA = '''
+		CREATE TABLE IF NOT EXISTS groups(id INTEGER PRIMARY KEY, size INTEGER, hash TEXT, reclaimable INTEGER);
+		CREATE TABLE IF NOT EXISTS files(group_id INTEGER, name TEXT, path TEXT, inode TEXT);
+		CREATE TABLE IF NOT EXISTS folder_pairs(id INTEGER PRIMARY KEY, folder1 TEXT, folder2 TEXT, files INTEGER);
+		CREATE TABLE IF NOT EXISTS pair_files(pair_id INTEGER, name1 TEXT, name2 TEXT);
+		CREATE TABLE IF NOT EXISTS tree_folders(id INTEGER PRIMARY KEY, folder TEXT, files INTEGER, size INTEGER);
+		CREATE TABLE IF NOT EXISTS tree_candidates(folder_id INTEGER, candidate TEXT);
+		'''
+
+	_INDEXES = '''
+		CREATE INDEX IF NOT EXISTS groups_reclaimable ON groups(reclaimable);
+		CREATE INDEX IF NOT EXISTS groups_hash ON groups(hash);
+		CREATE INDEX IF NOT EXISTS files_group ON files(group_id);
+		CREATE INDEX IF NOT EXISTS files_path ON files(path);
+		CREATE INDEX IF NOT EXISTS pairs_folder1 ON folder_pairs(folder1);
+		CREATE INDEX IF NOT EXISTS pairs_folder2 ON folder_pairs(folder2);
+		CREATE INDEX IF NOT EXISTS pair_files_pair ON pair_files(pair_id);
+		CREATE INDEX IF NOT EXISTS tree_folders_folder ON tree_folders(folder);
+		CREATE INDEX IF NOT EXISTS tree_candidates_folder ON tree_candidates(folder_id);
+		'''
+
+	def __init__(self, outfile, verbosity=1, batchsize=10000):
+		super().__init__(outfile, verbosity, batchsize)
+		outfile.executescript(self._SCHEMA)
+		self._ids = {table: outfile.execute("SELECT COALESCE(MAX(id), 0) FROM " + table).fetchone()[0]
+						for table in ("groups", "folder_pairs", "tree_folders")}
+		self._rows = {}		# table: list of rows of the current batch
+
+
+	def _next_id(self, table):
+		self._ids[table] += 1
+		return self._ids[table]
+
+
+	def _add_rows(self, table, rows):
+		self._rows.setdefault(table, []).extend(rows)
+
+
+	def write_group(self, group, wasted=None):
+		size, checksum = group[0][0].hash.split(' ', 1)
+		group_id = self._next_id("groups")
+		self._add_rows("groups", [(group_id, int(size), checksum, (len(group) - 1) * group[0][0].size)])
+		self._add_rows("files", [(group_id, entry.filename, self._path(entry.path), entry.inode)
+									for member in group for entry in member])
+		self._emit(group_id)
+
+
+	def write_folders(self, paths, files):
+		for i in range(len(paths)):			# sets of more than two folders are stored pairwise
+			for j in range(i + 1, len(paths)):
+				pair_id = self._next_id("folder_pairs")
+				self._add_rows("folder_pairs", [(pair_id, self._path(paths[i]), self._path(paths[j]), len(files))])
+				self._add_rows("pair_files", [(pair_id, names[i], names[j]) for names in files])
+		self._emit(paths)
+
+
+	def write_tree_folder(self, path, num_files, size, candidates):
+		folder_id = self._next_id("tree_folders")
+		self._add_rows("tree_folders", [(folder_id, self._path(path), num_files, size)])
+		self._add_rows("tree_candidates", [(folder_id, self._path(candidate)) for candidate in candidates])
+		self._emit(path)
+
+
+	def flush(self):
+		for table, rows in self._rows.items():
+			if rows:
+				self.outfile.executemany("INSERT INTO " + table + " VALUES (" + ", ".join("?" * len(rows[0])) + ")", rows)
+				rows.clear()
+		self._batch.clear()
+		self._console.clear()
+
+
+	def close(self):
+		self.flush()
+		self.outfile.executescript(self._INDEXES)
+		self.outfile.commit()
+
+
+
+REPORT_FORMATS = {
+	"text": TextReportWriter,
+	"jsonl": JsonLinesReportWriter,
+	"ndjson": JsonLinesReportWriter,
+	"csv": CsvReportWriter,
+	"sqlite": SqliteReportWriter,
+}
+
+def report_writer(outfile, fmt="text", verbosity=1, batchsize=None):
+	'''return a report writer for the format 'fmt' writing to 'outfile'.
+	'batchsize' overrides the number of records written at once'''
+
+	if batchsize:
+		return REPORT_FORMATS[fmt](outfile, verbosity, batchsize)
+	return REPORT_FORMATS[fmt](outfile, verbosity)
+
+
+def open_report(filename, fmt="text", buffering=-1):
+	'''open the file 'filename' for a report in the format 'fmt'.
+	return a file object or, for sqlite, a connection to a new database.
+	use it as context manager, it closes the file or connection'''
+
+	if fmt == "sqlite":
+		if os.path.exists(filename):
+			os.remove(filename)
+		return contextlib.closing(sqlite3.connect(filename))
+	return open(filename, 'w', buffering=buffering)
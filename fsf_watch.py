@@ -0,0 +1,459 @@
+# FindSimilarFolders: find duplicate files and folders, that contain many of them
+# Copyright (C) 2015  Johannes König
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# keep an index up to date: watch the indexed trees with inotify (or by polling
+# the mtimes of the directories, where inotify is not available) and append
+# the new checksums of changed files to the index. the index is compacted
+# from time to time to drop the outdated lines
+
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import pathlib
+import select
+import stat
+import struct
+
+from time import monotonic, sleep
+
+from fsf_core import open_indexfile, compact_index_file, _is_sorted_index, _hash_candidate, _format_index_line, _RateLimiter
+from fsf_metrics import metrics
+
+
+# inotify events, see inotify(7)
+IN_ATTRIB		= 0x00000004
+IN_CLOSE_WRITE	= 0x00000008
+IN_MOVED_FROM	= 0x00000040
+IN_MOVED_TO		= 0x00000080
+IN_CREATE		= 0x00000100
+IN_DELETE		= 0x00000200
+IN_DELETE_SELF	= 0x00000400
+IN_MOVE_SELF	= 0x00000800
+IN_Q_OVERFLOW	= 0x00004000
+IN_IGNORED		= 0x00008000
+IN_ONLYDIR		= 0x01000000
+IN_DONT_FOLLOW	= 0x02000000
+IN_ISDIR		= 0x40000000
+
+_WATCH_MASK = (IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+				| IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW)
+_EVENT = struct.Struct("iIII")		# wd, mask, cookie, length of the name
+
+
+class _Inotify(object):
+	'''the inotify interface of linux, called by ctypes.
+	raises OSError, if it is not available'''
+
+	def __init__(self):
+		try:
+			self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+			init = self._libc.inotify_init1
+		except (OSError, AttributeError):
+			raise OSError(errno.ENOSYS, "inotify is not available")
+		self.fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+		self._paths = {}		# wd: path of the watched directory
+
+
+	def add_watch(self, path):
+		wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), _WATCH_MASK)
+		if wd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_add_watch failed", path)
+		self._paths[wd] = path
+
+
+	def read(self, timeout):
+		'''wait up to 'timeout' seconds for events and return them as list of
+		(mask, cookie, path of the directory, name)'''
+
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return []
+		try:
+			data = os.read(self.fd, 1024*1024)
+		except BlockingIOError:
+			return []
+
+		events = []
+		pos = 0
+		while pos < len(data):
+			wd, mask, cookie, length = _EVENT.unpack_from(data, pos)
+			pos += _EVENT.size
+			name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+			pos += length
+			events.append((mask, cookie, self._paths.get(wd), name))
+			if mask & IN_IGNORED:		# the watch was removed (the dir was deleted or moved away)
+				self._paths.pop(wd, None)
+		return events
+
+
+	def close(self):
+		os.close(self.fd)
+
+
+
+class _Poller(object):
+	'''the fallback for directories, that inotify can't watch: remember the mtime of
+	the directories and report the changed ones. the mtime of a directory changes, when
+	files are created, deleted or renamed in it, but not, when a file is modified in place'''
+
+	def __init__(self):
+		self._mtimes = {}		# path: mtime
+
+
+	def add_watch(self, path):
+		try:
+			self._mtimes[path] = os.stat(path).st_mtime_ns
+		except OSError:
+			pass
+
+
+	def changed(self):
+		'''return the watched directories, that changed or disappeared'''
+
+		changed = []
+		for path, mtime in list(self._mtimes.items()):
+			try:
+				new = os.stat(path).st_mtime_ns
+			except OSError:
+				del self._mtimes[path]
+				changed.append(path)
+				continue
+			if new != mtime:
+				self._mtimes[path] = new
+				changed.append(path)
+		return changed
+
+
+	def __len__(self):
+		return len(self._mtimes)
+
+
+	def __contains__(self, path):
+		return path in self._mtimes
+
+
+
+class IndexWatcher(object):
+	'''keep the index 'indexfile' of the 'rootdirs' up to date (see watch_index)'''
+
+	def __init__(self, indexfile, rootdirs, rel_to=None, exclude=[], exclude_pattern=[], errorfile=None,
+					poll=False, poll_interval=60, batchsize=1000, flush_interval=10, compact_interval=3600,
+					verbosity=1, bwlimit=None, nocache=False):
+		self.indexfile = indexfile
+		self.rootdirs = [os.path.normpath(rootdir) for rootdir in rootdirs]
+		self.rel_to = rel_to
+		self.exclude = [os.path.realpath(path) for path in exclude or []]
+		self.exclude_pattern = exclude_pattern or []
+		self.errorfile = errorfile
+		self.poll_interval = poll_interval
+		self.batchsize = batchsize
+		self.flush_interval = flush_interval
+		self.compact_interval = compact_interval
+		self.verbosity = verbosity
+		self.hashargs = {"limiter": _RateLimiter(bwlimit) if bwlimit else None, "nocache": nocache}
+
+		self._files = {}		# absolute dir: {name: (size, mtime, checksum, path in the index)} of the indexed files
+		self._created = set()	# files created, but not closed yet
+		self._lines = []		# lines to append to the index
+		self._deleted = set()	# index paths of deleted files, dropped at the next compaction
+		self._appended = 0		# lines appended since the last compaction
+		self._moved = {}		# cookie of IN_MOVED_FROM: old path
+		self._visited = None	# dirs scanned by sync()
+		self._sort = "path"		# order of the index (see compact_index), "hash" if it was sorted by checksum
+
+		self._inotify = None
+		if not poll:
+			try:
+				self._inotify = _Inotify()
+			except OSError as e:
+				print("\033[94minotify not available (" + str(e) + "), polling the directories\033[0m")
+		self._poller = _Poller()
+
+
+	def _entry(self, fullname):
+		'''return the dict of the files in the dir of 'fullname' and its name'''
+
+		dirname, name = os.path.split(os.path.abspath(fullname))
+		return self._files.setdefault(dirname, {}), name
+
+
+	def _excluded(self, fullname, is_dir):
+		if is_dir:
+			return os.path.realpath(fullname) in self.exclude
+		return any(pathlib.Path(fullname).match(pattern) for pattern in self.exclude_pattern)
+
+
+	def load(self):
+		'''read the entries of the index below the rootdirs'''
+
+		if self.verbosity >= 1:
+			print("reading " + self.indexfile + "...")
+		if not os.path.exists(self.indexfile):
+			return
+		if _is_sorted_index(self.indexfile, complete=False):		# even if lines were appended since
+			self._sort = "hash"
+		with open_indexfile(self.indexfile) as f:
+			for line in f:
+				if line[0] == '#':
+					continue
+				size, mtime, checksum, path = line.rstrip('\n').split('\t', 3)
+				fullname = os.path.abspath(os.path.join(self.rel_to, path) if self.rel_to != None else path)
+				if not any(fullname.startswith(os.path.join(os.path.abspath(rootdir), "")) for rootdir in self.rootdirs):
+					continue
+				files, name = self._entry(fullname)
+				files[name] = (int(size), mtime.strip(), checksum, path)
+
+
+	def _watch(self, path):
+		if self._inotify:
+			try:
+				self._inotify.add_watch(path)
+				return
+			except OSError as e:
+				if e.errno != errno.ENOSPC:
+					return		# e.g. the dir is gone already
+				if self.verbosity >= 1:
+					print("\033[94mno inotify watch left (see fs.inotify.max_user_watches), polling " + path + "\033[0m")
+		self._poller.add_watch(path)
+
+
+	def _index_file(self, fullname, old=None):
+		'''index the file 'fullname', if it is new or changed. if it was moved from 'old'
+		and did not change, its checksum is taken over without reading it'''
+
+		try:
+			fstats = os.lstat(fullname)
+		except OSError:
+			self._remove(fullname)
+			return
+		if not stat.S_ISREG(fstats.st_mode) or self._excluded(fullname, False):		# don't resolve links
+			return
+
+		files, name = self._entry(fullname)
+		mtime = "{:.4f}".format(fstats.st_mtime)
+		known = files.get(name)
+		if known and known[:2] == (fstats.st_size, mtime):
+			return
+		# keep the path of a known file as it is written in the index, so the new line replaces the old one
+		path = known[3] if known else os.path.relpath(fullname, self.rel_to) if self.rel_to != None else fullname
+		if old:
+			oldfiles, oldname = self._entry(old)
+			known = oldfiles.get(oldname)
+		if known and known[:2] == (fstats.st_size, mtime):
+			checksum = known[2].partition(':')[0]
+		else:
+			checksum = _hash_candidate(fullname, fstats, {}, self.errorfile, **self.hashargs)	# {}: hard links may have changed
+			if checksum is None:
+				return
+
+		line = _format_index_line(path, fstats, checksum, 13)
+		files[name] = (fstats.st_size, mtime, line.split('\t')[2], path)
+		self._deleted.discard(path)
+		self._lines.append(line + '\n')
+		metrics.count("files_reindexed")
+		if self.verbosity >= 2:
+			print(fullname)
+
+
+	def _remove(self, fullname):
+		'''forget the file or directory tree 'fullname' '''
+
+		fullname = os.path.abspath(fullname)
+		files, name = self._entry(fullname)
+		known = files.pop(name, None)
+		if known:
+			self._deleted.add(known[3])
+		prefix = fullname + os.sep
+		for dirname in [dirname for dirname in self._files if dirname == fullname or dirname.startswith(prefix)]:
+			for known in self._files.pop(dirname).values():
+				self._deleted.add(known[3])
+
+
+	def _scan_dir(self, path, old=None, recursive=True):
+		'''watch the directory 'path' and index its new and changed files, forget the files
+		that disappeared. 'old' is the previous path of a moved directory'''
+
+		if self._visited is not None:
+			self._visited.add(os.path.abspath(path))
+		if self._excluded(path, True):
+			return
+		self._watch(path)
+		try:
+			with os.scandir(path) as it:
+				entries = list(it)
+		except OSError:
+			self._remove(path)
+			return
+
+		names = set()
+		for entry in entries:
+			names.add(entry.name)
+			fullname = os.path.join(path, entry.name)
+			oldname = os.path.join(old, entry.name) if old else None
+			if entry.is_dir(follow_symlinks=False):
+				if recursive or fullname not in self._poller:		# new dirs are scanned completely
+					self._scan_dir(fullname, oldname)
+			else:
+				self._index_file(fullname, oldname)
+
+		for name in set(self._files.get(os.path.abspath(path), {})) - names:
+			self._remove(os.path.join(path, name))
+		if not recursive:		# subdirs, that are gone (sync() finds them by the dirs it didn't visit)
+			prefix = os.path.join(os.path.abspath(path), "")
+			for name in {dirname[len(prefix):].split(os.sep, 1)[0] for dirname in self._files if dirname.startswith(prefix)} - names:
+				self._remove(os.path.join(path, name))
+		if old:
+			self._remove(old)
+
+
+	def sync(self):
+		'''watch all directories and index the files, that changed since the index was written'''
+
+		if self.verbosity >= 1:
+			print("scanning for changes...")
+		self._visited = set()
+		try:
+			for rootdir in self.rootdirs:
+				self._scan_dir(rootdir)
+			for dirname in [dirname for dirname in self._files if dirname not in self._visited]:		# dirs, that are gone
+				if dirname in self._files and not any(os.path.realpath(dirname).startswith(os.path.join(path, "")) for path in self.exclude):
+					self._remove(dirname)
+		finally:
+			self._visited = None
+
+
+	def _handle(self, events):
+		for mask, cookie, dirname, name in events:
+			if mask & IN_Q_OVERFLOW:
+				if self.verbosity >= 1:
+					print("\033[94mtoo many changes, rescanning everything\033[0m")
+				self.sync()
+				continue
+			if dirname is None or not name:		# events of the watched dir itself
+				continue
+
+			fullname = os.path.join(dirname, name)
+			if mask & IN_MOVED_FROM:
+				self._moved[cookie] = fullname
+			elif mask & IN_MOVED_TO:
+				old = self._moved.pop(cookie, None)
+				if mask & IN_ISDIR:
+					self._scan_dir(fullname, old)
+				else:
+					self._index_file(fullname, old)
+					if old:
+						self._remove(old)
+			elif mask & IN_DELETE:
+				self._remove(fullname)
+			elif mask & IN_ISDIR:		# created
+				self._scan_dir(fullname)	# files might have been created before the watch
+			elif mask & IN_CREATE:		# usually followed by IN_CLOSE_WRITE, but not for hard links
+				self._created.add(fullname)
+			elif mask & IN_CLOSE_WRITE:
+				self._created.discard(fullname)
+				self._index_file(fullname)
+
+		for old in self._moved.values():		# moved out of the watched trees
+			self._remove(old)
+		self._moved.clear()
+
+
+	def flush(self):
+		'''append the collected lines to the index'''
+
+		for fullname in self._created:		# not written since they were created
+			self._index_file(fullname)
+		self._created.clear()
+		if self._lines:
+			if self._sort == "hash" and not self._appended:
+				# lines appended to an index sorted by checksum break its order. so it is sorted
+				# by path until the next compaction, which sorts it by checksum again
+				compact_index_file([self.indexfile], self.indexfile, keep="last", rel_to=self.rel_to, verbosity=self.verbosity - 1)
+			with open_indexfile(self.indexfile, 'a') as f:
+				f.writelines(self._lines)
+			if self.verbosity >= 1:
+				print("appended " + str(len(self._lines)) + " entries")
+			self._appended += len(self._lines)
+			self._lines.clear()
+
+
+	def compact(self):
+		'''drop the outdated lines and the lines of deleted files from the index'''
+
+		self.flush()
+		if self._appended or self._deleted:
+			if self.verbosity >= 1:
+				print("compacting " + self.indexfile + "...")
+			with metrics.stage("compact_index", self.verbosity):
+				compact_index_file([self.indexfile], self.indexfile, keep="last", rel_to=self.rel_to,
+									sort=self._sort, drop_paths=self._deleted, verbosity=self.verbosity - 1)
+			self._appended = 0
+			self._deleted.clear()
+
+
+	def run(self, stop=None):
+		'''watch until KeyboardInterrupt or until the threading.Event 'stop' is set'''
+
+		last_flush = last_compact = last_poll = monotonic()
+		try:
+			while not (stop and stop.is_set()):
+				timeout = min(self.flush_interval, self.poll_interval, 1)
+				if self._inotify:
+					self._handle(self._inotify.read(timeout))
+				else:
+					sleep(timeout)
+
+				now = monotonic()
+				if len(self._poller) and now - last_poll >= self.poll_interval:
+					for path in self._poller.changed():
+						self._scan_dir(path, recursive=False)
+					last_poll = now
+				if len(self._lines) >= self.batchsize or now - last_flush >= self.flush_interval:
+					self.flush()
+					last_flush = now
+				if now - last_compact >= self.compact_interval:
+					self.compact()
+					last_compact = now
+		except KeyboardInterrupt:
+			pass
+		finally:
+			self.compact()
+			if self._inotify:
+				self._inotify.close()
+
+
+
+def watch_index(indexfile, rootdirs, stop=None, **kwargs):
+	''' keep the index 'indexfile' of the 'rootdirs' (written by create_index) up to date.
+	first the files, that changed since the index was written, are indexed. then the trees
+	are watched by inotify and created, modified and moved files are indexed, as soon as
+	they are closed. with 'poll' or where inotify is not available (or runs out of watches)
+	the mtime of the directories is checked every 'poll_interval' seconds instead, this
+	finds new, deleted and renamed files, but not files modified in place.
+	the new lines are appended to the index in batches of 'batchsize' lines or every
+	'flush_interval' seconds, every 'compact_interval' seconds and at the end the index is
+	compacted (see compact_index), which drops the outdated lines and deleted files.
+	moved files, that did not change, keep their checksum without being read again.
+	runs until KeyboardInterrupt or until the threading.Event 'stop' is set.
+	see IndexWatcher for the other parameters'''
+
+	watcher = IndexWatcher(indexfile, rootdirs, **kwargs)
+	watcher.load()
+	watcher.sync()
+	watcher.run(stop)
@@ -1,13 +1,30 @@
 #!/usr/bin/env python3
 
 from fsf_core import *
-from fsf_core import _get_fileinfo, _gethash, _read_indexfiles, _collect_duplicate_files, _combine_folders_with_duplicate_files, _pair_folders_with_duplicate_files
+from fsf_core import _is_sorted_index, _max_open_per_group, _index_candidates, _get_fileinfo, _get_fileinfo_fast, _shard_of, _walk_parallel, _hash_per_device, _verify_duplicate_group, _gethash, _read_indexfiles, _collect_duplicate_files, _combine_folders_with_duplicate_files, _pair_folders_with_duplicate_files
 
 from fsf_objects import *
+from fsf_report import *
+from fsf_metrics import Metrics
+from fsf_watch import IndexWatcher
+import fsf_watch
+import fsf_lookup
+from fsf_daemon import QueryServer, query_index
+from fsf_lookup import LookupFilter, open_lookup_filter, lookup_files, _key
+from fsf_plan import plan_index, run_plan
+import threading
 
 import unittest
 import unittest.mock as mock
 import io
+import hashlib
+import collections
+import contextlib
+import os
+import json
+import sqlite3
+import shutil
+import tempfile
 
 
 class test_helper_functions(unittest.TestCase):
@@ -18,6 +35,18 @@ class test_helper_functions(unittest.TestCase):
 		self.assertEqual(t1, t2)
 
 
+	def test__get_fileinfo_fast(self):
+		dircache = {}
+		for path in ["VMs/Win10alpha/Logs/f1", "/abs/path/f2", "/f3", "f4", "double//slash/f5", "dot/./f6", "tab\tin/name\tf7"]:
+			line = "  124428	1413392134.8142	e800e9c562ec23614517e868799dba8e6eca9be	" + path + "\n"
+			self.assertEqual(_get_fileinfo_fast(line, dircache), _get_fileinfo(line), path)
+
+		t1 = _get_fileinfo_fast("  1	1.0	aa	shared/dir/f1", dircache)
+		t2 = _get_fileinfo_fast("  2	1.0	bb	shared/dir/f2", dircache)
+		self.assertIs(t1.path, t2.path, "files of the same directory should share the cached path tuple")
+		self.assertEqual(t2.size, 2)
+
+
 	def test__read_indexfiles(self):
 		fake_file = io.StringIO("  124428	1413392134.8142	e800e9c562ec23614517e868799dba8e6eca9be	VMs/Win10alpha/Logs/f1\n  224428	1413392134.8142	e800e9c562ec23614517e868799dba8e6eca9be	VMs/Win10alpha/Logs/f1\n  324428	1413392134.8142	e800e9c562ec23614517e868799dba8e6eca9be	VMs/Win10alpha/Logs/f1\n")
 		fake_file2 = io.StringIO("  424428	1413392134.8142	e800e9c562ec23614517e868799dba8e6eca9be	VMs/Win10alpha/Logs/f1\n  524428	1413392134.8142	e800e9c562ec23614517e868799dba8e6eca9be	VMs/Win10alpha/Logs/f1\n  624428	1413392134.8142	e800e9c562ec23614517e868799dba8e6eca9be	VMs/Win10alpha/Logs/f1\n")
@@ -30,6 +59,240 @@ class test_helper_functions(unittest.TestCase):
 		self.assertEqual(filelist[0], hpn("124428 e800e9c562ec23614517e868799dba8e6eca9be", ("VMs","Win10alpha","Logs"), "f1"), "first entry not read correctly")
 		self.assertEqual([i.hash[0] for i in filelist], ['1', '2', '3', '4', '5', '6'], "something was messed up while reading the files")
 
+	def test__read_indexfiles_parallel(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			files = []
+			for i in range(3):
+				files.append(os.path.join(tmpdir, "index" + str(i)))
+				with open(files[-1], 'w') as f:
+					for j in range(50):
+						f.write("{size: 13d}\t1413392134.8142\t{hash:040x}\tfolder{i}/sub{j}/file{j}\n".format(size=j, hash=i*100+j, i=i, j=j))
+
+			serial = _read_indexfiles(files, verbosity=0)
+			parallel = _read_indexfiles(files, verbosity=0, processes=2, chunksize=500)	# force several chunks per file
+
+		self.assertEqual(len(serial), 150)
+		self.assertEqual(parallel, serial, "the parallel loader must return the same entries in the same order")
+
+
+	def test_open_indexfile_compressed(self):
+		lines = ["{size: 13d}\t1413392134.8142\t{hash:040x}\tfolder/file{size}\n".format(size=i, hash=i) for i in range(100)]
+
+		with tempfile.TemporaryDirectory() as tmpdir:
+			for ext in [".gz", ".xz", ".bz2"]:
+				file = os.path.join(tmpdir, "index" + ext)
+				with open_indexfile(file, 'a') as f:
+					for line in lines[:50]:
+						f.write(line)
+				with open_indexfile(file, 'a') as f:		# appending adds another stream
+					for line in lines[50:]:
+						f.write(line)
+
+				with open(file, 'rb') as f:
+					self.assertNotEqual(f.read(len(lines[0])), lines[0].encode(), "file is not compressed")
+				filelist = _read_indexfiles([file], verbosity=0)
+				self.assertEqual([i.size for i in filelist], list(range(100)), ext)
+				self.assertEqual(_read_indexfiles([file], verbosity=0, processes=2), filelist, ext)
+
+				os.rename(file, file + ".idx")		# now only the magic bytes tell the format
+				self.assertEqual(_read_indexfiles([file + ".idx"], verbosity=0), filelist, ext)
+
+
+	def test_ShardedIndexWriter(self):
+		lines = ["{size: 13d}\t1413392134.8142\t{hash:040x}\tfolder{i}/file\n".format(size=i % 7, hash=(i % 7) << 140, i=i) for i in range(70)]
+
+		with tempfile.TemporaryDirectory() as tmpdir:
+			dataset = os.path.join(tmpdir, "dataset")
+			with ShardedIndexWriter(dataset, 4) as f:
+				for line in lines:
+					f.write(line)
+
+			manifest = read_manifest(dataset)
+			self.assertEqual(manifest["shards"], 4)
+			for shard, name in enumerate(manifest["files"]):
+				for entry in _read_indexfiles([os.path.join(dataset, name)], verbosity=0):
+					self.assertEqual(_shard_of(entry.hash.split(' ')[1], 4), shard)
+			self.assertEqual(len(_read_indexfiles([dataset], verbosity=0)), 70)
+
+			whole = io.StringIO()
+			find_duplicate_files([dataset], whole, verbosity=0)
+			per_shard = io.StringIO()
+			find_duplicate_files([dataset], per_shard, verbosity=0, per_shard=True)
+			parts = io.StringIO()
+			for shard in range(4):
+				find_duplicate_files([dataset], parts, verbosity=0, shards=[shard])
+			for shard in [4, -1]:
+				self.assertRaises(ValueError, find_duplicate_files, [dataset], io.StringIO(), verbosity=0, shards=[shard])
+
+		groups = lambda out: sorted(out.getvalue().split('\n\n'))
+		self.assertEqual(groups(per_shard), groups(whole))
+		self.assertEqual(parts.getvalue(), per_shard.getvalue())
+		self.assertEqual(len(groups(whole)), 7)
+
+
+	def test_compact_index(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			existing = os.path.join(tmpdir, "existing")
+			open(existing, 'w').close()
+			index1 = os.path.join(tmpdir, "index1")
+			index2 = os.path.join(tmpdir, "index2")
+			with open(index1, 'w') as f:
+				f.write("            1\t 100.0000\taa\tb/new_in_1\n")
+				f.write("            2\t 100.0000\tbb\ta/old_in_2\n")
+				f.write("            3\t 100.0000\tcc\texisting\n")
+			with open(index2, 'w') as f:
+				f.write("            4\t  50.0000\tdd\tb/new_in_1\n")
+				f.write("            5\t 200.0000\tee\ta/old_in_2\n")
+				f.write("            6\t 100.0000\tff\ta/old_in_2\n")
+
+			out = io.StringIO()
+			compact_index([index1, index2], out, keep="mtime", verbosity=0)
+			self.assertEqual(out.getvalue(), "            5\t 200.0000\tee\ta/old_in_2\n"
+												"            1\t 100.0000\taa\tb/new_in_1\n"
+												"            3\t 100.0000\tcc\texisting\n")
+
+			out = io.StringIO()
+			compact_index([index1, index2], out, keep="last", verbosity=0)
+			self.assertEqual(out.getvalue(), "            6\t 100.0000\tff\ta/old_in_2\n"
+												"            4\t  50.0000\tdd\tb/new_in_1\n"
+												"            3\t 100.0000\tcc\texisting\n")
+
+			out = io.StringIO()
+			compact_index([index1, index2], out, drop_missing=True, rel_to=tmpdir, verbosity=0)
+			self.assertEqual(out.getvalue(), "            3\t 100.0000\tcc\texisting\n")
+
+
+	def test_find_duplicate_files_sorted_merge(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			files, sortedfiles = [], []
+			for i in range(3):
+				files.append(os.path.join(tmpdir, "index" + str(i)))
+				with open(files[-1], 'w') as f:
+					for j in range(30):
+						f.write("{size: 13d}\t1413392134.8142\t{hash:040x}\tfolder{i}/file{j}\n".format(size=j % 11, hash=j % 13, i=i, j=j))
+				sortedfiles.append(files[-1] + ".sorted")
+				with open(sortedfiles[-1], 'w') as f:
+					compact_index([files[-1]], f, sort="hash", verbosity=0)
+
+			unsorted_out = io.StringIO()
+			find_duplicate_files(files, unsorted_out, verbosity=0)
+			sorted_out = io.StringIO()
+			with mock.patch('fsf_core._read_indexfiles') as mockread:
+				find_duplicate_files(sortedfiles, sorted_out, verbosity=0)
+			self.assertFalse(mockread.called, "sorted indexes should be merged, not read and sorted")
+			with open(sortedfiles[0]) as f:
+				header = f.readline()
+				self.assertEqual(header, SORTED_HEADER.format(len(f.read())))
+
+		self.assertEqual(sorted_out.getvalue(), unsorted_out.getvalue())
+		self.assertTrue(sorted_out.getvalue())
+
+
+	def test_find_duplicate_files_appended_to_sorted(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			entries = "{: 13d}\t1.0\t{:040x}\ta/x\n".format(5, 2) + "{: 13d}\t1.0\t{:040x}\ta/y\n".format(7, 3)
+			for indexfile in [os.path.join(tmpdir, "index"), os.path.join(tmpdir, "index.gz")]:
+				with open_indexfile(indexfile, 'w') as f:
+					f.write(SORTED_HEADER.format(len(entries)) + entries)
+				self.assertTrue(_is_sorted_index(indexfile))
+				with open_indexfile(indexfile, 'a') as f:		# e.g. a later createIndex without --sorted
+					f.write("{: 13d}\t1.0\t{:040x}\tb/x2\n".format(5, 2))
+				self.assertFalse(_is_sorted_index(indexfile))
+				self.assertTrue(_is_sorted_index(indexfile, complete=False))
+
+				out = io.StringIO()
+				with mock.patch('fsf_core._iter_sorted_indexfile') as merged:
+					find_duplicate_files([indexfile], out, verbosity=0)
+				self.assertFalse(merged.called, "an index with lines appended should not be merged")
+				self.assertIn("x2\tb", out.getvalue(), "an index with lines appended should be sorted in memory")
+
+			corrupt = os.path.join(tmpdir, "corrupt")
+			entries = "".join(reversed(entries.splitlines(True)))
+			with open(corrupt, 'w') as f:
+				f.write(SORTED_HEADER.format(len(entries)) + entries)
+			self.assertRaises(ValueError, find_duplicate_files, [corrupt], io.StringIO(), verbosity=0)
+
+
+	def test_find_duplicate_files_verify(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			contents = {"a": b"x" * 100, "b": b"y" * 100, "c": b"x" * 100, "d": b"x" * 99 + b"z", "e": b"y" * 100}
+			for name, content in contents.items():
+				with open(os.path.join(tmpdir, name), 'wb') as f:
+					f.write(content)
+
+			group = [[hpn("100 fakehash", (), name)] for name in sorted(contents)]
+			confirmed = _verify_duplicate_group(group, tmpdir, chunksize=16, verbosity=0)
+			self.assertEqual([[member[0].filename for member in subgroup] for subgroup in confirmed], [["a", "c"], ["b", "e"]])
+
+			files, peak = [], [0]
+			def tracking_open(*args):
+				files.append(open(*args))
+				peak[0] = max(peak[0], sum(not f.closed for f in files))
+				return files[-1]
+			large = [[hpn("100 fakehash", (), name)] for i in range(4) for name in sorted(contents)]
+			with mock.patch('fsf_core.open', create=True, side_effect=tracking_open):
+				confirmed = _verify_duplicate_group(large, tmpdir, chunksize=16, verbosity=0, max_open=3)
+			self.assertEqual([[member[0].filename for member in subgroup] for subgroup in confirmed], [["a", "c"] * 4, ["b", "e"] * 4, ["d"] * 4])
+			self.assertEqual(peak[0], 3, "at most max_open files should be open at a time")
+
+			index = os.path.join(tmpdir, "index")
+			with open(index, 'w') as f:
+				for name in sorted(contents):
+					f.write("          100\t1413392134.8142\tfakehash\t" + name + "\n")
+			out = io.StringIO()
+			find_duplicate_files([index], out, verbosity=0, verify=True, verify_workers=2, rel_to=tmpdir)
+
+		self.assertEqual(out.getvalue(), "\n100 fakehash\na\t.\nc\t.\n\n100 fakehash\nb\t.\ne\t.\n")
+
+
+	def test_hard_links(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			for name in ["a", "copy"]:
+				with open(os.path.join(tmpdir, name), 'wb') as f:
+					f.write(b"content")
+			os.link(os.path.join(tmpdir, "a"), os.path.join(tmpdir, "link"))
+
+			index = io.StringIO()
+			with mock.patch('fsf_core._gethash', wraps=_gethash) as mockhash:
+				create_index(tmpdir, index, None, rel_to=tmpdir, verbosity=0)
+			self.assertEqual(mockhash.call_count, 2, "the inode of the hard links should be hashed only once")
+
+			lines = sorted(index.getvalue().splitlines(), key = lambda line: line.split('\t')[3])
+			self.assertEqual([line.count(':') for line in lines], [2, 0, 2])
+
+			indexfile = os.path.join(tmpdir, "index")
+			with open(indexfile, 'w') as f:
+				f.write('\n'.join(lines) + '\n')
+			out = io.StringIO()
+			find_duplicate_files([indexfile], out, verbosity=0)
+			self.assertEqual(out.getvalue().split('\n')[2:], ["a\t.", "\tlink\t.", "copy\t.", ""])
+
+			os.remove(os.path.join(tmpdir, "copy"))		# only the links are left, that's no duplicate
+			with open(indexfile, 'w') as f:
+				f.write(lines[0] + '\n' + lines[2] + '\n')
+			out = io.StringIO()
+			find_duplicate_files([indexfile], out, verbosity=0)
+			self.assertEqual(out.getvalue(), "")
+
+
+	def test_find_duplicate_files_top(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			indexfile = os.path.join(tmpdir, "index")
+			with open(indexfile, 'w') as f:
+				#            size     copies
+				for size, copies in [(10, 5), (100, 2), (30, 4), (1000, 1), (50, 2), (2, 50)]:
+					for i in range(copies):
+						f.write("{size: 13d}\t1413392134.8142\t{hash:040x}\tfolder{i}/file{size}\n".format(size=size, hash=size, i=i))
+
+			out = io.StringIO()
+			find_duplicate_files([indexfile], out, verbosity=0, top=3, min_size=5)
+
+		headers = [block.split('\n')[0] for block in out.getvalue().strip('\n').split('\n\n')]
+		self.assertEqual(headers, ["100 " + "{:040x}".format(100) + "\t100",
+									"30 " + "{:040x}".format(30) + "\t90",
+									"50 " + "{:040x}".format(50) + "\t50"])
+
+
 	def test__gethash(self):
 		shortbytes = b"foobar"
 
@@ -46,7 +309,526 @@ class test_helper_functions(unittest.TestCase):
 		self.assertEqual(hash, "cfb9d945d9d322b092be7f7ae48abb9ecd618be1", "wrong hash for long files")
 
 
+	def test__gethash_block_sizes(self):
+		content = os.urandom(300000)
+		expected = hashlib.sha1(content).hexdigest()
+		with tempfile.TemporaryDirectory() as tmpdir:
+			filename = os.path.join(tmpdir, "f")
+			with open(filename, 'wb') as f:
+				f.write(content)
+			for blocksize in [None, 1, 4096, 65536, 1 << 20]:
+				self.assertEqual(_gethash(filename, blocksize), expected, blocksize)
+
+			limiter = mock.Mock()
+			self.assertEqual(_gethash(filename, 100000, limiter, nocache=True), expected)
+			self.assertEqual([c[0][0] for c in limiter.consume.call_args_list], [100000, 100000, 100000])
+
+
+	def test__walk_parallel(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			for path in ["b/y/1", "b/x/2", "a/3", "c/skip/4", "c/5", "6"]:
+				os.makedirs(os.path.join(tmpdir, os.path.dirname(path)), exist_ok=True)
+				open(os.path.join(tmpdir, path), 'w').close()
+			os.symlink(os.path.join(tmpdir, "b"), os.path.join(tmpdir, "link"))
+
+			walked = []
+			for root, dirs, files in _walk_parallel(tmpdir, 3, lookahead=2):
+				walked.append((os.path.relpath(root, tmpdir), list(dirs), files))
+				if "skip" in dirs:
+					dirs.remove("skip")
+
+		self.assertEqual(walked, [
+			(".", ["a", "b", "c", "link"], ["6"]),
+			("a", [], ["3"]),
+			("b", ["x", "y"], []),
+			("b/x", [], ["2"]),
+			("b/y", [], ["1"]),
+			("c", ["skip"], ["5"]),
+		], "should walk like os.walk, depth first and sorted, without following links and pruned dirs")
+
+
+	def test_create_index_sizes(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			for name, content in [("empty", b""), ("small", b"x"), ("medium", b"x" * 100), ("large", b"x" * 1000)]:
+				with open(os.path.join(tmpdir, name), 'wb') as f:
+					f.write(content)
+
+			outfile = io.StringIO()
+			with mock.patch('fsf_core._gethash', wraps=_gethash) as gethash:
+				create_index(tmpdir, outfile, None, rel_to=tmpdir, verbosity=0)
+			self.assertEqual(sorted(os.path.basename(call[0][0]) for call in gethash.call_args_list), ["large", "medium", "small"],
+								"empty files should not be opened")
+			self.assertIn("\t" + EMPTY_CHECKSUM + "\tempty\n", outfile.getvalue())
+			self.assertEqual(EMPTY_CHECKSUM, hashlib.sha1(b"").hexdigest())
+
+			outfile = io.StringIO()
+			with mock.patch('fsf_core._gethash', wraps=_gethash) as gethash:
+				create_index(tmpdir, outfile, None, rel_to=tmpdir, verbosity=0, min_size=1, max_size=100)
+			self.assertEqual(sorted(line.split('\t')[3] for line in outfile.getvalue().splitlines()), ["medium", "small"])
+			self.assertEqual(gethash.call_count, 2, "files out of the size window should not be opened")
+
+
+	def test_scan_duplicate_files(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			root = os.path.join(tmpdir, "root")
+			for path, content in [("a/1", b"same"), ("b/2", b"same"), ("b/3", b"diff"), ("c/4", b"same"), ("unique", b"other size"),
+									("a/big", b"x" * 1000), ("c/big", b"x" * 1000)]:
+				os.makedirs(os.path.join(root, os.path.dirname(path)), exist_ok=True)
+				with open(os.path.join(root, path), 'wb') as f:
+					f.write(content)
+			os.link(os.path.join(root, "a", "1"), os.path.join(root, "a", "link"))
+
+			with mock.patch('fsf_core._gethash', wraps=_gethash) as gethash:
+				records = list(iter_index(root, verbosity=0, size_buckets=True))
+			self.assertNotIn(os.path.join(root, "unique"), [call[0][0] for call in gethash.call_args_list], "a file of a unique size should not be read")
+			self.assertEqual([record.fstats.st_size for record in records], [1000, 1000, 4, 4, 4, 4, 4], "the records should come size by size")
+
+			indexfile = os.path.join(tmpdir, "index")
+			with open(indexfile, 'w') as f:
+				create_index(root, f, None, rel_to=tmpdir, verbosity=0)
+			expected = io.StringIO()
+			find_duplicate_files([indexfile], expected, verbosity=0)
+
+			for by_size in [False, True]:
+				outfile = io.StringIO()
+				find_duplicate_files(None, outfile, verbosity=0, rel_to=tmpdir, records=iter(records), records_by_size=by_size)
+				self.assertEqual(outfile.getvalue(), expected.getvalue())
+			outfile = io.StringIO()
+			scan_duplicate_files(root, outfile, rel_to=tmpdir, verbosity=0)
+			self.assertEqual(sorted(outfile.getvalue().split("\n\n")), sorted(expected.getvalue().split("\n\n")), "only the order of the groups may differ")
+
+
+	def test_collect_folders_dtype(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			for path in ["a/1", "a/2.tmp", "a/b/3", "c/4", "5"]:
+				os.makedirs(os.path.join(tmpdir, os.path.dirname(path)), exist_ok=True)
+				open(os.path.join(tmpdir, path), 'w').close()
+			os.symlink(os.path.join(tmpdir, "5"), os.path.join(tmpdir, "a", "link"))
+			os.symlink(os.path.join(tmpdir, "c"), os.path.join(tmpdir, "a", "dirlink"))
+			os.mkfifo(os.path.join(tmpdir, "c", "fifo"))
+
+			outputs = []
+			for dtype, walkers in [(False, 2), (True, 1), (True, 4)]:
+				outfile = io.StringIO()
+				collect_folders(tmpdir, outfile, exclude_pattern=["*.tmp"], rel_to=tmpdir, verbosity=0, walkers=walkers, dtype=dtype)
+				outputs.append(outfile.getvalue())
+
+		self.assertEqual(outputs[1], outputs[0])
+		self.assertEqual(outputs[2], outputs[0])
+		self.assertEqual([line.split('\t')[1:] for line in outputs[0].splitlines()], [
+			[".", "     1", "     1"], ["a", "     3", "     1"], [os.path.join("a", "b"), "     1", "     1"], ["c", "     2", "     1"]])
+
+
+	def test__hash_per_device(self):
+		stat = collections.namedtuple("stat", ["st_dev", "st_ino"])
+		candidates = [("file" + str(i), stat(i % 3, 100 - i)) for i in range(30)]
+		calls = []
+		def hashfunc(fullname, fstats):
+			calls.append(fstats)
+			return fullname.upper()
+
+		results = list(_hash_per_device(candidates, hashfunc, batchsize=20))
+		self.assertEqual(sorted(results), sorted((c, c[0].upper()) for c in candidates))
+		self.assertEqual(sorted(results[:20]), sorted((c, c[0].upper()) for c in candidates[:20]), "batches should be finished in order")
+		for batch in [calls[:20], calls[20:]]:
+			for dev in range(3):
+				lane = [fstats.st_ino for fstats in batch if fstats.st_dev == dev]
+				self.assertEqual(lane, sorted(lane), "each device should be read sorted by inode")
+
+
+	def test__gethash_mmap(self):
+		content = os.urandom(300000)
+		with tempfile.TemporaryDirectory() as tmpdir:
+			filename = os.path.join(tmpdir, "f")
+			with open(filename, 'wb') as f:
+				f.write(content)
+			self.assertEqual(_gethash(filename, mmap_threshold=1), hashlib.sha1(content).hexdigest())
+			self.assertEqual(_gethash("/dev/null", mmap_threshold=0), hashlib.sha1(b"").hexdigest(), "special files are read")
+			with mock.patch('fsf_core.mmap.mmap') as mapped:
+				self.assertEqual(_gethash(filename), hashlib.sha1(content).hexdigest())
+			mapped.assert_not_called()		# files are read by default, they may be truncated
+
+			fstat = os.fstat
+			calls = []
+			def shrinking_fstat(fd):
+				calls.append(fd)
+				if len(calls) == 4:		# while hashing the third block
+					os.truncate(filename, 150000)
+				return fstat(fd)
+			with mock.patch('fsf_core.os.fstat', side_effect=shrinking_fstat):
+				hash = _gethash(filename, 65536, mmap_threshold=1)
+			self.assertEqual(hash, hashlib.sha1(content[:150000]).hexdigest(), "the rest of a shrinking file should be read")
+
+
+class test_fsf_watch(unittest.TestCase):
+
+	def test_IndexWatcher_sync(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			rootdir = os.path.join(tmpdir, "root")
+			os.makedirs(os.path.join(rootdir, "sub"))
+			for name, content in [("a", b"aaa"), ("b", b"bbbb"), ("sub/c", b"ccccc")]:
+				with open(os.path.join(rootdir, name), 'wb') as f:
+					f.write(content)
+			indexfile = os.path.join(tmpdir, "index")
+			with open(indexfile, 'w') as f:
+				create_index(rootdir, f, None, rel_to=tmpdir, verbosity=0)
+
+			with open(os.path.join(rootdir, "a"), 'wb') as f:
+				f.write(b"changed")
+			os.rename(os.path.join(rootdir, "sub", "c"), os.path.join(rootdir, "c"))
+			os.remove(os.path.join(rootdir, "b"))
+			with open(os.path.join(rootdir, "sub", "d"), 'wb') as f:
+				f.write(b"new")
+
+			watcher = IndexWatcher(indexfile, [rootdir], rel_to=tmpdir, poll=True, verbosity=0)
+			watcher.load()
+			with mock.patch('fsf_watch._hash_candidate', wraps=fsf_watch._hash_candidate) as hashed:
+				watcher.sync()
+			self.assertEqual(sorted(call[0][0] for call in hashed.call_args_list),
+							[os.path.join(rootdir, name) for name in ["a", "c", "sub/d"]])
+
+			os.rename(os.path.join(rootdir, "c"), os.path.join(rootdir, "sub", "e"))
+			with mock.patch('fsf_watch._hash_candidate') as hashed:
+				watcher._handle([(fsf_watch.IN_MOVED_FROM, 7, rootdir, "c"),
+								(fsf_watch.IN_MOVED_TO, 7, os.path.join(rootdir, "sub"), "e")])
+			self.assertFalse(hashed.called, "a moved file should keep its checksum")
+			watcher.compact()
+
+			with open(indexfile) as f:
+				entries = {line.split('\t')[3].rstrip('\n'): line.split('\t')[2] for line in f if line[0] != '#'}
+			self.assertEqual(entries, {os.path.join("root", name): hashlib.sha1(content).hexdigest()
+										for name, content in [("a", b"changed"), ("sub/e", b"ccccc"), ("sub/d", b"new")]})
+
+			watcher = IndexWatcher(indexfile, [rootdir], rel_to=tmpdir, poll=True, verbosity=0)
+			watcher.load()
+			watcher.sync()
+			self.assertEqual(watcher._lines, [], "an up to date index should not change")
+
+
+	def test_IndexWatcher_removed_dirs(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			rootdir = os.path.join(tmpdir, "root")
+			for name in ["keep/k", "gone/g", "gone/deeper/h", "polled/gone/p"]:
+				os.makedirs(os.path.dirname(os.path.join(rootdir, name)), exist_ok=True)
+				with open(os.path.join(rootdir, name), 'w') as f:
+					f.write(name)
+			indexfile = os.path.join(tmpdir, "index")
+			with open(indexfile, 'w') as f:
+				create_index(rootdir, f, None, rel_to=tmpdir, verbosity=0)
+
+			shutil.rmtree(os.path.join(rootdir, "gone"))
+			watcher = IndexWatcher(indexfile, [rootdir], rel_to=tmpdir, poll=True, verbosity=0)
+			watcher.load()
+			watcher.sync()
+			self.assertEqual(watcher._deleted, {os.path.join("root", "gone", "g"), os.path.join("root", "gone", "deeper", "h")})
+
+			shutil.rmtree(os.path.join(rootdir, "polled", "gone"))
+			watcher._scan_dir(os.path.join(rootdir, "polled"), recursive=False)		# like a change found by polling
+			watcher.compact()
+			with open(indexfile) as f:
+				self.assertEqual([line.split('\t')[3] for line in f], [os.path.join("root", "keep", "k") + "\n"])
+
+
+class test_fsf_daemon(unittest.TestCase):
+
+	def test_QueryServer(self):
+		lines = ["   10	1.0	aa	a/f1\n", "   10	1.0	aa	b/f1\n", "   10	1.0	aa	b/f2\n",
+				"    5	1.0	bb	a/f3\n", "    5	1.0	bb	c/f3\n", "    7	1.0	cc	a/f4\n",
+				"    7	1.0	dd	c/f3\n"]		# c/f3 was changed
+		with tempfile.TemporaryDirectory() as tmpdir:
+			indexfile = os.path.join(tmpdir, "index")
+			with open(indexfile, 'w') as f:
+				f.writelines(lines)
+			socketfile = os.path.join(tmpdir, "socket")
+			with QueryServer(socketfile, [indexfile], verbosity=0) as server:
+				thread = threading.Thread(target=server.serve_forever)
+				thread.start()
+				try:
+					group = query_index(socketfile, {"query": "duplicates", "path": "b/f2"})
+					self.assertEqual((group["size"], group["hash"], group["reclaimable"]), (10, "aa", 20))
+					self.assertEqual([(file["path"], file["name"]) for file in group["files"]], [("a", "f1"), ("b", "f1"), ("b", "f2")])
+					self.assertIsNone(query_index(socketfile, {"query": "duplicates", "path": "a/f3"}), "c/f3 was replaced by a later entry")
+					self.assertRaises(ValueError, query_index, socketfile, {"query": "duplicates", "path": "x/f"})
+
+					self.assertEqual(len(query_index(socketfile, {"query": "groups"})), 1)
+					self.assertEqual(query_index(socketfile, {"query": "groups", "min_size": 11}), [])
+					self.assertEqual(query_index(socketfile, {"query": "overlap", "folder": "a"}), [{"folder": "b", "common": 1, "files": 2}])
+
+					query_index(socketfile, {"top": None, "query": "groups"})
+					stats = query_index(socketfile, {"query": "stats"})
+					self.assertEqual((stats["files"], stats["folders"], stats["groups"]), (6, 3, 1))
+					self.assertEqual(stats["cache_hits"], 0)
+					query_index(socketfile, {"query": "groups"})
+					self.assertEqual(query_index(socketfile, {"query": "stats"})["cache_hits"], 1)
+				finally:
+					server.shutdown()
+					thread.join()
+			self.assertFalse(os.path.exists(socketfile))
+
+
+	def test_QueryServer_reload(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			indexfile = os.path.join(tmpdir, "index")
+			with open(indexfile, 'w') as f:
+				f.writelines(["   10	1.0	aa	a/f1\n", "   10	1.0	aa	b/f1\n"])
+			with QueryServer(os.path.join(tmpdir, "socket"), [indexfile], verbosity=0) as server:
+				old = server.store
+				duplicates = old.duplicates
+				def reloading_duplicates(**request):
+					server.reload()		# by another client while the query is answered
+					return duplicates(**request)
+				old.duplicates = reloading_duplicates
+				answer = json.loads(server.answer('{"query": "duplicates", "path": "a/f1"}'))
+				self.assertEqual(len(answer["result"]["files"]), 2)
+				self.assertIsNot(server.store, old)
+				self.assertEqual(server._cached.cache_info().currsize, 0, "the answer of the old tables should not be cached")
+
+				os.remove(indexfile)
+				store = server.store
+				self.assertIn("error", json.loads(server.answer('{"query": "reload"}')))
+				self.assertIs(server.store, store, "the old tables should be kept")
+
+
+class test_fsf_lookup(unittest.TestCase):
+
+	def test_LookupFilter(self):
+		keys = [(size, "{:040x}".format(size * 7919)) for size in range(1000)]
+		with tempfile.TemporaryDirectory() as tmpdir:
+			indexfile = os.path.join(tmpdir, "index")
+			with open(indexfile, 'w') as f:
+				for size, checksum in keys:
+					f.write("{: 13d}\t1.0\t{}:1:2\tdir/f{}\n".format(size, checksum, size))
+			lookupfile = os.path.join(tmpdir, "lookup")
+			open_lookup_filter(lookupfile, [indexfile], verbosity=0).close()
+
+			with mock.patch.object(LookupFilter, 'build') as build:
+				lookup = open_lookup_filter(lookupfile, [indexfile], verbosity=0)
+			self.assertFalse(build.called, "an up to date lookup file should be loaded")
+			self.assertEqual(lookup.sizes, set(range(1000)))
+			for size, checksum in keys:
+				self.assertTrue(lookup.might_contain(_key(size, checksum)))
+				self.assertTrue(lookup.contains(_key(size, checksum)))
+			others = [_key(size, "{:040x}".format(size * 7919 + 1)) for size in range(1000)]
+			self.assertFalse(any(lookup.contains(key) for key in others))
+			self.assertLess(sum(lookup.might_contain(key) for key in others), 50, "too many false positives")
+			lookup.close()
+
+			other = os.path.join(tmpdir, "other")
+			with open(other, 'w') as f:
+				f.write("{: 13d}\t1.0\t{:040x}\tdir/g\n".format(5000, 1))
+			os.utime(other, (0, 0))		# older than the lookup file
+			lookup = open_lookup_filter(lookupfile, [other], verbosity=0)
+			self.assertEqual(lookup.sizes, {5000}, "a lookup file of other indexfiles should be rebuilt")
+			self.assertEqual(lookup.indexfiles, [os.path.abspath(other)])
+			lookup.close()
+
+
+	def test_lookup_files(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			archive = os.path.join(tmpdir, "archive")
+			candidates = os.path.join(tmpdir, "new")
+			for folder, name, content in [(archive, "a", b"aaa"), (archive, "b", b"bbbb"),
+											(candidates, "a2", b"aaa"), (candidates, "c", b"ccc"), (candidates, "d", b"ddddddd")]:
+				os.makedirs(folder, exist_ok=True)
+				with open(os.path.join(folder, name), 'wb') as f:
+					f.write(content)
+			indexfile = os.path.join(tmpdir, "index")
+			with open(indexfile, 'w') as f:
+				create_index(archive, f, None, rel_to=tmpdir, verbosity=0)
+
+			lookup = open_lookup_filter(None, [indexfile], verbosity=0)
+			outfile = io.StringIO()
+			with mock.patch('fsf_lookup._hash_candidate', wraps=fsf_lookup._hash_candidate) as hashed:
+				lookup_files([candidates], outfile, lookup, verbosity=0)
+			self.assertEqual(sorted(call[0][0] for call in hashed.call_args_list),
+							[os.path.join(candidates, name) for name in ["a2", "c"]], "d has a size, that is not in the index")
+			self.assertEqual(outfile.getvalue().split('\n'), ["new\t" + os.path.join(candidates, "c"),
+								"new\t" + os.path.join(candidates, "d"),
+								"exists\t" + os.path.join(candidates, "a2"),
+								"\t" + os.path.join("archive", "a"), ""])
+
+
+class test_fsf_plan(unittest.TestCase):
+
+	def make_tree(self, tmpdir):
+		root = os.path.join(tmpdir, "root")
+		for folder, size in [("big/a", 50000), ("big/b", 40000), ("big", 100), ("small", 10), ("", 1), ("skip", 1000)]:
+			for i in range(4):
+				os.makedirs(os.path.join(root, folder), exist_ok=True)
+				with open(os.path.join(root, folder, "f" + str(i)), 'wb') as f:
+					f.write(bytes([i]) * size)
+		return root
+
+
+	def test_plan_index(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			root = self.make_tree(tmpdir)
+			exclude = [os.path.join(root, "skip")]
+			plan = plan_index([root], 3, exclude=exclude, units_per_process=2, verbosity=0)
+			self.assertEqual(len(plan), 3)
+
+			indexed = []
+			for unit in (unit for process in plan for unit in process):
+				indexed += [fullname for fullname, fstats in _index_candidates(unit.rootdirs, exclude=unit.exclude, verbosity=0, subdirs=unit.subdirs)]
+				self.assertTrue(set(unit.exclude) <= set(exclude), "units should not exclude each other")
+			self.assertEqual(sorted(indexed), sorted(fullname for fullname, fstats in _index_candidates([root], exclude=exclude, verbosity=0)),
+							"the units must cover the tree without overlapping")
+			self.assertIn([os.path.join(root, "big", "a")], [unit.rootdirs for process in plan for unit in process])
+
+
+	def test_run_plan(self):
+		with tempfile.TemporaryDirectory() as tmpdir:
+			root = self.make_tree(tmpdir)
+			indexfile = os.path.join(tmpdir, "index.txt")
+			plan = plan_index([root], 2, units_per_process=2, verbosity=0)
+			self.assertTrue(run_plan(plan, indexfile, ["-v", "0", "-R", tmpdir], verbosity=0))
+
+			with open(os.path.join(tmpdir, "reference.txt"), 'w') as f:
+				create_index(root, f, None, rel_to=tmpdir, verbosity=0)
+			def entries(file):
+				with open(file) as f:
+					return sorted(line.split('\t', 2)[2] for line in f)		# without the mtime
+			self.assertEqual(entries(indexfile), entries(os.path.join(tmpdir, "reference.txt")))
+			self.assertEqual(sorted(os.listdir(tmpdir)), ["index.txt", "reference.txt", "root"], "the parts should be removed")
+
+
+class test_report_writers(unittest.TestCase):
+	def setUp(self):
+		self.group = [
+			[hpn("7 abc", ("a", "b"), "f1", inode="1:2"), hpn("7 abc", ("c",), "link", inode="1:2")],
+			[hpn("7 abc", ("/", "d"), "f2")],
+		]
+
+	def write(self, writerclass, wasted=None):
+		out = io.StringIO()
+		with writerclass(out, verbosity=0, batchsize=2) as writer:
+			writer.write_group(self.group, wasted)
+			writer.write_group(self.group, wasted)
+			writer.write_folders([("a", "b"), ("c",)], [("f1", "f2"), ("f3", "f4")])
+		return out.getvalue()
+
+
+	def test_TextReportWriter(self):
+		self.assertEqual(self.write(TextReportWriter, 7),
+			"\n7 abc\t7\nf1\ta/b\n\tlink\tc\nf2\t/d\n" * 2 + "a/b\nc\n--------\nf1\tf2\nf3\tf4\n\n")
+
+
+	def test_JsonLinesReportWriter(self):
+		lines = self.write(JsonLinesReportWriter).splitlines()
+		self.assertEqual(len(lines), 3)
+		self.assertEqual(json.loads(lines[0]), {"size": 7, "hash": "abc", "files": [
+				{"name": "f1", "path": "a/b", "links": [{"name": "link", "path": "c"}]},
+				{"name": "f2", "path": "/d"}]})
+		self.assertEqual(json.loads(lines[2]), {"folders": ["a/b", "c"], "files": [["f1", "f2"], ["f3", "f4"]]})
+
+
+	def test_CsvReportWriter(self):
+		out = io.StringIO()
+		with CsvReportWriter(out, verbosity=0) as writer:
+			writer.write_group(self.group, 7)
+		self.assertEqual(out.getvalue(), "group,size,hash,reclaimable,name,path,link\n"
+											"0,7,abc,7,f1,a/b,0\n0,7,abc,7,link,c,1\n0,7,abc,7,f2,/d,0\n")
+
+		out = io.StringIO()
+		with CsvReportWriter(out, verbosity=0) as writer:
+			writer.write_folders([("a", "b"), ("c",)], [("f1", "f2")])
+		self.assertEqual(out.getvalue(), "group,folder1,name1,folder2,name2\n0,a/b,f1,c,f2\n")
+
+
+	def test_SqliteReportWriter(self):
+		db = sqlite3.connect(":memory:")
+		with SqliteReportWriter(db, verbosity=0) as writer:
+			writer.write_group(self.group, 7)
+			writer.write_folders([("a", "b"), ("c",), ("d",)], [("f1", "f2", "f3")])
+			writer.write_tree_folder(("a", "b"), 2, 14, [("c",), ("d",)])
+
+		self.assertEqual(db.execute("SELECT * FROM groups").fetchall(), [(1, 7, "abc", 7)])
+		self.assertEqual(db.execute("SELECT * FROM files").fetchall(), [(1, "f1", "a/b", "1:2"), (1, "link", "c", "1:2"), (1, "f2", "/d", None)])
+		self.assertEqual(db.execute("SELECT folder1, folder2, files FROM folder_pairs").fetchall(), [("a/b", "c", 1), ("a/b", "d", 1), ("c", "d", 1)])
+		self.assertEqual(db.execute("SELECT * FROM pair_files WHERE pair_id = 3").fetchall(), [(3, "f2", "f3")])
+		self.assertEqual(db.execute("SELECT * FROM tree_folders").fetchall(), [(1, "a/b", 2, 14)])
+		self.assertEqual(db.execute("SELECT candidate FROM tree_candidates").fetchall(), [("c",), ("d",)])
+
+
+class test_metrics(unittest.TestCase):
+	def test_stages_and_counters(self):
+		m = Metrics()
+		for i in range(2):
+			with m.stage("outer", verbosity=0):
+				with m.stage("inner", verbosity=0):
+					m.count("files")
+		m.count("bytes", 10)
+		self.assertEqual(m.stages["outer"]["calls"], 2)
+		self.assertEqual(m.stages["inner"]["calls"], 2)
+		self.assertGreaterEqual(m.stages["outer"]["wall"], m.stages["inner"]["wall"])
+		self.assertEqual(m.counters, {"files": 2, "bytes": 10})
+
+
+	def test_without_resource(self):		# e.g. on windows
+		m = Metrics()
+		with mock.patch('fsf_metrics.resource', None):
+			with m.stage("read", verbosity=0):
+				pass
+			self.assertEqual(m.stages["read"]["peak_rss"], 0)
+		with mock.patch('fsf_core.resource', None):
+			self.assertEqual(_max_open_per_group(4), 64)
+
+
+	def test_write(self):
+		m = Metrics()
+		with m.stage("read", verbosity=0):
+			m.count("files_hashed", 3)
+		with tempfile.TemporaryDirectory() as tmpdir:
+			m.write(os.path.join(tmpdir, "metrics.json"))
+			with open(os.path.join(tmpdir, "metrics.json")) as f:
+				data = json.load(f)
+			self.assertEqual(data["counters"], {"files_hashed": 3})
+			self.assertEqual(data["stages"]["read"]["calls"], 1)
+
+			m.write(os.path.join(tmpdir, "metrics.prom"))
+			with open(os.path.join(tmpdir, "metrics.prom")) as f:
+				lines = f.read().splitlines()
+			self.assertIn("fsf_files_hashed_total 3", lines)
+			self.assertIn('fsf_stage_calls{stage="read"} 1', lines)
+			self.assertEqual(sorted(os.listdir(tmpdir)), ["metrics.json", "metrics.prom"])
+
+
+
 class test_find_similar_folders_subroutines(unittest.TestCase):
+	def test_folder_summary(self):
+		import random
+		rnd = random.Random(1)
+		folders = ["a", "a/b", "a/b/c", "d", "d/e", "f", "g/h"]
+		with tempfile.TemporaryDirectory() as tmpdir:
+			indexfile = os.path.join(tmpdir, "index")
+			with open(indexfile, 'w') as f:
+				for i in range(300):
+					content = rnd.randrange(120)
+					f.write("{: 13d}\t1.0\t{:040x}\t{}/file{}\n".format(content * 10, content, rnd.choice(folders), i))
+				f.write("          20\t1.0\t{:040x}\tnew/unique\n".format(999))
+			collectionfile = os.path.join(tmpdir, "folders")
+			with open(collectionfile, 'w') as f:
+				f.write("1\tempty\t0\t0\n2\ta\t3\t3\n")
+			summaryfile = os.path.join(tmpdir, "summary")
+			write_folder_summary([indexfile], summaryfile, [collectionfile], verbosity=0)
+
+			summary = FolderSummary.load(summaryfile)
+			self.assertEqual(summary.folders[("new",)], (1, 20, (), []))
+			self.assertEqual(summary.folders[("empty",)], (0, 0, (), []))
+			for function in [find_similar_folders, find_similar_trees]:
+				for min_size in [0, 1000]:
+					outputs = []
+					for indexfiles in [[indexfile], [summaryfile]]:
+						outfile = io.StringIO()
+						with contextlib.redirect_stdout(io.StringIO()):
+							function(indexfiles, outfile, verbosity=0, min_size=min_size)
+						outputs.append(outfile.getvalue())
+					self.assertTrue(outputs[0])
+					self.assertEqual(outputs[1], outputs[0], function.__name__)
+					if min_size:
+						self.assertLess(len(outputs[0]), length, "min_size should drop files")
+					length = len(outputs[0])
+
 	def test__collect_duplicate_files(self):
 		filelist = [
 			hpn("size hash", ("folder", "with", "file", "one"), "fileone"),
@@ -281,6 +1063,11 @@ class test_fsf_objects_FTree(unittest.TestCase):
 		self.assertEqual(FTree("tree3", subfolders=[FTree("subtree", cargo=13)]).num_subfolders(), 1)
 
 
+	def test_FTree_get_path(self):
+		self.assertEqual(self.testtree.get_path(), ())
+		self.assertEqual(self.testtree.get_by_path(("node", "leaf2")).get_path(), ("node", "leaf2"))
+
+
 	def test_FTree_is_leaf(self):
 		self.assertFalse(self.testtree.is_leaf())
 		self.assertTrue( self.testtree.get_subfolder("leaf").is_leaf())